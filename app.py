@@ -1,29 +1,105 @@
+from startup import StartupReport, lazy_resource, prewarm
+
+startup_report = StartupReport("chat")
+
 from flask import Flask, request, jsonify, render_template, session
 import os
 import json
-import requests
-from groq import Groq
+import gzip
+import hashlib
 from functools import lru_cache
 import uuid
 from dotenv import load_dotenv
+from upstream import single_flight, coalescing_stats, provider, provider_stats, get_json
+from conversation_log import ConversationLog
+import model_router
+import jobs
+import sharding
+import cache_warmer
+import metrics
+import profiler
+from jobs import job_queue
+from metrics import stage
+
+startup_report.mark("imports")
 
 # Load environment variables
 load_dotenv()
 
 app = Flask(__name__)
-app.secret_key = os.urandom(24)  # For session management
+# For session management; sharded nodes share SECRET_KEY so the router can read the chat_id
+app.secret_key = os.getenv("SECRET_KEY") or os.urandom(24)
+metrics.init_app(app, "chat")
+jobs.init_app(app)
+sharding.init_app(app)
+cache_warmer.init_app(app)
+profiler.init_app(app)
 
 # Initialize Groq client
 # Replace with your actual API key
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
-groq_client = Groq(api_key=GROQ_API_KEY)
+
+@lazy_resource("groq_client")
+def get_groq_client():
+    # groq pulls in httpx and pydantic; import it on first use, not at startup
+    from groq import Groq
+    return Groq(api_key=GROQ_API_KEY)
 
 # TomTom API key
 # Replace with your actual API key
 TOMTOM_API_KEY = os.getenv("TOMTOM_API_KEY")
+TOMTOM_BASE_URL = os.getenv("TOMTOM_BASE_URL", "https://api.tomtom.com")
 
-# Store chat history
+# Fetch nearby places on the enrichment job queue instead of inside /api/chat
+ASYNC_ENRICHMENT = os.getenv("ASYNC_ENRICHMENT", "1") == "1"
+
+# Store chat history; with CONVERSATION_LOG set, every turn is also appended
+# to that log and sessions missing from memory are reloaded from it
 chat_histories = {}
+CONVERSATION_LOG = os.getenv("CONVERSATION_LOG")
+# Turns reloaded from the log for a session that is not in memory
+CHAT_HISTORY_TURNS = int(os.getenv("CHAT_HISTORY_TURNS", "50"))
+# Turn index of the first in-memory turn, for chats reloaded from the log
+history_bases = {}
+# /api/history bodies at least this large are gzipped for clients that accept it
+HISTORY_GZIP_MIN_BYTES = int(os.getenv("HISTORY_GZIP_MIN_BYTES", "1024"))
+conversation_log = ConversationLog(
+    CONVERSATION_LOG, max_turns=int(os.getenv("CONVERSATION_MAX_TURNS", "0"))
+) if CONVERSATION_LOG else None
+
+# Places other nodes found hot, consulted before TomTom when sharded
+nearby_places_replicas = sharding.replicated_cache("nearby_places")
+
+# Last good TomTom payload per URL, served when TomTom is unavailable
+stale_responses = {}
+STALE_RESPONSES_SIZE = 1024
+
+# Sent instead of an LLM answer when Groq is rate limited, tripped or failing
+FALLBACK_RESPONSE = (
+    "**The response coordinator is temporarily unavailable.**\n\n"
+    "- If anyone is in immediate danger, call your local emergency number (911 in the US).\n"
+    "- Move away from the hazard and follow instructions from local authorities.\n"
+    "- Please describe the situation again in a moment for a full response plan."
+)
+
+def fetch_json(flight, url):
+    """
+    GET a TomTom JSON resource, sharing the request with concurrent identical callers
+    
+    Returns:
+        tuple: (data, source) where source is "live" or "stale_cache"
+    """
+    try:
+        data = single_flight(flight).do(url, provider("tomtom").call, get_json, url)
+    except Exception as e:
+        if url in stale_responses:
+            print(f"Serving stale {flight} response: {e}")
+            return stale_responses[url], "stale_cache"
+        raise
+    if len(stale_responses) >= STALE_RESPONSES_SIZE:
+        stale_responses.pop(next(iter(stale_responses)))
+    stale_responses[url] = data
+    return data, "live"
 
 @lru_cache(maxsize=100)
 def get_nearby_places(location, radius=5000, categories=None):
@@ -36,13 +112,18 @@ def get_nearby_places(location, radius=5000, categories=None):
         categories (list): Categories of places to search for
         
     Returns:
-        dict: JSON response with nearby places
+        dict: JSON response with nearby places; "source" is "stale_cache" if
+        any lookup was served from stale data
+    
+    Raises when a lookup fails with no stale copy, so failures are not cached.
     """
+    sources = set()
+    
     # First convert location name to coordinates if not already coordinates
     if not (isinstance(location, tuple) or ',' in location):
-        geocode_url = f"https://api.tomtom.com/search/2/geocode/{location}.json?key={TOMTOM_API_KEY}"
-        response = requests.get(geocode_url)
-        data = response.json()
+        geocode_url = f"{TOMTOM_BASE_URL}/search/2/geocode/{location}.json?key={TOMTOM_API_KEY}"
+        data, source = fetch_json("tomtom.geocode", geocode_url)
+        sources.add(source)
         if 'results' in data and len(data['results']) > 0:
             position = data['results'][0]['position']
             lat, lon = position['lat'], position['lon']
@@ -61,14 +142,15 @@ def get_nearby_places(location, radius=5000, categories=None):
     # Get nearby places for each category
     all_places = {}
     for category in categories:
-        poi_url = f"https://api.tomtom.com/search/2/poiSearch/{category}.json?lat={lat}&lon={lon}&radius={radius}&key={TOMTOM_API_KEY}"
-        response = requests.get(poi_url)
-        data = response.json()
+        poi_url = f"{TOMTOM_BASE_URL}/search/2/poiSearch/{category}.json?lat={lat}&lon={lon}&radius={radius}&key={TOMTOM_API_KEY}"
+        data, source = fetch_json("tomtom.poi", poi_url)
+        sources.add(source)
         all_places[category] = data.get('results', [])
     
     return {
         "center": {"lat": lat, "lon": lon},
-        "places": all_places
+        "places": all_places,
+        "source": "stale_cache" if "stale_cache" in sources else "live"
     }
 
 def get_route(from_location, to_location):
@@ -83,27 +165,48 @@ def get_route(from_location, to_location):
     to_lat, to_lon = map(float, to_location.split(','))
     
     # Get route
-    route_url = f"https://api.tomtom.com/routing/1/calculateRoute/{from_lat},{from_lon}:{to_lat},{to_lon}/json?key={TOMTOM_API_KEY}"
-    response = requests.get(route_url)
-    return response.json()
+    route_url = f"{TOMTOM_BASE_URL}/routing/1/calculateRoute/{from_lat},{from_lon}:{to_lat},{to_lon}/json?key={TOMTOM_API_KEY}"
+    data, _ = fetch_json("tomtom.route", route_url)
+    return data
+
+def nearby_places(location):
+    """get_nearby_places, answered from an entry replicated by another node when there is one"""
+    places = nearby_places_replicas.get(location)
+    if places is None:
+        places = get_nearby_places(location)
+        if "error" not in places:
+            nearby_places_replicas.record(location, places)
+    return places
+
+# Chats name places rather than coordinates, so regions are warmed by name
+cache_warmer.register("nearby", "tomtom", nearby_places, scope="name")
 
 def analyze_disaster(disaster_type, location, additional_info=None):
     """
     Analyze disaster and determine appropriate response
     """
     # Get nearby critical infrastructure
-    nearby_places = get_nearby_places(location)
+    places = nearby_places(location)
     
     # Prepare context for the LLM
     disaster_context = {
         "disaster_type": disaster_type,
         "location": location,
         "additional_info": additional_info,
-        "nearby_places": nearby_places
+        "nearby_places": places
     }
     
     return disaster_context
 
+def groq_chat_completion(**params):
+    """Groq chat completion shared with concurrent identical requests"""
+    return single_flight("groq.chat").do(
+        json.dumps(params, sort_keys=True),
+        provider("groq").call,
+        get_groq_client().chat.completions.create,
+        **params
+    )
+
 def get_chatbot_response(user_message, chat_history=None):
     """
     Get response from the LLM using Groq
@@ -147,25 +250,78 @@ def get_chatbot_response(user_message, chat_history=None):
     # Add the current user message
     messages.append({"role": "user", "content": user_message})
     
-    # Get response from Groq
-    response = groq_client.chat.completions.create(
-        model="llama3-70b-8192",  # or another appropriate model
-        messages=messages,
-        temperature=0.5,
-        max_tokens=1024
-    )
+    # Get response from Groq on the tier for this kind of message; identical
+    # concurrent conversations share one completion
+    kind = model_router.classify_chat(user_message, chat_history)
+    response, content, _ = model_router.complete(groq_chat_completion, kind, messages)
+    metrics.record_tokens("chat", response.usage)
     
-    return response.choices[0].message.content
+    return content
+
+def enrich_places(location):
+    """Enrichment job body: nearby places for a location, timed as the tomtom stage"""
+    with app.app_context(), stage("tomtom"):
+        return nearby_places(location)
+
+def load_history(chat_id):
+    """In-memory history of a chat, reloaded from the conversation log on a miss"""
+    history = chat_histories.get(chat_id)
+    if history is None:
+        history = conversation_log.tail(chat_id, CHAT_HISTORY_TURNS) if conversation_log else []
+        if history:
+            history_bases[chat_id] = conversation_log.turn_total(chat_id) - len(history)
+        chat_histories[chat_id] = history
+    return history
+
+def export_chat(chat_id):
+    return {"turns": list(load_history(chat_id)), "base": history_bases.get(chat_id, 0)}
+
+def import_chat(chat_id, state):
+    chat_histories[chat_id] = state["turns"]
+    history_bases[chat_id] = state.get("base", 0)
+    if conversation_log is not None:
+        conversation_log.clear(chat_id)
+        conversation_log.extend(chat_id, state["turns"])
+
+def release_chat(chat_id):
+    chat_histories.pop(chat_id, None)
+    history_bases.pop(chat_id, None)
+    if conversation_log is not None:
+        conversation_log.clear(chat_id)
+
+def chat_ids():
+    ids = set(chat_histories)
+    if conversation_log is not None:
+        ids.update(conversation_log.sessions())
+    return ids
+
+# Chats move to their new owner when nodes join or leave
+sharding.register("chat", chat_ids, export_chat, import_chat, release_chat)
+
+def history_etag(chat_id, next_turn):
+    """Histories only grow, so the chat and its turn count identify the content"""
+    return hashlib.sha1(chat_id.encode()).hexdigest()[:16] + f"-{next_turn}"
+
+def gzip_response(response):
+    if (len(response.get_data()) >= HISTORY_GZIP_MIN_BYTES
+            and 'gzip' in request.accept_encodings):
+        response.set_data(gzip.compress(response.get_data(), compresslevel=5))
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+def record_message(chat_id, role, content):
+    load_history(chat_id).append({"role": role, "content": content})
+    if conversation_log is not None:
+        conversation_log.append(chat_id, role, content)
 
 @app.route('/')
 def home():
     # Generate a session ID if one doesn't exist
     if 'chat_id' not in session:
-        session['chat_id'] = str(uuid.uuid4())
+        session['chat_id'] = sharding.new_id()
     
-    chat_id = session['chat_id']
-    if chat_id not in chat_histories:
-        chat_histories[chat_id] = []
+    load_history(session['chat_id'])
     
     return render_template('index.html', tomtom_api_key=TOMTOM_API_KEY)
 
@@ -176,17 +332,12 @@ def chat():
     
     # Get chat ID from session
     chat_id = session.get('chat_id', str(uuid.uuid4()))
-    if chat_id not in chat_histories:
-        chat_histories[chat_id] = []
     
     # Add user message to history
-    chat_histories[chat_id].append({"role": "user", "content": user_message})
+    record_message(chat_id, "user", user_message)
     
-    # Get chatbot response
-    bot_response = get_chatbot_response(user_message, chat_histories[chat_id])
-    
-    # Add bot response to history
-    chat_histories[chat_id].append({"role": "assistant", "content": bot_response})
+    # Record which path (live or degraded) each stage took
+    response_path = {"llm": "live", "places": None}
     
     # Check if we need to fetch location data
     location_data = None
@@ -203,37 +354,128 @@ def chat():
     }
     
     # Check for disaster types in user message
-    for disaster, keywords in disaster_keywords.items():
-        if any(keyword in user_message.lower() for keyword in keywords):
-            disaster_type = disaster
-            break
-    
-    # Extract location (this is a simplified approach)
-    # In a real implementation, use a proper NER model or geocoding service
-    if disaster_type:
-        # This is a very basic location extraction - would need improvements
-        words = user_message.replace(',', ' ').replace('.', ' ').split()
-        for i, word in enumerate(words):
-            if word.lower() in ["in", "at", "near"]:
-                if i + 1 < len(words):
-                    location = words[i + 1]
-                    # If we have a location and disaster type, get nearby places
-                    location_data = get_nearby_places(location)
-                    break
+    location = None
+    with stage("parse"):
+        for disaster, keywords in disaster_keywords.items():
+            if any(keyword in user_message.lower() for keyword in keywords):
+                disaster_type = disaster
+                break
+        
+        # Extract location (this is a simplified approach)
+        # In a real implementation, use a proper NER model or geocoding service
+        if disaster_type:
+            # This is a very basic location extraction - would need improvements
+            words = user_message.replace(',', ' ').replace('.', ' ').split()
+            for i, word in enumerate(words):
+                if word.lower() in ["in", "at", "near"]:
+                    if i + 1 < len(words):
+                        location = words[i + 1]
+                        break
+    
+    # Start the nearby-places lookup before the LLM call; identical locations share one job
+    enrichment = None
+    if location and ASYNC_ENRICHMENT:
+        enrichment = job_queue("enrichment").submit("places", location, enrich_places, location)
+    
+    # Get chatbot response
+    try:
+        with stage("llm"):
+            bot_response = get_chatbot_response(user_message, load_history(chat_id))
+    except Exception as e:
+        print(f"Error getting chatbot response: {e}")
+        bot_response = FALLBACK_RESPONSE
+        response_path["llm"] = "fallback"
+    
+    # Add bot response to history
+    record_message(chat_id, "assistant", bot_response)
+    
+    # If we have a location and disaster type, get nearby places
+    if enrichment is not None:
+        # Inline the places if the job beat the LLM; otherwise the client polls the job
+        if enrichment.done.is_set() and enrichment.status == "done":
+            location_data = enrichment.result
+            response_path["places"] = location_data.get("source", "live")
+        else:
+            response_path["places"] = "queued"
+    elif location:
+        try:
+            with stage("tomtom"):
+                location_data = nearby_places(location)
+            response_path["places"] = location_data.get("source", "live")
+        except Exception as e:
+            print(f"Error getting nearby places: {e}")
+            response_path["places"] = "unavailable"
     
     return jsonify({
         "response": bot_response,
         "location_data": location_data,
-        "disaster_type": disaster_type
+        "disaster_type": disaster_type,
+        "enrichment_job": enrichment.id if enrichment is not None else None,
+        "response_path": response_path
     })
 
 @app.route('/api/history', methods=['GET'])
 def get_history():
+    """Turns of the session's chat; `?since=<turn index>` returns only the newer ones
+
+    With `since` the body is {"turns", "since", "next"}: pass `next` as
+    `since` on the following call. `since` is the index of the first
+    returned turn, later than requested when older turns are no longer
+    held. An If-None-Match matching the ETag gets a 304.
+    """
+    since = request.args.get('since')
+    if since is not None:
+        try:
+            since = max(int(since), 0)
+        except ValueError:
+            return jsonify({"error": "since must be a turn index"}), 400
     chat_id = session.get('chat_id')
-    if not chat_id or chat_id not in chat_histories:
-        return jsonify([])
-    
-    return jsonify(chat_histories[chat_id])
+    if not chat_id or (chat_id not in chat_histories
+                       and (conversation_log is None or chat_id not in conversation_log)):
+        return jsonify([] if since is None else {"turns": [], "since": 0, "next": 0})
+
+    history = load_history(chat_id)
+    base = history_bases.get(chat_id, 0)
+    turns = list(history)
+    next_turn = base + len(turns)
+    etag = history_etag(chat_id, next_turn)
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        if since is None:
+            response = jsonify(turns)
+        else:
+            start = min(max(since - base, 0), len(turns))
+            response = jsonify({"turns": turns[start:], "since": base + start, "next": next_turn})
+        response = gzip_response(response)
+    # Weak: the gzipped and plain bodies share the tag
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+    return response
+
+@app.route('/api/upstream-stats', methods=['GET'])
+def upstream_stats():
+    return jsonify({"coalescing": coalescing_stats(), "providers": provider_stats(),
+                    "models": model_router.router_stats(), "warming": cache_warmer.warm_stats()})
+
+def places_cache_metrics():
+    info = get_nearby_places.cache_info()
+    return [
+        ("disaster_cache_hits_total", "counter", "Cache hits by cache",
+         [({"cache": "nearby_places"}, info.hits)]),
+        ("disaster_cache_requests_total", "counter", "Cache lookups by cache",
+         [({"cache": "nearby_places"}, info.hits + info.misses)]),
+    ]
+
+metrics.REGISTRY.register_collector(places_cache_metrics)
+
+cache_warmer.schedule_regions()
+
+startup_report.mark("app")
+if os.getenv("PREWARM_ON_START") == "1":
+    prewarm(get_groq_client)
+startup_report.ready()
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
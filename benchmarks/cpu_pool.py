@@ -0,0 +1,72 @@
+# benchmarks/cpu_pool.py
+"""Map rendering throughput, inline under threads versus the CPU process pool
+
+    python -m benchmarks.cpu_pool --workers 0,1,2,4 --maps 32 --facilities 300 --output pool.json
+
+Every configuration is driven by the same number of submitting threads, so
+workers=0 shows the GIL-bound baseline and the others show scaling with cores.
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.run import int_list, summarize, synthetic_facilities
+from cpu_pool import CpuPool, render_map
+from models import FACILITY_COLORS, Route
+
+
+def run(args):
+    facilities = synthetic_facilities(args.facilities)
+    routes = [Route(f"Route {i}", [[40.7128, -74.0060], [facilities[i].lat, facilities[i].lng]], "red")
+              for i in range(min(4, args.facilities))]
+    threads = max(max(args.workers), 1)
+    out_dir = tempfile.mkdtemp(prefix="cpu-pool-bench-")
+    results = []
+    try:
+        for workers in args.workers:
+            pool = CpuPool(workers)
+            if workers > 0:
+                pool.start()  # warm-up is excluded, as it would be at worker startup
+
+            def render(i):
+                start = time.perf_counter()
+                render_map(os.path.join(out_dir, f"map_{workers}_{i}.html"), (40.7128, -74.0060),
+                           "earthquake - bench", facilities, routes, FACILITY_COLORS, pool=pool)
+                return time.perf_counter() - start
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                latencies = list(executor.map(render, range(args.maps)))
+            wall = time.perf_counter() - start
+            pool.shutdown()
+            results.append(summarize(f"render_map.workers{workers}", "cpu_pool", latencies,
+                                     wall_time=wall, extra={"threads": threads, "facilities": args.facilities}))
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int_list, default=[0, 1, 2, os.cpu_count() or 1])
+    parser.add_argument("--maps", type=int, default=32)
+    parser.add_argument("--facilities", type=int, default=300)
+    parser.add_argument("--output", help="write machine-readable results to this JSON file")
+    args = parser.parse_args()
+
+    results = run(args)
+    for result in results:
+        print(f"{result['name']:<28} {result['throughput_rps']:>7} maps/s  p50={result['p50_ms']}ms")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"meta": {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                                "cpu_count": os.cpu_count(), "args": vars(args)},
+                       "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+# benchmarks/elevation.py
+"""Batched DEM elevation lookups against memory-mapped rasters
+
+    python -m benchmarks.elevation --size 8000 --points 1000,5000,20000 --output dem.json
+
+Writes a synthetic terrain raster as a stripped GeoTIFF, a tiled GeoTIFF
+and a raw .flt grid, checks lookups against the source array, then times
+batches of random points. Private resident memory growth is reported to
+show that the raster is never copied onto the heap.
+"""
+import argparse
+import json
+import os
+import shutil
+import struct
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.run import int_list, summarize
+from elevation import open_dem, rank_by_height
+from models import FACILITY_TYPES, FacilitySet
+
+WEST, NORTH, CELL = 139.0, 36.5, 1 / 3600  # 1 arc-second cells north-west of Tokyo
+
+
+def synthetic_terrain(size, seed=7):
+    """float32 hills and valleys, built row block by row block to bound memory"""
+    rng = np.random.default_rng(seed)
+    phases = rng.uniform(0, 2 * np.pi, 4)
+    cols = np.arange(size, dtype=np.float32) / size
+    terrain = np.empty((size, size), dtype=np.float32)
+    for start in range(0, size, 1024):
+        rows = (np.arange(start, min(start + 1024, size), dtype=np.float32) / size)[:, None]
+        terrain[start:start + len(rows)] = (
+            400 * np.sin(6 * rows + phases[0]) * np.cos(5 * cols + phases[1])
+            + 120 * np.sin(31 * rows + phases[2]) * np.sin(27 * cols + phases[3]) + 450)
+    return terrain
+
+
+def _tiff_header(entries):
+    """Little-endian TIFF header and IFD for (tag, type, values) entries, out-of-line values appended"""
+    codes = {2: "s", 3: "H", 4: "I", 12: "d"}
+    entries = sorted(entries)
+    extra_at = 8 + 2 + len(entries) * 12 + 4
+    ifd, extra = [], b""
+    for tag, kind, values in entries:
+        raw = values if kind == 2 else struct.pack(f"<{len(values)}{codes[kind]}", *values)
+        if len(raw) <= 4:
+            ifd.append(struct.pack("<HHI", tag, kind, len(values)) + raw.ljust(4, b"\0"))
+        else:
+            ifd.append(struct.pack("<HHII", tag, kind, len(values), extra_at + len(extra)))
+            extra += raw
+    return b"II" + struct.pack("<HIH", 42, 8, len(entries)) + b"".join(ifd) + b"\0" * 4 + extra
+
+
+def write_geotiff(path, terrain, tile=None):
+    """Minimal uncompressed float32 GeoTIFF, stripped or tiled when `tile` is set"""
+    height, width = terrain.shape
+    if tile:
+        across, down = -(-width // tile), -(-height // tile)
+        padded = np.zeros((down * tile, across * tile), dtype="<f4")
+        padded[:height, :width] = terrain
+        payload = padded.reshape(down, tile, across, tile).swapaxes(1, 2)
+        chunk, chunks = tile * tile * 4, down * across
+    else:
+        payload = terrain.astype("<f4")
+        chunk, chunks = height * width * 4, 1
+
+    def entries(data_offset):
+        offsets = [data_offset + i * chunk for i in range(chunks)]
+        layout = ([(322, 3, [tile]), (323, 3, [tile]), (324, 4, offsets), (325, 4, [chunk] * chunks)] if tile
+                  else [(273, 4, offsets), (278, 4, [height]), (279, 4, [chunk])])
+        return layout + [
+            (256, 4, [width]), (257, 4, [height]), (258, 3, [32]), (259, 3, [1]), (262, 3, [1]),
+            (277, 3, [1]), (339, 3, [3]), (33550, 12, [CELL, CELL, 0.0]),
+            (33922, 12, [0.0, 0.0, 0.0, WEST, NORTH, 0.0]), (42113, 2, b"-9999\0")]
+
+    # The header's size does not depend on the offset values, so measure it first
+    data_offset = len(_tiff_header(entries(0)))
+    with open(path, "wb") as f:
+        f.write(_tiff_header(entries(data_offset)))
+        payload.tofile(f)
+
+
+def write_flt(path, terrain):
+    terrain.astype("<f4").tofile(path)
+    height, width = terrain.shape
+    with open(os.path.splitext(path)[0] + ".hdr", "w") as f:
+        f.write(f"ncols {width}\nnrows {height}\nxllcorner {WEST}\nyllcorner {NORTH - height * CELL}\n"
+                f"cellsize {CELL}\nNODATA_value -9999\nbyteorder LSBFIRST\n")
+
+
+def rss_mb():
+    """Private resident memory (Linux RssAnon); mapped raster pages are page cache, not heap"""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("RssAnon:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def run(args):
+    out_dir = tempfile.mkdtemp(prefix="dem-bench-")
+    results = []
+    rng = np.random.default_rng(args.seed)
+    try:
+        terrain = synthetic_terrain(args.size)
+        files = {"geotiff_stripped": os.path.join(out_dir, "dem.tif"),
+                 "geotiff_tiled": os.path.join(out_dir, "dem_tiled.tif"),
+                 "flt": os.path.join(out_dir, "dem.flt")}
+        write_geotiff(files["geotiff_stripped"], terrain)
+        write_geotiff(files["geotiff_tiled"], terrain, tile=256)
+        write_flt(files["flt"], terrain)
+        probe_rows = rng.integers(0, args.size, 1000)
+        probe_cols = rng.integers(0, args.size, 1000)
+        expected = terrain[probe_rows, probe_cols]
+        del terrain
+        span = args.size * CELL
+
+        for fmt, path in files.items():
+            before = rss_mb()
+            dem = open_dem(path)
+            # Sample at cell centres so the check is exact
+            got = dem.elevations(NORTH - (probe_rows + 0.5) * CELL, WEST + (probe_cols + 0.5) * CELL)
+            if not np.array_equal(got, expected.astype(np.float64)):
+                raise AssertionError(f"{fmt}: lookups do not match the source raster")
+            for points in args.points:
+                latencies = []
+                for _ in range(args.iterations):
+                    lats = NORTH - rng.uniform(0, span, points)
+                    lngs = WEST + rng.uniform(0, span, points)
+                    start = time.perf_counter()
+                    dem.elevations(lats, lngs)
+                    latencies.append(time.perf_counter() - start)
+                results.append(summarize(f"elevations.{fmt}.{points}", "elevation", latencies, extra={
+                    "points": points, "raster_mb": round(os.path.getsize(path) / 2 ** 20, 1),
+                    "rss_growth_mb": round(rss_mb() - before, 1)}))
+
+        dem = open_dem(files["geotiff_stripped"])
+        facilities = FacilitySet()
+        for i in range(args.candidates):
+            facilities.append(FACILITY_TYPES[i % len(FACILITY_TYPES)], f"Site {i}",
+                              NORTH - rng.uniform(0, span), WEST + rng.uniform(0, span))
+        origin = (NORTH - span / 2, WEST + span / 2)
+        latencies = []
+        for _ in range(args.iterations):
+            start = time.perf_counter()
+            rank_by_height(dem, facilities, origin)
+            latencies.append(time.perf_counter() - start)
+        results.append(summarize(f"rank_by_height.{args.candidates}", "elevation", latencies,
+                                 extra={"candidates": args.candidates}))
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=8000, help="raster width and height in cells")
+    parser.add_argument("--points", type=int_list, default=[100, 1000, 5000])
+    parser.add_argument("--candidates", type=int, default=500, help="facilities ranked by rank_by_height")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write machine-readable results to this JSON file")
+    args = parser.parse_args()
+
+    results = run(args)
+    for result in results:
+        print(f"{result['name']:<36} p50={result['p50_ms']}ms p95={result['p95_ms']}ms "
+              f"rss+{result.get('rss_growth_mb', '-')}MB")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"meta": {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                                "cpu_count": os.cpu_count(), "args": vars(args)},
+                       "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# benchmarks/encoding.py
+"""Compare plain JSON, polyline JSON and varint encodings for routes and facilities
+
+    python -m benchmarks.encoding --vertices 100,5000 --facilities 500,10000 --output enc.json
+"""
+import argparse
+import json
+import math
+import random
+import time
+
+from benchmarks.run import int_list, summarize, synthetic_facilities, time_calls
+from facility_index import encode_facilities
+from geo_encoding import (decode_facilities_compact, decode_polyline, decode_varint_coords,
+                          encode_facilities_compact, encode_polyline, encode_varint_coords)
+
+
+def synthetic_route(vertices, seed=0):
+    """A wandering road-like path of `vertices` points starting near New York"""
+    rng = random.Random(seed)
+    lat, lng, heading = 40.7128, -74.0060, 0.0
+    coordinates = []
+    for _ in range(vertices):
+        heading += rng.uniform(-0.3, 0.3)
+        lat += math.cos(heading) * 0.0002
+        lng += math.sin(heading) * 0.0002
+        coordinates.append([lat, lng])
+    return coordinates
+
+
+def bench_codec(name, encode, decode, value, iterations):
+    encoded = encode(value)
+    size = len(encoded if isinstance(encoded, (bytes, str)) else json.dumps(encoded))
+    results = [
+        summarize(f"{name}.encode", "encoding", time_calls(lambda: encode(value), iterations),
+                  extra={"bytes": size}),
+        summarize(f"{name}.decode", "encoding", time_calls(lambda: decode(encoded), iterations),
+                  extra={"bytes": size}),
+    ]
+    return results
+
+
+def run(args):
+    results = []
+    for vertices in args.vertices:
+        route = synthetic_route(vertices)
+        results += bench_codec(f"route.json.v{vertices}", json.dumps, json.loads, route, args.iterations)
+        results += bench_codec(f"route.polyline.v{vertices}", encode_polyline, decode_polyline,
+                               route, args.iterations)
+        results += bench_codec(f"route.varint.v{vertices}", encode_varint_coords, decode_varint_coords,
+                               route, args.iterations)
+
+    for count in args.facilities:
+        facilities = synthetic_facilities(count)
+        indices = list(range(count))
+        results += bench_codec(
+            f"facilities.json_dicts.n{count}",
+            lambda f: json.dumps([facility.to_dict() for facility in f]), json.loads, facilities, args.iterations)
+        results += bench_codec(
+            f"facilities.json_rows.n{count}",
+            lambda f: json.dumps(encode_facilities(f, indices)), json.loads, facilities, args.iterations)
+        results += bench_codec(
+            f"facilities.compact.n{count}",
+            lambda f: json.dumps(encode_facilities_compact(f, indices)),
+            lambda s: decode_facilities_compact(json.loads(s)), facilities, args.iterations)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--vertices", type=int_list, default=[100, 2000, 10000])
+    parser.add_argument("--facilities", type=int_list, default=[500, 5000])
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--output", help="write machine-readable results to this JSON file")
+    args = parser.parse_args()
+
+    results = run(args)
+    for result in results:
+        print(f"{result['name']:<40} bytes={result['bytes']:<9} p50={result['p50_ms']}ms")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"meta": {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                                "args": vars(args)},
+                       "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+# benchmarks/pubsub.py
+"""Live-update fan-out: publish latency and coalescing with many subscribers on one node
+
+    python -m benchmarks.pubsub --subscribers 1000,20000 --events 2000 --output pubsub.json
+
+Subscribers follow random incidents, and a share also watch a bbox. A
+fraction are "slow": they are never drained during the run, so their
+queues show coalescing and dropping. The others are drained by a few
+threads, as the stream handlers of a cooperative server would be.
+"""
+import argparse
+import json
+import os
+import random
+import threading
+import time
+import tracemalloc
+
+from benchmarks.run import int_list, summarize
+from pubsub import LocalBroker
+
+KEYS = ["facilities", "plan", "routes", "map"]
+
+
+def run_one(subscribers, args):
+    rng = random.Random(args.seed)
+    broker = LocalBroker(max_pending=args.max_pending)
+    tracemalloc.start()
+    subs = []
+    for i in range(subscribers):
+        bbox = None
+        if rng.random() < args.geofenced:
+            lat, lng = rng.uniform(-60, 60), rng.uniform(-170, 170)
+            bbox = (lat, lng, lat + 0.5, lng + 0.5)
+        subs.append(broker.subscribe([f"incident:{rng.randrange(args.incidents)}"], bbox))
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    slow = set(rng.sample(range(subscribers), int(subscribers * args.slow)))
+    fast = [sub for i, sub in enumerate(subs) if i not in slow]
+    stop = threading.Event()
+
+    def drain(part):
+        while not stop.is_set():
+            for sub in part:
+                sub.drain(0)
+            time.sleep(0.01)
+
+    drainers = [threading.Thread(target=drain, args=(fast[i::args.drainers],), daemon=True)
+                for i in range(args.drainers)]
+    for thread in drainers:
+        thread.start()
+
+    payload = {"text": "x" * args.payload_bytes, "questions": ["Any injuries?"]}
+    latencies = []
+    start = time.perf_counter()
+    for i in range(args.events):
+        incident = rng.randrange(args.incidents)
+        lat, lng = rng.uniform(-60, 60), rng.uniform(-170, 170)
+        began = time.perf_counter()
+        broker.publish(f"incident:{incident}", KEYS[i % len(KEYS)], payload, lat, lng)
+        latencies.append(time.perf_counter() - began)
+    wall = time.perf_counter() - start
+    stop.set()
+    for thread in drainers:
+        thread.join()
+    stats = broker.stats()
+    return summarize(f"publish.{subscribers}", "pubsub", latencies, wall_time=wall, extra={
+        "subscribers": subscribers,
+        "bytes_per_subscriber": round(memory / max(subscribers, 1)),
+        "fanout_per_s": round(stats["fanout"] / wall),
+        "coalesced": stats["coalesced"],
+        "dropped": stats["dropped"],
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--subscribers", type=int_list, default=[1000, 10000, 20000])
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--incidents", type=int, default=200)
+    parser.add_argument("--geofenced", type=float, default=0.2, help="share of subscribers with a bbox")
+    parser.add_argument("--slow", type=float, default=0.1, help="share of subscribers never drained")
+    parser.add_argument("--drainers", type=int, default=4)
+    parser.add_argument("--max-pending", type=int, default=64)
+    parser.add_argument("--payload-bytes", type=int, default=1500)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write machine-readable results to this JSON file")
+    args = parser.parse_args()
+
+    results = [run_one(n, args) for n in args.subscribers]
+    for result in results:
+        print(f"{result['name']:<16} p50={result['p50_ms']}ms p99={result['p99_ms']}ms "
+              f"fanout={result['fanout_per_s']}/s mem={result['bytes_per_subscriber']}B/sub "
+              f"coalesced={result['coalesced']} dropped={result['dropped']}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"meta": {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                                "cpu_count": os.cpu_count(), "args": vars(args)},
+                       "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,520 @@
+# benchmarks/replay.py
+"""Record real traffic and upstream responses, then replay them offline against either app
+
+    python -m benchmarks.replay record --app respond --port 5000 --output traffic.jsonl.gz
+    python -m benchmarks.replay replay traffic.jsonl.gz --speed 10 --set GEOCODE_CACHE_TTL=0 \\
+        --output run.json --compare baseline.json
+
+record serves the app and points it at a recording proxy. The proxy
+forwards every Groq, TomTom, Overpass and Nominatim call to the real
+provider. The app is pointed at the proxy the same way provider_env points
+it at the stub server. Each incoming /api/chat or /api/respond request is
+logged with its arrival time and client, and each upstream exchange with
+its latency. Response bodies are stored once and referenced by hash. The
+log is gzipped when its name ends in .gz. API keys are never logged: TomTom
+keys are dropped from the logged query, and headers are not kept.
+
+replay loads the app in-process and points it at a replay server. The
+server answers every upstream call from the log, after its recorded
+latency times --upstream-latency; streamed Groq answers are spread out
+over that time. A call that was never recorded falls back to the stub
+providers' synthetic answer and counts as a miss. Requests are sent at
+their recorded offsets divided by --speed, or back to back with --speed 0.
+Each client's requests go in order: a chat session's, or an incident's
+follow-ups, whose incident_id is mapped to the one the replayed app
+minted. The report gives the latency per endpoint and the upstream calls
+per provider. It also gives cache hit rates and call-site coalescing, both
+taken from the app's /metrics and /api/upstream-stats.
+"""
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode, urlparse
+
+import requests
+
+from benchmarks.run import REPO_ROOT, compare, format_result, load_app_module, serve, summarize
+from benchmarks.stub_providers import StubHandler, StubState, provider_env
+
+APPS = {
+    "chat": ("app.py", "replay_chat_app"),
+    "respond": ("disaster-response-chatbot.py", "replay_respond_app"),
+}
+RECORDED_PATHS = ("/api/chat", "/api/respond")
+# Query arguments that are credentials, not part of what was asked
+SECRET_ARGS = {"key", "api_key"}
+# Not relayed by the recording proxy in either direction
+PROXY_SKIP_HEADERS = {"host", "content-length", "connection", "accept-encoding", "transfer-encoding",
+                      "content-encoding", "keep-alive"}
+CACHE_METRIC = re.compile(r'^disaster_cache_(hits|requests)_total\{cache="([^"]+)"\} (\S+)$')
+
+
+def provider_for(path):
+    if path.endswith("/chat/completions"):
+        return "groq"
+    if path == "/api/interpreter":
+        return "overpass"
+    if path.startswith(("/search/2/", "/routing/1/")):
+        return "tomtom"
+    if path.startswith(("/search", "/reverse")):
+        return "nominatim"
+    return None
+
+
+def exchange_key(method, path, query, body):
+    """What identifies an upstream call: method, path, query without credentials and a body hash"""
+    args = sorted((name, value) for name, value in parse_qsl(query, keep_blank_values=True)
+                  if name not in SECRET_ARGS)
+    try:
+        body = json.dumps(json.loads(body), sort_keys=True, separators=(",", ":")).encode()
+    except ValueError:
+        pass
+    digest = hashlib.sha1(body).hexdigest()[:16] if body else "-"
+    return f"{method} {path}?{urlencode(args)} {digest}"
+
+
+class TrafficLog:
+    """Append-only log of one recording: requests, upstream exchanges and the bodies they reference"""
+
+    def __init__(self, path, app_name):
+        self._file = gzip.open(path, "wt") if path.endswith(".gz") else open(path, "w")
+        self._lock = threading.Lock()
+        self._bodies = set()
+        self._start = time.monotonic()
+        self.write({"t": "meta", "app": app_name, "started": time.time()})
+
+    def elapsed(self):
+        return round(time.monotonic() - self._start, 4)
+
+    def write(self, record):
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with self._lock:
+            # Exchanges still in flight when recording stops are dropped
+            if not self._file.closed:
+                self._file.write(line)
+
+    def body(self, data):
+        """Store a response body once; returns its reference"""
+        ref = hashlib.sha1(data.encode()).hexdigest()[:16]
+        with self._lock:
+            if ref in self._bodies:
+                return ref
+            self._bodies.add(ref)
+        self.write({"t": "body", "id": ref, "data": data})
+        return ref
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def upstream_routes():
+    """The real provider endpoints, read before the app is pointed at the proxy"""
+    return {
+        "groq": os.getenv("GROQ_BASE_URL", "https://api.groq.com").rstrip("/"),
+        "tomtom": os.getenv("TOMTOM_BASE_URL", "https://api.tomtom.com").rstrip("/"),
+        "overpass": os.getenv("OVERPASS_URL", "http://overpass-api.de/api/interpreter"),
+        "nominatim": f"{os.getenv('NOMINATIM_SCHEME', 'https')}://"
+                     f"{os.getenv('NOMINATIM_DOMAIN', 'nominatim.openstreetmap.org')}",
+    }
+
+
+class RecordingProxy(StubHandler):
+    """Forwards provider calls upstream, relaying streamed bodies as they arrive, and logs each exchange"""
+    log = None  # TrafficLog, set by make_proxy
+    routes = None
+    session = None
+
+    def do_GET(self):
+        self._forward(b"")
+
+    def do_POST(self):
+        self._forward(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+
+    def _forward(self, raw):
+        url = urlparse(self.path)
+        provider = provider_for(url.path)
+        if provider is None:
+            return self._send_json({"error": "not a provider path"}, 404)
+        target = self.routes[provider] if provider == "overpass" else self.routes[provider] + url.path
+        if url.query:
+            target += "?" + url.query
+        headers = {name: value for name, value in self.headers.items() if name.lower() not in PROXY_SKIP_HEADERS}
+        at, start = self.log.elapsed(), time.perf_counter()
+        try:
+            upstream = self.session.request(self.command, target, headers=headers, data=raw or None,
+                                            stream=True, timeout=(5, 120))
+        except Exception as e:
+            print(f"Error forwarding {provider} call: {e}")
+            return self._send_json({"error": "upstream unavailable"}, 502)
+        content_type = upstream.headers.get("Content-Type", "application/json")
+        streamed = content_type.startswith("text/event-stream")
+        self.send_response(upstream.status_code)
+        self.send_header("Content-Type", content_type)
+        chunks, first_ms = [], None
+        if streamed:
+            self.send_header("Connection", "close")
+            self.end_headers()
+            # read1 returns what has arrived; iter_content would wait for a full chunk or the end
+            for chunk in iter(lambda: upstream.raw.read1(65536, decode_content=True), b""):
+                if first_ms is None:
+                    first_ms = round((time.perf_counter() - start) * 1000, 1)
+                chunks.append(chunk)
+                self.wfile.write(chunk)
+                self.wfile.flush()
+            self.close_connection = True
+        else:
+            chunks.append(upstream.content)
+            self.send_header("Content-Length", str(len(chunks[0])))
+            self.end_headers()
+            self.wfile.write(chunks[0])
+        body = b"".join(chunks).decode("utf-8", "replace")
+        self.log.write({"t": "upstream", "at": at, "provider": provider,
+                        "key": exchange_key(self.command, url.path, url.query, raw),
+                        "status": upstream.status_code, "type": content_type, "body": self.log.body(body),
+                        "ms": round((time.perf_counter() - start) * 1000, 1), "first_ms": first_ms})
+
+
+def make_proxy(log, host="127.0.0.1", port=0):
+    """Start the recording proxy on a background thread; returns (server, base_url)"""
+    session = requests.Session()
+    handler = type("BoundRecordingProxy", (RecordingProxy,),
+                   {"log": log, "routes": upstream_routes(), "session": session})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def record_requests(app, log, paths=RECORDED_PATHS):
+    """Log each request to `paths` with its arrival time, client, outcome and latency"""
+    from flask import g, request, session
+
+    @app.before_request
+    def _mark_arrival():
+        g.replay_at = log.elapsed()
+        g.replay_start = time.perf_counter()
+
+    @app.after_request
+    def _record_request(response):
+        if request.path not in paths or g.get("replay_start") is None:
+            return response
+        chat_id = session.get("chat_id")
+        answer = response.get_json(silent=True) if response.is_json else None
+        log.write({"t": "request", "at": g.replay_at,
+                   "client": hashlib.sha1(chat_id.encode()).hexdigest()[:12] if chat_id else None,
+                   "method": request.method, "path": request.path,
+                   "query": request.query_string.decode(), "body": request.get_json(silent=True),
+                   "status": response.status_code,
+                   "ms": round((time.perf_counter() - g.replay_start) * 1000, 1),
+                   "incident_id": answer.get("incident_id") if isinstance(answer, dict) else None})
+        return response
+
+
+def load_log(path):
+    """(app name, requests in arrival order, upstream exchanges by key)"""
+    meta, bodies, incoming, exchanges = {}, {}, [], {}
+    with (gzip.open(path, "rt") if path.endswith(".gz") else open(path)) as f:
+        for line in f:
+            record = json.loads(line)
+            kind = record.pop("t")
+            if kind == "meta":
+                meta = record
+            elif kind == "body":
+                bodies[record["id"]] = record["data"]
+            elif kind == "request":
+                incoming.append(record)
+            elif kind == "upstream":
+                record["body"] = bodies[record["body"]]
+                exchanges.setdefault(record["key"], []).append(record)
+    incoming.sort(key=lambda record: record["at"])
+    return meta.get("app"), incoming, exchanges
+
+
+class ReplayState(StubState):
+    """Recorded exchanges served in recorded order per key, with hit and miss counts per provider"""
+
+    def __init__(self, exchanges, latency_factor=1.0):
+        super().__init__()
+        self.exchanges = exchanges
+        self.latency_factor = latency_factor
+        self._served = {}  # key -> exchanges already served
+        self.counts = {}
+
+    def take(self, provider, key):
+        """The next recorded exchange for `key`; the last one repeats once they run out"""
+        with self._lock:
+            recorded = self.exchanges.get(key)
+            counts = self.counts.setdefault(provider, {"replayed": 0, "missed": 0})
+            if not recorded:
+                counts["missed"] += 1
+                return None
+            served = self._served.get(key, 0)
+            self._served[key] = served + 1
+            counts["replayed"] += 1
+            return recorded[min(served, len(recorded) - 1)]
+
+
+class ReplayHandler(StubHandler):
+    """Answers provider calls from the log, falling back to the stub's synthetic answers"""
+
+    def do_GET(self):
+        if not self._replay(b""):
+            super().do_GET()
+
+    def do_POST(self):
+        raw = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not self._replay(raw):
+            # The stub handler reads the body itself
+            self.rfile = io.BytesIO(raw)
+            super().do_POST()
+
+    def _replay(self, raw):
+        url = urlparse(self.path)
+        provider = provider_for(url.path)
+        exchange = provider and self.state.take(provider, exchange_key(self.command, url.path, url.query, raw))
+        if not exchange:
+            return False
+        factor = self.state.latency_factor
+        body = exchange["body"].encode()
+        if exchange.get("first_ms") is None:
+            time.sleep(exchange["ms"] / 1000 * factor)
+            self.send_response(exchange["status"])
+            self.send_header("Content-Type", exchange["type"])
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return True
+        time.sleep(exchange["first_ms"] / 1000 * factor)
+        self.send_response(exchange["status"])
+        self.send_header("Content-Type", exchange["type"])
+        self.send_header("Connection", "close")
+        self.end_headers()
+        events = re.findall(rb".*?\n\n|.+$", body, re.DOTALL)
+        gap = max(exchange["ms"] - exchange["first_ms"], 0) / 1000 * factor / max(len(events), 1)
+        for i, event in enumerate(events):
+            if i and gap:
+                time.sleep(gap)
+            self.wfile.write(event)
+            self.wfile.flush()
+        self.close_connection = True
+        return True
+
+
+def make_replay_server(exchanges, latency_factor=1.0, host="127.0.0.1", port=0):
+    """Start the replay server on a background thread; returns (server, state, base_url)"""
+    state = ReplayState(exchanges, latency_factor)
+    handler = type("BoundReplayHandler", (ReplayHandler,), {"state": state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state, f"http://{host}:{server.server_address[1]}"
+
+
+def group_clients(incoming):
+    """Split requests into per-client sequences: one per chat session, or per incident and its follow-ups"""
+    clients, incident_client = {}, {}
+    for i, record in enumerate(incoming):
+        body = record.get("body") if isinstance(record.get("body"), dict) else {}
+        client = record.get("client") or incident_client.get(body.get("incident_id")) or f"request-{i}"
+        if record.get("incident_id"):
+            incident_client[record["incident_id"]] = client
+        clients.setdefault(client, []).append(record)
+    return list(clients.values())
+
+
+def replay_requests(base_url, clients, speed, max_clients):
+    """Send every client's requests in order at their scheduled times; returns {path: [(seconds, ok)]}"""
+    results, incident_ids = {}, {}
+    lock = threading.Lock()
+    origin = min(records[0]["at"] for records in clients)
+    start = time.perf_counter()
+
+    def run_client(records):
+        session = requests.Session()
+        if any(record["path"] == "/api/chat" for record in records):
+            # The chat app keys history on the session it sets up on the index page
+            session.get(base_url + "/")
+        for record in records:
+            if speed:
+                delay = (record["at"] - origin) / speed - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            body = record.get("body")
+            if isinstance(body, dict) and body.get("incident_id") in incident_ids:
+                body = dict(body, incident_id=incident_ids[body["incident_id"]])
+            url = base_url + record["path"] + ("?" + record["query"] if record.get("query") else "")
+            began = time.perf_counter()
+            try:
+                response = session.request(record["method"], url, json=body, timeout=300)
+                ok = response.status_code < 400
+                answer = response.json() if ok and response.headers.get("Content-Type", "").startswith(
+                    "application/json") else None
+            except Exception as e:
+                print(f"Error replaying {record['path']}: {e}")
+                ok, answer = False, None
+            elapsed = time.perf_counter() - began
+            with lock:
+                results.setdefault(record["path"], []).append((elapsed, ok))
+                if record.get("incident_id") and isinstance(answer, dict) and answer.get("incident_id"):
+                    incident_ids[record["incident_id"]] = answer["incident_id"]
+
+    with ThreadPoolExecutor(max_workers=max_clients) as pool:
+        list(pool.map(run_client, clients))
+    return results, time.perf_counter() - start
+
+
+def app_counters(base_url):
+    """Cache and coalescing counters the app exposes, for before/after deltas"""
+    caches = {}
+    for line in requests.get(base_url + "/metrics", timeout=10).text.splitlines():
+        match = CACHE_METRIC.match(line)
+        if match:
+            caches.setdefault(match.group(2), {})[match.group(1)] = float(match.group(3))
+    coalescing = requests.get(base_url + "/api/upstream-stats", timeout=10).json().get("coalescing", {})
+    return caches, coalescing
+
+
+def counter_deltas(before, after):
+    return {name: {field: value - before.get(name, {}).get(field, 0)
+                   for field, value in fields.items() if isinstance(value, (int, float))}
+            for name, fields in after.items()}
+
+
+def run_replay(args):
+    app_name, incoming, exchanges = load_log(args.log)
+    app_name = args.app or app_name
+    if not incoming:
+        raise SystemExit(f"{args.log} has no recorded requests")
+    server, state, base = make_replay_server(exchanges, args.upstream_latency)
+    os.environ.update(provider_env(base))
+    if not args.respect_rate_limits:
+        for name in ("NOMINATIM", "OVERPASS", "TOMTOM", "GROQ"):
+            os.environ[f"UPSTREAM_{name}_RATE"] = "100000"
+            os.environ[f"UPSTREAM_{name}_BURST"] = "100000"
+    # Settings under comparison; the apps read them at import
+    for setting in args.set:
+        name, _, value = setting.partition("=")
+        os.environ[name] = value
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    # /api/respond overwrites the committed map; put it back afterwards
+    map_file = os.path.join(REPO_ROOT, "static", "disaster_map.html")
+    backup = map_file + ".replay-backup"
+    if os.path.exists(map_file):
+        shutil.copyfile(map_file, backup)
+    try:
+        module = load_app_module(*APPS[app_name])
+        app_server, app_url = serve(module.app)
+        caches_before, coalescing_before = app_counters(app_url)
+        results, wall = replay_requests(app_url, group_clients(incoming), args.speed, args.max_clients)
+        caches_after, coalescing_after = app_counters(app_url)
+        app_server.shutdown()
+    finally:
+        server.shutdown()
+        if os.path.exists(backup):
+            shutil.move(backup, map_file)
+
+    recorded_calls = {}
+    for records in exchanges.values():
+        for record in records:
+            recorded_calls[record["provider"]] = recorded_calls.get(record["provider"], 0) + 1
+    report_results = []
+    for path, samples in sorted(results.items()):
+        recorded = sorted(record["ms"] for record in incoming if record["path"] == path)
+        report_results.append(summarize(
+            f"replay.{path.rsplit('/', 1)[-1]}", "replay", [elapsed for elapsed, ok in samples if ok], wall,
+            sum(1 for _, ok in samples if not ok),
+            {"recorded_p50_ms": recorded[len(recorded) // 2] if recorded else None}))
+        print(format_result(report_results[-1]))
+    caches = counter_deltas(caches_before, caches_after)
+    for cache in caches.values():
+        cache["hit_rate"] = round(cache["hits"] / cache["requests"], 4) if cache.get("requests") else None
+    upstream = {name: dict(state.counts.get(name, {"replayed": 0, "missed": 0}),
+                           recorded=recorded_calls.get(name, 0))
+                for name in sorted(set(recorded_calls) | set(state.counts))}
+    for name, counts in upstream.items():
+        print(f"  upstream {name:<10} recorded={counts['recorded']} replayed={counts['replayed']} "
+              f"missed={counts['missed']}")
+    for name, cache in sorted(caches.items()):
+        print(f"  cache {name:<13} hit_rate={cache['hit_rate']} requests={cache.get('requests', 0):.0f}")
+
+    report = {
+        "meta": {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "cpu_count": os.cpu_count(),
+                 "app": app_name, "requests": len(incoming),
+                 "args": {k: v for k, v in vars(args).items() if k not in ("output", "compare", "func")}},
+        "results": report_results,
+        "upstream": upstream,
+        "caches": caches,
+        "coalescing": counter_deltas(coalescing_before, coalescing_after),
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.output}")
+    if args.compare:
+        compare(report_results, args.compare)
+
+
+def run_record(args):
+    log = TrafficLog(args.output, args.app)
+    proxy, proxy_url = make_proxy(log)
+    os.environ.update(provider_env(proxy_url))
+    module = load_app_module(*APPS[args.app])
+    record_requests(module.app, log)
+    from werkzeug.serving import make_server
+    server = make_server(args.host, args.port, module.app, threaded=True)
+    print(f"Recording {args.app} on http://{args.host}:{args.port} to {args.output}; Ctrl-C to stop")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        proxy.shutdown()
+        log.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    record = commands.add_parser("record", help="serve an app and log its traffic and upstream exchanges")
+    record.add_argument("--app", choices=sorted(APPS), default="respond")
+    record.add_argument("--host", default="127.0.0.1")
+    record.add_argument("--port", type=int, default=5000)
+    record.add_argument("--output", default="traffic.jsonl.gz")
+    record.set_defaults(func=run_record)
+
+    replay = commands.add_parser("replay", help="drive an app with a recorded log, offline")
+    replay.add_argument("log")
+    replay.add_argument("--app", choices=sorted(APPS), help="defaults to the app that was recorded")
+    replay.add_argument("--speed", type=float, default=1.0,
+                        help="arrival-time speed-up; 1 keeps the recorded timing, 0 sends back to back")
+    replay.add_argument("--upstream-latency", type=float, default=1.0,
+                        help="factor on recorded upstream latency; 0 answers at once")
+    replay.add_argument("--max-clients", type=int, default=64, help="clients replayed at the same time")
+    replay.add_argument("--set", action="append", default=[], metavar="NAME=VALUE",
+                        help="environment setting for the replayed app, e.g. GEOCODE_CACHE_TTL=0")
+    replay.add_argument("--respect-rate-limits", action="store_true",
+                        help="keep the production per-provider rate limits instead of lifting them")
+    replay.add_argument("--output", help="write machine-readable results to this JSON file")
+    replay.add_argument("--compare", help="previous --output file to compare against")
+    replay.set_defaults(func=run_replay)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
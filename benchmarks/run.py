@@ -0,0 +1,316 @@
+# benchmarks/run.py
+"""End-to-end load test and micro-benchmarks against stubbed providers
+
+Runs app.py (/api/chat) and disaster-response-chatbot.py (/api/respond) on
+local ports, pointed at benchmarks.stub_providers, and drives them at several
+concurrency levels. Results are written as JSON so runs can be compared:
+
+    python -m benchmarks.run --concurrency 1,8,32 --latency groq=0.4,overpass=0.2 \\
+        --output bench.json --compare baseline.json
+"""
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from benchmarks.stub_providers import make_server as make_stub_server, parse_latency, provider_env
+from models import FACILITY_TYPES, FacilitySet
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DISASTERS = ["earthquake", "flood", "fire", "hurricane", "tornado"]
+PLACES = ["Brooklyn", "Queens", "Hoboken", "Newark", "Yonkers", "Harlem", "Astoria",
+          "Flushing", "Bayonne", "Jersey", "Bronx", "Manhattan", "Staten", "Paterson",
+          "Elizabeth", "Clifton", "Passaic", "Union", "Kearny", "Secaucus"]
+
+
+def load_app_module(filename, module_name):
+    """Import one of the Flask entry points by file path (their names contain dashes)"""
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(REPO_ROOT, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def serve(app):
+    from werkzeug.serving import make_server
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarize(name, kind, latencies, wall_time=None, errors=0, extra=None):
+    latencies = sorted(latencies)
+    result = {
+        "name": name,
+        "kind": kind,
+        "count": len(latencies),
+        "errors": errors,
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 3) if latencies else None,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3) if latencies else None,
+    }
+    if wall_time:
+        result["throughput_rps"] = round(len(latencies) / wall_time, 2)
+    if extra:
+        result.update(extra)
+    return result
+
+
+def sample_message(rng):
+    return f"A {rng.choice(DISASTERS)} has been reported in {rng.choice(PLACES)}"
+
+
+def load_test(base_url, endpoint, concurrency, total, seed):
+    """Send `total` POSTs at a fixed concurrency; each worker keeps its own session"""
+    rng = random.Random(seed)
+    messages = [sample_message(rng) for _ in range(total)]
+    local = threading.local()
+    latencies, errors = [], []
+
+    def send(message):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+            local.session.get(base_url + "/")
+        start = time.perf_counter()
+        try:
+            response = local.session.post(base_url + endpoint, json={"message": message}, timeout=120)
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+        except Exception:
+            errors.append(message)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(send, messages))
+    return latencies, len(errors), time.perf_counter() - start
+
+
+def run_e2e(args, stub_state):
+    results = []
+    targets = [
+        ("chat", "app.py", "bench_chat_app", "/api/chat"),
+        ("respond", "disaster-response-chatbot.py", "bench_respond_app", "/api/respond"),
+    ]
+    for name, filename, module_name, endpoint in targets:
+        if name not in args.apps:
+            continue
+        module = load_app_module(filename, module_name)
+        server, base_url = serve(module.app)
+        try:
+            load_test(base_url, endpoint, 1, args.warmup, seed=-1)
+            for concurrency in args.concurrency:
+                stub_state.reset()
+                latencies, errors, wall = load_test(base_url, endpoint, concurrency,
+                                                    args.requests, seed=concurrency)
+                results.append(summarize(
+                    f"e2e.{name}.c{concurrency}", "e2e", latencies, wall, errors,
+                    {"concurrency": concurrency, "upstream_calls": dict(stub_state.calls)}))
+                print(format_result(results[-1]))
+        finally:
+            server.shutdown()
+    return results
+
+
+def time_calls(fn, iterations):
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+COLD_START_SNIPPET = """
+import importlib.util, json, sys, time
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location("cold", sys.argv[1])
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+print(json.dumps({"seconds": time.perf_counter() - start, "modules": len(sys.modules)}))
+"""
+
+
+def run_cold_start(args):
+    """Import each entry point in a fresh interpreter, as a newly scaled-out worker would"""
+    env = dict(os.environ, STARTUP_REPORT="0", PREWARM_ON_START="0")
+    results = []
+    for app_name, filename in (("chat", "app.py"), ("respond", "disaster-response-chatbot.py")):
+        latencies = []
+        modules = 0
+        for _ in range(args.cold_starts):
+            output = subprocess.run(
+                [sys.executable, "-c", COLD_START_SNIPPET, os.path.join(REPO_ROOT, filename)],
+                cwd=REPO_ROOT, env=env, capture_output=True, text=True, check=True).stdout
+            sample = json.loads(output.strip().splitlines()[-1])
+            latencies.append(sample["seconds"])
+            modules = sample["modules"]
+        results.append(summarize(f"cold_start.{app_name}", "startup", latencies,
+                                 extra={"modules_loaded": modules}))
+        print(format_result(results[-1]))
+    return results
+
+
+def synthetic_facilities(count, lat=40.7128, lng=-74.0060, seed=0):
+    rng = random.Random(seed)
+    facilities = FacilitySet()
+    for i in range(count):
+        loc_type = FACILITY_TYPES[i % len(FACILITY_TYPES)]
+        facilities.append(loc_type, f"{loc_type} {i}",
+                          lat + rng.uniform(-0.05, 0.05), lng + rng.uniform(-0.05, 0.05))
+    return facilities
+
+
+def run_micro(args):
+    module = load_app_module("disaster-response-chatbot.py", "bench_respond_micro")
+    results = []
+    texts = [sample_message(random.Random(i)) + ", magnitude 6.1" for i in range(50)]
+
+    for fn_name in ("extract_disaster_type", "extract_location", "extract_severity"):
+        fn = getattr(module, fn_name)
+        latencies = time_calls(lambda: [fn(text) for text in texts], args.iterations)
+        results.append(summarize(f"micro.{fn_name}.x{len(texts)}", "micro", latencies))
+
+    disaster_info = {"disaster_type": "earthquake", "location": "Brooklyn",
+                     "severity": {}, "lat": 40.7128, "lng": -74.0060}
+    for count in args.facilities:
+        facilities = synthetic_facilities(count)
+        latencies = time_calls(
+            lambda: module.coordinator.process_disaster(disaster_info, facilities), args.iterations)
+        results.append(summarize(f"micro.agents.n{count}", "micro", latencies))
+
+        routes = module.coordinator.process_disaster(disaster_info, facilities)["routes"]
+        latencies = time_calls(
+            lambda: module.generate_map(disaster_info, facilities, routes),
+            max(1, args.iterations // 10))
+        results.append(summarize(f"micro.generate_map.n{count}", "micro", latencies))
+
+        module.incident_facilities.put("bench", facilities)
+        module.MAP_RENDER_MODE = "clustered"
+        latencies = time_calls(
+            lambda: module.generate_map(disaster_info, facilities, routes, "bench"),
+            max(1, args.iterations // 10))
+        module.MAP_RENDER_MODE = "markers"
+        results.append(summarize(f"micro.generate_map_clustered.n{count}", "micro", latencies))
+
+    for result in results:
+        print(format_result(result))
+    return results
+
+
+def format_result(result):
+    line = f"{result['name']:<36} p50={result['p50_ms']}ms p95={result['p95_ms']}ms p99={result['p99_ms']}ms"
+    if "throughput_rps" in result:
+        line += f" {result['throughput_rps']} req/s errors={result['errors']}"
+    return line
+
+
+def compare(results, baseline_path):
+    """Print p50/p95 change against a previous run's JSON output"""
+    with open(baseline_path) as f:
+        baseline = {r["name"]: r for r in json.load(f)["results"]}
+    print(f"\nComparison with {baseline_path}:")
+    for result in results:
+        before = baseline.get(result["name"])
+        if not before:
+            continue
+        deltas = []
+        for key in ("p50_ms", "p95_ms", "throughput_rps"):
+            if before.get(key) and result.get(key) is not None:
+                deltas.append(f"{key} {(result[key] - before[key]) / before[key] * 100:+.1f}%")
+        print(f"  {result['name']:<36} " + "  ".join(deltas))
+
+
+def int_list(value):
+    return [int(v) for v in value.split(",") if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", type=int_list, default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=100, help="requests per concurrency level")
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--latency", default="", help="stub delay per provider, e.g. groq=0.5,overpass=0.2")
+    parser.add_argument("--apps", default="chat,respond", type=lambda v: v.split(","))
+    parser.add_argument("--facilities", type=int_list, default=[50, 500],
+                        help="facility counts for the agent and map micro-benchmarks")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--skip-e2e", action="store_true")
+    parser.add_argument("--skip-micro", action="store_true")
+    parser.add_argument("--cold-starts", type=int, default=5, help="fresh-interpreter imports per app; 0 skips")
+    parser.add_argument("--respect-rate-limits", action="store_true",
+                        help="keep the production per-provider rate limits instead of lifting them")
+    parser.add_argument("--output", help="write machine-readable results to this JSON file")
+    parser.add_argument("--compare", help="previous --output file to compare against")
+    args = parser.parse_args()
+
+    stub_server, stub_state, stub_url = make_stub_server(latency=parse_latency(args.latency))
+    os.environ.update(provider_env(stub_url))
+    if not args.respect_rate_limits:
+        for name in ("NOMINATIM", "OVERPASS", "TOMTOM", "GROQ"):
+            os.environ[f"UPSTREAM_{name}_RATE"] = "100000"
+            os.environ[f"UPSTREAM_{name}_BURST"] = "100000"
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    # /api/respond and generate_map overwrite the committed map; put it back afterwards
+    map_file = os.path.join(REPO_ROOT, "static", "disaster_map.html")
+    backup = map_file + ".bench-backup"
+    if os.path.exists(map_file):
+        shutil.copyfile(map_file, backup)
+
+    results = []
+    try:
+        if not args.skip_e2e:
+            results.extend(run_e2e(args, stub_state))
+        if not args.skip_micro:
+            results.extend(run_micro(args))
+        if args.cold_starts:
+            results.extend(run_cold_start(args))
+    finally:
+        stub_server.shutdown()
+        if os.path.exists(backup):
+            shutil.move(backup, map_file)
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+# benchmarks/stub_providers.py
+"""Local stand-ins for Groq, TomTom, Overpass and Nominatim with injected latency
+
+One threaded HTTP server answers all four providers from the recorded fixtures
+in benchmarks/fixtures. Point the apps at it with `provider_env(base_url)`.
+
+    python -m benchmarks.stub_providers --port 8765 --latency groq=0.8,overpass=0.3
+
+Streamed Groq completions ("stream": true) are sent as server-sent events, one
+word per chunk; `groq_token=0.02` in --latency spaces the chunks out.
+"""
+import argparse
+import copy
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# Center of the synthetic geocoder; every place name hashes to a point nearby
+BASE_LAT, BASE_LNG = 40.7128, -74.0060
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name)) as f:
+        return json.load(f)
+
+
+def parse_latency(spec):
+    """Parse "groq=0.5,overpass=0.2" into {"groq": 0.5, "overpass": 0.2}"""
+    latency = {}
+    for part in filter(None, (spec or "").split(",")):
+        name, _, seconds = part.partition("=")
+        latency[name.strip()] = float(seconds)
+    return latency
+
+
+def place_coordinates(name):
+    """Deterministic coordinates within ~0.2 degrees of the base point for a place name"""
+    digest = hashlib.sha1(name.lower().encode()).digest()
+    dlat = (digest[0] / 255 - 0.5) * 0.4
+    dlng = (digest[1] / 255 - 0.5) * 0.4
+    return round(BASE_LAT + dlat, 6), round(BASE_LNG + dlng, 6)
+
+
+def provider_env(base_url):
+    """Environment variables that point both apps at a stub server"""
+    host = urlparse(base_url).netloc
+    return {
+        "GROQ_API_KEY": os.getenv("GROQ_API_KEY", "stub-key"),
+        "GROQ_BASE_URL": base_url,
+        "TOMTOM_API_KEY": os.getenv("TOMTOM_API_KEY", "stub-key"),
+        "TOMTOM_BASE_URL": base_url,
+        "OVERPASS_URL": base_url + "/api/interpreter",
+        "NOMINATIM_DOMAIN": host,
+        "NOMINATIM_SCHEME": "http",
+    }
+
+
+class StubState:
+    def __init__(self, latency=None):
+        self.latency = latency or {}
+        self.groq_chat = load_fixture("groq_chat.json")
+        self.groq_parse = load_fixture("groq_parse.json")
+        self.overpass = load_fixture("overpass_elements.json")["elements"]
+        self.tomtom_poi = load_fixture("tomtom_poi.json")["results"]
+        self._lock = threading.Lock()
+        self.calls = {}
+
+    def record(self, provider):
+        with self._lock:
+            self.calls[provider] = self.calls.get(provider, 0) + 1
+        delay = self.latency.get(provider, 0)
+        if delay:
+            time.sleep(delay)
+
+    def reset(self):
+        with self._lock:
+            self.calls = {}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state = None  # StubState, set by make_server
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        if self.path.endswith("/chat/completions"):
+            self.state.record("groq")
+            if body.get("stream"):
+                return self._send_stream(self._completion(body))
+            return self._send_json(self._completion(body))
+        self._send_json({"error": "not found"}, 404)
+
+    def _send_stream(self, completion):
+        """Replay a completion as OpenAI-style chat.completion.chunk events"""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        base = {"id": completion["id"], "object": "chat.completion.chunk",
+                "created": completion["created"], "model": completion["model"]}
+        content = completion["choices"][0]["message"]["content"]
+        token_delay = self.state.latency.get("groq_token", 0)
+        for i, word in enumerate(re.findall(r"\s*\S+", content)):
+            delta = {"role": "assistant", "content": word} if i == 0 else {"content": word}
+            self._send_event(dict(base, choices=[{"index": 0, "delta": delta, "finish_reason": None}]))
+            if token_delay:
+                time.sleep(token_delay)
+        self._send_event(dict(base, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                              x_groq={"id": completion["id"], "usage": completion.get("usage")}))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+    def _send_event(self, payload):
+        self.wfile.write(f"data: {json.dumps(payload)}\n\n".encode())
+        self.wfile.flush()
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        path = url.path
+        if path == "/api/interpreter":
+            self.state.record("overpass")
+            return self._send_json({"elements": self._overpass(query.get("data", [""])[0])})
+        if path == "/search":
+            self.state.record("nominatim")
+            return self._send_json(self._nominatim(query.get("q", [""])[0]))
+        if path.startswith("/search/2/geocode/"):
+            self.state.record("tomtom")
+            name = unquote(path[len("/search/2/geocode/"):-len(".json")])
+            lat, lng = place_coordinates(name)
+            return self._send_json({"results": [{"position": {"lat": lat, "lon": lng}}]})
+        if path.startswith("/search/2/poiSearch/"):
+            self.state.record("tomtom")
+            category = unquote(path[len("/search/2/poiSearch/"):-len(".json")])
+            return self._send_json({"results": self._pois(category, query)})
+        if path.startswith("/routing/1/calculateRoute/"):
+            self.state.record("tomtom")
+            return self._send_json(self._route(path))
+        self._send_json({"error": "not found"}, 404)
+
+    def _completion(self, body):
+        messages = body.get("messages", [])
+        system = messages[0]["content"] if messages else ""
+        user = messages[-1]["content"] if messages else ""
+        if "Format the response as JSON" in system:
+            completion = copy.deepcopy(self.state.groq_parse)
+            match = re.search(r"in ([A-Za-z\s,]+)", user)
+            location = match.group(1).strip() if match else "unknown location"
+            disaster = next((d for d in ("earthquake", "flood", "fire", "hurricane", "tornado")
+                             if d in user.lower()), "unknown")
+            message = completion["choices"][0]["message"]
+            message["content"] = (message["content"]
+                                  .replace("{location}", location)
+                                  .replace("{disaster_type}", disaster))
+            if body.get("response_format", {}).get("type") == "json_object":
+                # JSON mode answers with the bare object
+                message["content"] = re.sub(r"^```json\n|\n```$", "", message["content"])
+            return completion
+        return self.state.groq_chat
+
+    def _overpass(self, query):
+        match = re.search(r"\(([-\d.]+),([-\d.]+),([-\d.]+),([-\d.]+)\)", query)
+        if not match:
+            return []
+        south, west, north, east = map(float, match.groups())
+        center_lat, center_lng = (south + north) / 2, (west + east) / 2
+        elements = []
+        for template in self.state.overpass:
+            lat, lng = center_lat + template["dlat"], center_lng + template["dlng"]
+            element = {"type": template["type"], "id": template["id"], "tags": template["tags"]}
+            if template["type"] == "node":
+                element.update(lat=lat, lon=lng)
+            else:
+                # What `out bb` returns for ways and relations
+                element["bounds"] = {"minlat": lat - 0.001, "minlon": lng - 0.001,
+                                     "maxlat": lat + 0.001, "maxlon": lng + 0.001}
+            elements.append(element)
+        return elements
+
+    def _nominatim(self, name):
+        lat, lng = place_coordinates(name)
+        return [{"lat": str(lat), "lon": str(lng), "display_name": name,
+                 "place_id": 1, "osm_type": "node", "osm_id": 1}]
+
+    def _pois(self, category, query):
+        lat = float(query.get("lat", [BASE_LAT])[0])
+        lng = float(query.get("lon", [BASE_LNG])[0])
+        return [
+            {"type": poi["type"], "poi": poi["poi"], "address": poi["address"],
+             "position": {"lat": lat + poi["dlat"], "lon": lng + poi["dlon"]}}
+            for poi in self.state.tomtom_poi if poi["category"] == category
+        ]
+
+    def _route(self, path):
+        points = path[len("/routing/1/calculateRoute/"):].split("/")[0]
+        (from_lat, from_lng), (to_lat, to_lng) = (map(float, p.split(",")) for p in points.split(":"))
+        steps = 20
+        return {"routes": [{
+            "summary": {"lengthInMeters": 2500, "travelTimeInSeconds": 420},
+            "legs": [{"points": [
+                {"latitude": from_lat + (to_lat - from_lat) * i / steps,
+                 "longitude": from_lng + (to_lng - from_lng) * i / steps}
+                for i in range(steps + 1)
+            ]}],
+        }]}
+
+
+def make_server(host="127.0.0.1", port=0, latency=None):
+    """Start the stub server on a background thread; returns (server, state, base_url)"""
+    state = StubState(latency)
+    handler = type("BoundStubHandler", (StubHandler,), {"state": state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, state, f"http://{host}:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", default="", help="per-provider delay, e.g. groq=0.5,overpass=0.2")
+    args = parser.parse_args()
+    server, _, base_url = make_server(args.host, args.port, parse_latency(args.latency))
+    print(f"Stub providers listening on {base_url}")
+    for key, value in provider_env(base_url).items():
+        print(f"  export {key}={value}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
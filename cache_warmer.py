@@ -0,0 +1,289 @@
+# cache_warmer.py
+"""Background warming of geo caches for high-risk regions and around new incidents
+
+Apps register a warm function per kind of lookup, naming the provider it
+spends and whether it takes a place name or a tile centre. warm_region()
+runs the name lookups for a place and, once its geocode gives coordinates,
+the tile lookups for the surrounding tiles. Regions come from WARM_REGIONS
+(re-warmed every WARM_REGIONS_INTERVAL) or from POST /api/warm for an
+incoming alert, served only when WARM_TOKEN is set. warm_area() queues the tiles around a point directly, as
+the disaster app does for each newly located incident.
+
+Tiles are WARM_TILE_DEG squares. Queued lookups run one at a time on a
+single thread, most urgent first: incidents, then alerts, then configured
+regions. Each provider gets its own budget of WARM_<PROVIDER>_RATE lookups
+per second, by default WARM_BUDGET_SHARE of its upstream rate, so warming
+leaves most of the rate to live requests. Nothing is sent to a provider
+whose circuit is open, and a key warmed in the last WARM_REFRESH seconds is
+skipped.
+"""
+import heapq
+import hmac
+import itertools
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import jsonify, request
+
+from upstream import CircuitBreaker, provider
+
+WARM_TILE_DEG = float(os.getenv("WARM_TILE_DEG", "0.05"))
+# ";"-separated place names or "lat,lng" pairs
+WARM_REGIONS = [region.strip() for region in os.getenv("WARM_REGIONS", "").split(";") if region.strip()]
+WARM_REGIONS_INTERVAL = float(os.getenv("WARM_REGIONS_INTERVAL", "900"))
+# Rings of tiles warmed around a region's or an incident's own tile
+WARM_REGION_RINGS = int(os.getenv("WARM_REGION_RINGS", "1"))
+WARM_INCIDENT_RINGS = int(os.getenv("WARM_INCIDENT_RINGS", "1"))
+WARM_BUDGET_SHARE = float(os.getenv("WARM_BUDGET_SHARE", "0.25"))
+WARM_REFRESH = float(os.getenv("WARM_REFRESH", "600"))
+WARM_QUEUE_MAX = int(os.getenv("WARM_QUEUE_MAX", "5000"))
+# Seconds a provider is left alone after its circuit was found open
+WARM_BACKOFF = float(os.getenv("WARM_BACKOFF", "30"))
+# Required as X-Warm-Token on POST /api/warm; the route is not served without it
+WARM_TOKEN = os.getenv("WARM_TOKEN", "")
+
+PRIORITY_INCIDENT, PRIORITY_ALERT, PRIORITY_REGION = 0, 1, 2
+
+
+def tile_of(lat, lng, tile_deg=WARM_TILE_DEG):
+    return (math.floor(lat / tile_deg), math.floor(lng / tile_deg))
+
+
+def tile_center(tile, tile_deg=WARM_TILE_DEG):
+    return ((tile[0] + 0.5) * tile_deg, (tile[1] + 0.5) * tile_deg)
+
+
+def tiles_around(lat, lng, rings, tile_deg=WARM_TILE_DEG):
+    """The tile holding (lat, lng) and `rings` rings of neighbours, nearest first"""
+    row, col = tile_of(lat, lng, tile_deg)
+    tiles = [(row + dr, col + dc) for dr in range(-rings, rings + 1) for dc in range(-rings, rings + 1)]
+    return sorted(tiles, key=lambda tile: max(abs(tile[0] - row), abs(tile[1] - col)))
+
+
+def parse_region(region):
+    """(lat, lng) for a "lat,lng" string, else the place name unchanged"""
+    parts = region.split(",")
+    if len(parts) == 2:
+        try:
+            return float(parts[0]), float(parts[1])
+        except ValueError:
+            pass
+    return region
+
+
+class _Kind:
+    __slots__ = ("name", "provider", "fn", "scope")
+
+    def __init__(self, name, provider_name, fn, scope):
+        self.name = name
+        self.provider = provider_name
+        self.fn = fn
+        self.scope = scope
+
+
+class CacheWarmer:
+    """Priority queues of warm lookups per provider, drained within each provider's budget"""
+
+    def __init__(self, tile_deg=WARM_TILE_DEG, refresh=WARM_REFRESH, max_queued=WARM_QUEUE_MAX):
+        self.tile_deg = tile_deg
+        self.refresh = refresh
+        self.max_queued = max_queued
+        self._kinds = {}
+        self._rates = {}  # provider -> warm lookups per second
+        self._queues = {}  # provider -> heap of (priority, seq, kind, key, args, then)
+        self._ready_at = {}  # provider -> monotonic time its budget allows the next lookup
+        self._queued = {}  # (kind, key) -> priority of its live queue entry
+        self._warmed = OrderedDict()  # (kind, key) -> monotonic time it was warmed
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._seq = itertools.count()
+        self._thread = None
+        self._counts = {"queued": 0, "warmed": 0, "failed": 0, "skipped": 0, "dropped": 0, "deferred": 0}
+
+    def register(self, kind, provider_name, fn, scope="tile", rate=None):
+        """Warm `kind` with fn(name) for scope "name" or fn(lat, lng) for scope "tile"
+
+        A "name" lookup that returns a dict with "lat" and "lng" also warms
+        the tiles around that point.
+        """
+        if rate is None:
+            # The provider's effective rate, including any UPSTREAM_<NAME>_RATE override
+            default = provider(provider_name).bucket.rate * WARM_BUDGET_SHARE
+            rate = float(os.getenv(f"WARM_{provider_name.upper()}_RATE", default))
+        with self._lock:
+            self._kinds[kind] = _Kind(kind, provider_name, fn, scope)
+            self._rates[provider_name] = rate
+
+    def submit(self, kind, key, args, priority, then=None):
+        """Queue one lookup; False when unknown, recently warmed, already queued as urgently, or full"""
+        slot = (kind, key)
+        with self._lock:
+            spec = self._kinds.get(kind)
+            if spec is None:
+                return False
+            warmed = self._warmed.get(slot)
+            if warmed is not None and time.monotonic() - warmed < self.refresh:
+                self._counts["skipped"] += 1
+                return False
+            queued = self._queued.get(slot)
+            if queued is not None and queued <= priority:
+                return False
+            if len(self._queued) >= self.max_queued:
+                self._counts["dropped"] += 1
+                return False
+            # A more urgent resubmission supersedes the entry already queued
+            self._queued[slot] = priority
+            heapq.heappush(self._queues.setdefault(spec.provider, []),
+                           (priority, next(self._seq), kind, key, args, then))
+            self._counts["queued"] += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._work, name="cache-warmer", daemon=True)
+                self._thread.start()
+            self._wake.notify()
+        return True
+
+    def warm_area(self, lat, lng, rings, priority, skip_center=False):
+        """Queue the tile lookups for the tiles around (lat, lng); returns how many were queued"""
+        kinds = [kind for kind in self._kinds.values() if kind.scope == "tile"]
+        queued = 0
+        for tile in tiles_around(lat, lng, rings, self.tile_deg):
+            if skip_center and tile == tile_of(lat, lng, self.tile_deg):
+                continue
+            for kind in kinds:
+                queued += self.submit(kind.name, f"{tile[0]}:{tile[1]}", tile_center(tile, self.tile_deg), priority)
+        return queued
+
+    def warm_region(self, region, rings, priority):
+        """Queue a place name's lookups, or a (lat, lng) point's tiles"""
+        if not isinstance(region, str):
+            return self.warm_area(region[0], region[1], rings, priority)
+
+        def located(result):
+            if isinstance(result, dict) and result.get("lat") is not None and result.get("lng") is not None:
+                self.warm_area(result["lat"], result["lng"], rings, priority)
+
+        kinds = [kind for kind in self._kinds.values() if kind.scope == "name"]
+        return sum(self.submit(kind.name, region, (region,), priority, located) for kind in kinds)
+
+    def _stale(self, entry):
+        return self._queued.get((entry[2], entry[3])) != entry[0]
+
+    def _next_task(self):
+        """(task, None) for the most urgent lookup a budget allows now, else (None, seconds to wait)"""
+        now = time.monotonic()
+        best, best_provider, wait = None, None, None
+        for name, heap in self._queues.items():
+            while heap and self._stale(heap[0]):
+                heapq.heappop(heap)
+            if not heap:
+                continue
+            ready_at = self._ready_at.get(name, 0.0)
+            if ready_at <= now and provider(name).breaker.state == CircuitBreaker.OPEN:
+                ready_at = self._ready_at[name] = now + WARM_BACKOFF
+                self._counts["deferred"] += 1
+            if ready_at > now:
+                wait = ready_at - now if wait is None else min(wait, ready_at - now)
+            elif best is None or heap[0][:2] < best[:2]:
+                best, best_provider = heap[0], name
+        if best is None:
+            return None, wait
+        heapq.heappop(self._queues[best_provider])
+        del self._queued[(best[2], best[3])]
+        self._ready_at[best_provider] = max(self._ready_at.get(best_provider, 0.0), now) + 1 / self._rates[best_provider]
+        return best, None
+
+    def _work(self):
+        while True:
+            with self._lock:
+                task, wait = self._next_task()
+                if task is None:
+                    self._wake.wait(wait)
+                    continue
+                spec = self._kinds[task[2]]
+            self._run(spec, task)
+
+    def _run(self, spec, task):
+        _, _, kind, key, args, then = task
+        try:
+            result = spec.fn(*args)
+        except Exception as e:
+            print(f"Error warming {kind} {key}: {e}")
+            with self._lock:
+                self._counts["failed"] += 1
+            return
+        with self._lock:
+            self._warmed[(kind, key)] = time.monotonic()
+            self._warmed.move_to_end((kind, key))
+            while len(self._warmed) > self.max_queued * 2:
+                self._warmed.popitem(last=False)
+            self._counts["warmed"] += 1
+        if then is not None:
+            then(result)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counts, pending=len(self._queued),
+                        rates={name: round(rate, 3) for name, rate in self._rates.items()})
+
+
+_warmer = CacheWarmer()
+
+
+def register(kind, provider_name, fn, scope="tile", rate=None):
+    _warmer.register(kind, provider_name, fn, scope, rate)
+
+
+def warm_area(lat, lng, rings=WARM_INCIDENT_RINGS, priority=PRIORITY_INCIDENT, skip_center=False):
+    return _warmer.warm_area(lat, lng, rings, priority, skip_center)
+
+
+def warm_region(region, rings=WARM_REGION_RINGS, priority=PRIORITY_REGION):
+    return _warmer.warm_region(region, rings, priority)
+
+
+def warm_stats():
+    return _warmer.stats()
+
+
+def schedule_regions(regions=None, interval=WARM_REGIONS_INTERVAL):
+    """Warm the configured high-risk regions now and again every `interval` seconds"""
+    regions = [parse_region(region) for region in (WARM_REGIONS if regions is None else regions)]
+    if not regions:
+        return None
+
+    def run():
+        while True:
+            for region in regions:
+                warm_region(region)
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name="warm-regions", daemon=True)
+    thread.start()
+    return thread
+
+
+def init_app(app):
+    """Serve POST /api/warm {"location"} or {"lat", "lng"} for incoming alerts when WARM_TOKEN is set"""
+    if not WARM_TOKEN:
+        return
+
+    @app.route('/api/warm', methods=['POST'])
+    def warm():
+        token = request.headers.get("X-Warm-Token", "")
+        if not hmac.compare_digest(token.encode(), WARM_TOKEN.encode()):
+            return jsonify({"error": "Bad warm token"}), 403
+        data = request.get_json(silent=True) or {}
+        try:
+            rings = min(int(data.get("rings", WARM_REGION_RINGS)), 3)
+            if data.get("lat") is not None and data.get("lng") is not None:
+                region = (float(data["lat"]), float(data["lng"]))
+            elif data.get("location"):
+                region = str(data["location"])
+            else:
+                return jsonify({"error": "Give a location or lat and lng"}), 400
+        except (TypeError, ValueError):
+            return jsonify({"error": "rings, lat and lng must be numbers"}), 400
+        return jsonify({"queued": warm_region(region, rings, PRIORITY_ALERT)}), 202
@@ -0,0 +1,228 @@
+# conversation_log.py
+"""Append-only conversation store with a per-session offset index
+
+Turns are appended to a JSON Lines log, one {"s", "r", "c", "t", "n"} record
+per message, n being the message's absolute number within its session. A
+sidecar `<log>.idx` records [offset, length, session, turn] for each line,
+so on open the index is rebuilt from the small sidecar instead of parsing
+the log; a log rescanned without it keeps the same numbers. Appending a turn is two appends; reading the last N turns
+of a session is N seeks. Cleared sessions and turns beyond `max_turns` are
+dead bytes, reclaimed by compaction once they make up `compact_ratio` of
+the log.
+
+A log has a single writer: the index lives in the owning process, so
+several worker processes need one log file each.
+"""
+import json
+import os
+import threading
+import time
+
+
+class ConversationLog:
+    def __init__(self, path, max_turns=0, compact_ratio=0.5, compact_min_bytes=1 << 20):
+        self.path = path
+        self.index_path = path + ".idx"
+        self.max_turns = max_turns  # 0 keeps every turn
+        self.compact_ratio = compact_ratio
+        self.compact_min_bytes = compact_min_bytes
+        self._lock = threading.Lock()
+        self._sessions = {}  # session -> [(offset, length, turn), ...] of live turns
+        self._next_turn = {}  # session -> absolute number of its next turn, counting dropped ones
+        self._dead_bytes = 0
+        self._size = 0
+        self.stats = {"appends": 0, "reads": 0, "compactions": 0}
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+        self._log = open(self.path, "ab")
+        self._idx = open(self.index_path, "ab")
+
+    # -- index -------------------------------------------------------------
+
+    def _apply(self, session, offset, length, turn=None):
+        """Index one log line; length < 0 marks a clear of `session`
+
+        Returns the turn's absolute number. Entries from before turns were
+        numbered get the next number in sequence.
+        """
+        if length < 0:
+            self._dead_bytes += sum(entry[1] for entry in self._sessions.pop(session, ())) - length
+            self._next_turn.pop(session, None)
+            return None
+        if turn is None:
+            turn = self._next_turn.get(session, 0)
+        self._next_turn[session] = turn + 1
+        turns = self._sessions.setdefault(session, [])
+        turns.append((offset, length, turn))
+        if self.max_turns and len(turns) > self.max_turns:
+            self._dead_bytes += turns.pop(0)[1]
+        return turn
+
+    def _load_index(self):
+        indexed_end = 0
+        if os.path.exists(self.index_path):
+            valid = 0
+            with open(self.index_path, "rb") as f:
+                for line in f:
+                    try:
+                        offset, length, session, *turn = json.loads(line)
+                    except ValueError:
+                        break
+                    if not line.endswith(b"\n"):
+                        break
+                    self._apply(session, offset, length, turn[0] if turn else None)
+                    indexed_end = max(indexed_end, offset + abs(length))
+                    valid += len(line)
+            if valid < os.path.getsize(self.index_path):
+                # Torn last write; the log tail scan below re-indexes what it covered
+                with open(self.index_path, "r+b") as f:
+                    f.truncate(valid)
+        self._size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        if self._size > indexed_end:
+            self._recover_tail(indexed_end)
+
+    def _recover_tail(self, start):
+        """Index log lines written after the last index entry (crash between the two appends)"""
+        entries = []
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            offset = start
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                length = len(line) if "r" in record else -len(line)
+                entries.append([offset, length, record["s"], record.get("n")])
+                offset += len(line)
+        if offset < self._size:
+            # Drop a partially written last record
+            with open(self.path, "r+b") as f:
+                f.truncate(offset)
+            self._size = offset
+        with open(self.index_path, "ab") as idx:
+            for offset, length, session, turn in entries:
+                turn = self._apply(session, offset, length, turn)
+                idx.write(json.dumps([offset, length, session, turn]).encode() + b"\n")
+
+    # -- writes ------------------------------------------------------------
+
+    def _write(self, record, clear=False):
+        turn = None if clear else self._next_turn.get(record["s"], 0)
+        if turn is not None:
+            record["n"] = turn
+        line = json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n"
+        offset = self._size
+        self._log.write(line)
+        self._log.flush()
+        length = -len(line) if clear else len(line)
+        self._idx.write(json.dumps([offset, length, record["s"], turn]).encode() + b"\n")
+        self._idx.flush()
+        self._size += len(line)
+        self._apply(record["s"], offset, length, turn)
+
+    def append(self, session, role, content):
+        """Append one turn to `session`"""
+        with self._lock:
+            self._write({"s": session, "r": role, "c": content, "t": round(time.time(), 3)})
+            self.stats["appends"] += 1
+            compact = self._should_compact()
+        if compact:
+            self.compact()
+
+    def extend(self, session, messages):
+        for message in messages:
+            self.append(session, message["role"], message["content"])
+
+    def clear(self, session):
+        """Forget a session; its bytes are reclaimed at the next compaction"""
+        with self._lock:
+            if session in self._sessions:
+                self._write({"s": session, "op": "clear"}, clear=True)
+
+    def _should_compact(self):
+        return self._size >= self.compact_min_bytes and self._dead_bytes >= self._size * self.compact_ratio
+
+    # -- reads -------------------------------------------------------------
+
+    def __contains__(self, session):
+        with self._lock:
+            return session in self._sessions
+
+    def sessions(self):
+        with self._lock:
+            return list(self._sessions)
+
+    def turn_count(self, session):
+        """Live turns of `session`, at most max_turns"""
+        with self._lock:
+            return len(self._sessions.get(session, ()))
+
+    def turn_total(self, session):
+        """Turns ever appended to `session`, including ones dropped beyond max_turns"""
+        with self._lock:
+            return self._next_turn.get(session, 0)
+
+    def tail(self, session, n=None):
+        """The last `n` turns (all when None) of `session` as {"role", "content"} dicts"""
+        # Read under the lock: a compaction rewrites the file and moves every offset
+        with self._lock:
+            turns = self._sessions.get(session, [])
+            turns = turns if n is None else turns[-n:] if n > 0 else []
+            self.stats["reads"] += 1
+            messages = []
+            with open(self.path, "rb") as f:
+                for offset, length, _ in turns:
+                    f.seek(offset)
+                    record = json.loads(f.read(length))
+                    messages.append({"role": record["r"], "content": record["c"]})
+        return messages
+
+    # -- maintenance -------------------------------------------------------
+
+    def compact(self):
+        """Rewrite the log with only live turns, session by session, and swap it in atomically"""
+        with self._lock:
+            tmp_log, tmp_idx = self.path + ".compact", self.index_path + ".compact"
+            sessions = {}
+            size = 0
+            with open(self.path, "rb") as src, open(tmp_log, "wb") as log, open(tmp_idx, "wb") as idx:
+                for session, turns in self._sessions.items():
+                    moved = []
+                    for offset, length, turn in turns:
+                        src.seek(offset)
+                        log.write(src.read(length))
+                        idx.write(json.dumps([size, length, session, turn]).encode() + b"\n")
+                        moved.append((size, length, turn))
+                        size += length
+                    sessions[session] = moved
+                log.flush()
+                os.fsync(log.fileno())
+                idx.flush()
+                os.fsync(idx.fileno())
+            self._log.close()
+            self._idx.close()
+            # Without an index the log is rescanned on open, and its records carry
+            # their turn numbers, so a crash between these steps leaves a
+            # consistent (if slower to open) store
+            os.remove(self.index_path)
+            os.replace(tmp_log, self.path)
+            os.replace(tmp_idx, self.index_path)
+            self._log = open(self.path, "ab")
+            self._idx = open(self.index_path, "ab")
+            self._sessions = sessions
+            self._size = size
+            self._dead_bytes = 0
+            self.stats["compactions"] += 1
+
+    def close(self):
+        with self._lock:
+            self._log.close()
+            self._idx.close()
+
+    def info(self):
+        with self._lock:
+            return dict(self.stats, sessions=len(self._sessions), bytes=self._size, dead_bytes=self._dead_bytes)
@@ -0,0 +1,180 @@
+# cpu_pool.py
+"""Process pool for CPU-bound stages such as folium map rendering
+
+Threaded Flask serves requests and renders maps in one interpreter, so a
+render holds the GIL that request handling needs. With CPU_POOL_WORKERS > 0
+renders run in warm worker processes instead. Facility columns travel
+through a shared-memory block rather than being pickled per facility, and
+workers write the page straight to disk, so only the path comes back.
+CPU_POOL_WORKERS=0 (the default) renders inline.
+"""
+import os
+import struct
+import threading
+import time
+
+from models import FacilitySet
+
+CPU_POOL_WORKERS = int(os.getenv("CPU_POOL_WORKERS", "0"))
+# Seconds to wait for one offloaded task before giving up on it
+CPU_POOL_TIMEOUT = float(os.getenv("CPU_POOL_TIMEOUT", "60"))
+
+_HEADER = struct.Struct("<II")  # facility count, byte length of the names blob
+
+
+def pack_facilities(facilities):
+    """Copy a FacilitySet into shared memory; returns (SharedMemory, spec for workers)
+
+    Layout: header | lats (f8) | lngs (f8) | type codes (u1) | NUL-joined UTF-8 names.
+    The caller must close() and unlink() the block once the task finishes.
+    """
+    from multiprocessing import shared_memory
+
+    if not isinstance(facilities, FacilitySet):
+        facilities = FacilitySet.from_dicts(facilities)
+    count = len(facilities.lats)
+    names = "\0".join(facilities.names).encode("utf-8")
+    chunks = [_HEADER.pack(count, len(names)), facilities.lats.tobytes(),
+              facilities.lngs.tobytes(), facilities.type_codes.tobytes(), names]
+    size = sum(len(chunk) for chunk in chunks)
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    offset = 0
+    for chunk in chunks:
+        shm.buf[offset:offset + len(chunk)] = chunk
+        offset += len(chunk)
+    return shm, (shm.name, list(facilities.types))
+
+
+def attach_facilities(spec):
+    """Rebuild a FacilitySet in a worker from a pack_facilities spec"""
+    from multiprocessing import shared_memory
+
+    name, types = spec
+    # Spawned workers share the parent's resource tracker, so attaching here
+    # does not make the block outlive or predecease the parent's unlink()
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        buf = shm.buf
+        count, names_len = _HEADER.unpack_from(buf, 0)
+        offset = _HEADER.size
+        facilities = FacilitySet()
+        facilities.types = types
+        facilities.lats.frombytes(buf[offset:offset + 8 * count])
+        offset += 8 * count
+        facilities.lngs.frombytes(buf[offset:offset + 8 * count])
+        offset += 8 * count
+        facilities.type_codes.frombytes(buf[offset:offset + count])
+        offset += count
+        blob = bytes(buf[offset:offset + names_len]).decode("utf-8")
+        facilities.names = blob.split("\0") if count else []
+        del buf
+    finally:
+        shm.close()
+    return facilities
+
+
+def _warm_worker():
+    """Pool initializer: pay for the folium import once per worker, not per task"""
+    import map_layers  # noqa: F401
+
+
+def _worker_pid(hold=0.1):
+    # Held briefly so each warm-up task lands on a different worker
+    time.sleep(hold)
+    return os.getpid()
+
+
+def render_map_task(path, center, label, facilities_spec, routes, colors, lazy_incident_id):
+    """Worker body: build the incident map and save it to `path`"""
+    import map_layers
+
+    facilities = attach_facilities(facilities_spec) if facilities_spec else FacilitySet()
+    m = map_layers.build_incident_map(center, label, facilities, routes, colors, lazy_incident_id)
+    m.save(path)
+    return path
+
+
+class CpuPool:
+    """Warm ProcessPoolExecutor for CPU-bound tasks"""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._counts = {"submitted": 0, "failed": 0, "inline": 0}
+
+    def start(self):
+        """Spawn the workers and wait until each has run its initializer"""
+        from concurrent.futures import ProcessPoolExecutor
+        from multiprocessing import get_context
+
+        with self._start_lock:
+            if self._executor is None:
+                # spawn, not fork: the parent runs job and server threads
+                executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=get_context("spawn"), initializer=_warm_worker)
+                pids = {f.result() for f in [executor.submit(_worker_pid) for _ in range(self.workers)]}
+                print(f"CPU pool ready with {len(pids)} warm workers")
+                with self._lock:
+                    self._executor = executor
+            return self._executor
+
+    def run(self, fn, *args):
+        """Run fn(*args) in a worker process and return its result"""
+        executor = self.start()
+        with self._lock:
+            self._counts["submitted"] += 1
+        try:
+            return executor.submit(fn, *args).result(timeout=CPU_POOL_TIMEOUT)
+        except Exception:
+            with self._lock:
+                self._counts["failed"] += 1
+            raise
+
+    def count_inline(self):
+        with self._lock:
+            self._counts["inline"] += 1
+
+    def shutdown(self):
+        with self._start_lock, self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counts, workers=self.workers, started=self._executor is not None)
+
+
+_pool = CpuPool(CPU_POOL_WORKERS)
+
+
+def cpu_pool():
+    return _pool
+
+
+def cpu_pool_stats():
+    return _pool.stats()
+
+
+def render_map(path, center, label, facilities, routes, colors, lazy_incident_id=None, pool=None):
+    """Render an incident map to `path`, in a worker process when the pool is enabled"""
+    pool = pool or _pool
+    routes = [{"name": r["name"], "color": r["color"], "coordinates": r["coordinates"]} for r in routes]
+    if pool.workers <= 0:
+        pool.count_inline()
+        import map_layers
+        map_layers.build_incident_map(center, label, facilities, routes, colors, lazy_incident_id).save(path)
+        return path
+
+    shm = None
+    spec = None
+    if not lazy_incident_id and len(facilities):
+        shm, spec = pack_facilities(facilities)
+    try:
+        return pool.run(render_map_task, path, list(center), label, spec, routes, dict(colors), lazy_incident_id)
+    finally:
+        if shm is not None:
+            shm.close()
+            shm.unlink()
@@ -1,86 +1,172 @@
 # disaster_response_chatbot.py
 import os
 import re
-import requests
-import folium
 import json
-from flask import Flask, request, jsonify, render_template, send_from_directory
-from geopy.geocoders import Nominatim
+import glob
+import hashlib
+import time
+import threading
+from collections import OrderedDict
+from functools import lru_cache, partial
+from startup import StartupReport, lazy_resource, prewarm
+
+startup_report = StartupReport("disaster-response")
+
+# groq, geopy and folium are imported on first use to keep cold start short
+from flask import Flask, request, jsonify, render_template, send_from_directory, make_response
 from dotenv import load_dotenv
-import groq
+from overpass_planner import (OverpassPlanner, FACILITY_QUERIES, METERS_PER_DEGREE, element_type,
+                              element_coords, filter_elements)
+from upstream import single_flight, coalescing_stats, provider, provider_stats
+import model_router
+import jobs
+import metrics
+import profiler
+import pubsub
+import sharding
+import cache_warmer
+import extraction
+from jobs import job_queue
+from metrics import stage
+from facility_index import IncidentFacilityStore, encode_facilities
+from models import FACILITY_COLORS, FACILITY_ICONS, AgentResponse, FacilitySet, Incident, Route
+from geo_encoding import wants_compact, encode_facilities_compact, encode_routes_compact
+from cpu_pool import CPU_POOL_WORKERS, cpu_pool, render_map
+from incident_state import IncidentStateStore, Pipeline
+from elevation import get_dem, rank_by_height
+
+startup_report.mark("imports")
 
 load_dotenv()
 
 app = Flask(__name__)
+metrics.init_app(app, "disaster-response")
+jobs.init_app(app)
+pubsub.init_app(app)
+sharding.init_app(app)
+cache_warmer.init_app(app)
+profiler.init_app(app)
 
 # Configuration
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 TOMTOM_API_KEY = os.getenv("TOMTOM_API_KEY")
+NOMINATIM_DOMAIN = os.getenv("NOMINATIM_DOMAIN", "nominatim.openstreetmap.org")
+NOMINATIM_SCHEME = os.getenv("NOMINATIM_SCHEME", "https")
+# "markers" inlines one folium marker per facility; "clustered" clusters them
+# client-side and fetches them lazily by viewport from /api/facilities; "shell"
+# serves one prebuilt, cacheable map page and sends only per-incident JSON
+MAP_RENDER_MODE = os.getenv("MAP_RENDER_MODE", "markers")
+# Optional Overpass-format JSON ({"elements": [...]}) used when Overpass is unavailable
+LOCAL_FACILITIES_FILE = os.getenv("LOCAL_FACILITIES_FILE")
+# Render markers/clustered maps on the "maps" job queue and answer with a job id
+ASYNC_MAP_RENDER = os.getenv("ASYNC_MAP_RENDER", "1") == "1"
+# Background renders go to static/maps/; only the newest MAP_FILES_KEEP are kept
+MAP_FILES_KEEP = int(os.getenv("MAP_FILES_KEEP", "256"))
+STATIC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
 
 # Initialize services
-groq_client = groq.Client(api_key=GROQ_API_KEY)  # Initialize Groq client
-geolocator = Nominatim(user_agent="disaster-response-chatbot")
+@lazy_resource("groq_client")
+def get_groq_client():
+    import groq
+    return groq.Client(api_key=GROQ_API_KEY)
+
+@lazy_resource("geolocator")
+def get_geolocator():
+    from geopy.geocoders import Nominatim
+    return Nominatim(user_agent="disaster-response-chatbot",
+                     domain=NOMINATIM_DOMAIN, scheme=NOMINATIM_SCHEME)
+
+@lazy_resource("folium")
+def load_folium():
+    import folium
+    return folium
+
+@lazy_resource("map_layers")
+def load_map_layers():
+    import map_layers
+    return map_layers
+
+overpass_planner = OverpassPlanner()
+incident_facilities = IncidentFacilityStore()
 
 # NLP Component
-def parse_disaster_input(user_input):
-    """Extract disaster information from user input using Groq"""
+def groq_completion(flight, key, **params):
+    """Groq chat completion shared with concurrent calls for the same key and model"""
+    return single_flight(flight).do(
+        f"{params['model']}|{key}", provider("groq").call,
+        get_groq_client().chat.completions.create, **params)
+
+def groq_extraction(parser, **params):
+    """Groq completion streamed through `parser`; returns an object shaped like a non-streamed one
+
+    Concurrent calls with the same model and messages share one completion;
+    only the leader's parser sees the answer as it arrives.
+    """
+    def run():
+        parser.reset()
+        if not extraction.EXTRACTION_STREAM:
+            response = provider("groq").call(get_groq_client().chat.completions.create, **params)
+            parser.feed(response.choices[0].message.content or "")
+            return response
+        # Read the whole stream inside the provider call, so a stream that breaks
+        # off counts against the circuit breaker like any other failed call
+        return provider("groq").call(consume_stream, parser, params)
+
+    key = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+    return single_flight("groq.parse").do(key, run)
+
+def consume_stream(parser, params):
+    stream = get_groq_client().chat.completions.create(stream=True, **params)
+    parts, usage = [], None
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            parts.append(chunk.choices[0].delta.content)
+            parser.feed(parts[-1])
+        usage = extraction.chunk_usage(chunk) or usage
+    return extraction.StreamedCompletion("".join(parts), usage)
+
+def prefetch_geocode(location):
+    """Start geocoding as soon as the streamed extraction has named the location"""
+    if isinstance(location, str) and location.strip() and location.strip() != "unknown location":
+        job_queue("prefetch").submit("geocode", location.strip(), get_coordinates, location.strip())
+
+def extract_incident(user_input):
+    """Extract disaster information from user input using Groq; coordinates are left unset
+
+    The answer is schema-checked, with one local and one model repair; when
+    it still fails the keyword extractors are used.
+    """
+    parser = extraction.StreamingObjectParser({"location": prefetch_geocode})
+    validation = extraction.Validation()
     try:
-        # Use Groq's API to analyze the disaster input
-        response = groq_client.chat.completions.create(
-            model="llama3-70b-8192",  # Using Llama3 model, adjust as needed
-            messages=[
-                {"role": "system", "content": """
-                You are an AI specialized in disaster response. Extract the following information from the user input:
-                1. Disaster type (earthquake, flood, fire, hurricane, etc.)
-                2. Location name (city, neighborhood, region)
-                3. Severity (if mentioned)
-                4. Any other critical details
-                Format the response as JSON.
-                """},
-                {"role": "user", "content": user_input}
-            ],
-            temperature=0.3,
-            max_tokens=500
-        )
-        content = response.choices[0].message.content
-        
-        # Try to extract JSON from the response
-        match = re.search(r'```json\n(.*?)\n```', content, re.DOTALL)
-        if match:
-            content = match.group(1)
-        else:
-            match = re.search(r'{.*}', content, re.DOTALL)
-            if match:
-                content = match.group(0)
-                
-        try:
-            parsed_data = json.loads(content)
-        except:
-            # Fallback if JSON parsing fails
-            parsed_data = {
-                "disaster_type": extract_disaster_type(user_input),
-                "location": extract_location(user_input),
-                "severity": extract_severity(user_input),
-                "details": ""
-            }
-        
-        # Get coordinates for the location
-        location_data = get_coordinates(parsed_data.get("location", ""))
-        parsed_data.update(location_data)
-        
+        # JSON mode on the extraction tier; a rejected answer is sent back once with its errors
+        with stage("llm"):
+            response, data, _ = model_router.complete(
+                partial(groq_extraction, parser), "extraction", extraction.extraction_messages(user_input),
+                validate=validation, repair=extraction.repair_messages, **extraction.request_options())
+        metrics.record_tokens("parse", response.usage)
+        extraction.record(validation.outcome())
+        with stage("parse"):
+            parsed_data = Incident.from_dict(data)
+        parsed_data.parse_source = "llm"
         return parsed_data
-        
+    
+    except ValueError as e:
+        # No tier returned an answer matching the schema
+        print(f"Extraction rejected, using keywords: {e}")
+        extraction.record("invalid")
     except Exception as e:
         print(f"Error parsing input: {e}")
-        # Fallback to basic parsing
-        return {
-            "disaster_type": extract_disaster_type(user_input),
-            "location": extract_location(user_input),
-            "severity": extract_severity(user_input),
-            "details": "",
-            "lat": None,
-            "lng": None
-        }
+        extraction.record("error")
+    # Fallback to basic parsing
+    with stage("parse"):
+        return Incident(
+            disaster_type=extract_disaster_type(user_input),
+            location=extract_location(user_input),
+            severity=extract_severity(user_input),
+            details="",
+            parse_source="keywords"
+        )
 
 def extract_disaster_type(text):
     """Simple rule-based extraction of disaster type"""
@@ -122,85 +208,142 @@ def extract_severity(text):
             return {key: match.group(1)}
     return {}
 
+# Last successful geocode per location name, served when Nominatim is unavailable
+_geocode_cache = OrderedDict()  # location name -> (fetched at, coords), least recently stored first
+_geocode_lock = threading.Lock()  # shared by request threads and the cache warmer
+GEOCODE_CACHE_SIZE = 1024
+# Places barely move; geocodes younger than this are answered without Nominatim
+GEOCODE_CACHE_TTL = float(os.getenv("GEOCODE_CACHE_TTL", "86400"))
+# Places other nodes geocoded often, used before Nominatim when sharded
+geocode_replicas = sharding.replicated_cache("geocode")
+
+def cached_geocode(location_name):
+    with _geocode_lock:
+        return _geocode_cache.get(location_name)
+
+def store_geocode(location_name, coords):
+    with _geocode_lock:
+        _geocode_cache[location_name] = (time.time(), coords)
+        _geocode_cache.move_to_end(location_name)
+        while len(_geocode_cache) > GEOCODE_CACHE_SIZE:
+            _geocode_cache.popitem(last=False)
+
 def get_coordinates(location_name):
-    """Get coordinates for a location using Nominatim"""
+    """Get coordinates for a location using Nominatim
+
+    The returned "geocode_source" reports which path was taken: "live",
+    "cache" (geocoded within GEOCODE_CACHE_TTL, possibly by the cache
+    warmer), "replica" (geocoded by another node), "default" (no location
+    given or found), "stale_cache" or "unavailable".
+    When the provider is down and nothing is cached the coordinates are None
+    so callers skip the map instead of pointing at the default city.
+    """
     try:
         if location_name and location_name != "unknown location":
-            location = geolocator.geocode(location_name)
+            cached = cached_geocode(location_name)
+            if cached is not None and time.time() - cached[0] < GEOCODE_CACHE_TTL:
+                # Cache hits count towards replication too, or popular places would rarely get hot
+                geocode_replicas.record(location_name, cached[1])
+                return dict(cached[1], geocode_source="cache")
+            replica = geocode_replicas.get(location_name)
+            if replica is not None:
+                return dict(replica, geocode_source="replica")
+            # Coalesce identical lookups first so only the leader spends rate budget
+            location = single_flight("nominatim.geocode").do(
+                location_name, provider("nominatim").call, get_geolocator().geocode, location_name)
             if location:
-                return {"lat": location.latitude, "lng": location.longitude}
+                coords = {"lat": location.latitude, "lng": location.longitude}
+                store_geocode(location_name, coords)
+                geocode_replicas.record(location_name, coords)
+                return dict(coords, geocode_source="live")
     except Exception as e:
         print(f"Geocoding error: {e}")
+        cached = cached_geocode(location_name)
+        if cached is not None:
+            return dict(cached[1], geocode_source="stale_cache")
+        return {"lat": None, "lng": None, "geocode_source": "unavailable"}
     
     # Fallback to default coordinates (New York City)
-    return {"lat": 40.7128, "lng": -74.0060}
+    return {"lat": 40.7128, "lng": -74.0060, "geocode_source": "default"}
 
-# GIS Component
-def get_critical_locations(location_info, radius=5000):
-    """Get critical locations using OpenStreetMap Overpass API"""
-    try:
-        lat = location_info.get("lat")
-        lng = location_info.get("lng")
-        
-        if not lat or not lng:
-            return []
-        
-        # OpenStreetMap Overpass API query
-        overpass_url = "http://overpass-api.de/api/interpreter"
-        query = f"""
-        [out:json];
-        (
-          node["amenity"="hospital"](around:{radius},{lat},{lng});
-          node["amenity"="police"](around:{radius},{lat},{lng});
-          node["amenity"="fire_station"](around:{radius},{lat},{lng});
-          node["leisure"="park"](around:{radius},{lat},{lng});
-          way["leisure"="park"](around:{radius},{lat},{lng});
-          relation["leisure"="park"](around:{radius},{lat},{lng});
-        );
-        out center;
-        """
-        
-        response = requests.get(overpass_url, params={"data": query})
-        data = response.json()
+def get_critical_locations(location_info, radius=5000, types=None, path=None):
+    """Get critical locations using OpenStreetMap Overpass API
+
+    Returns a FacilitySet. If `path` is a dict, path["facilities"] is set to the source that answered:
+    "live", "stale_cache", "local_data" or "unavailable".
+    """
+    lat = location_info.get("lat")
+    lng = location_info.get("lng")
+    
+    locations = FacilitySet()
+    if not lat or not lng:
+        return locations
+    
+    elements, source = get_facility_elements(lat, lng, radius, types)
+    if path is not None:
+        path["facilities"] = source
+    
+    for element in elements:
+        loc_type = element_type(element)
+        name = element["tags"].get("name", loc_type)
         
-        locations = []
-        for element in data.get("elements", []):
-            if "tags" in element:
-                loc_type = element["tags"].get("amenity") or element["tags"].get("leisure")
-                name = element["tags"].get("name", loc_type)
-                
-                # Get coordinates
-                if element["type"] == "node":
-                    coords = {"lat": element["lat"], "lng": element["lon"]}
-                else:
-                    # For ways and relations, use the center point
-                    coords = {"lat": element.get("center", {}).get("lat"), 
-                             "lng": element.get("center", {}).get("lon")}
-                
-                if coords["lat"] and coords["lng"]:
-                    locations.append({
-                        "type": loc_type,
-                        "name": name,
-                        "lat": coords["lat"],
-                        "lng": coords["lng"],
-                        "type_color": get_location_color(loc_type)
-                    })
+        # Get coordinates (center point for ways and relations)
+        elem_lat, elem_lng = element_coords(element)
         
-        return locations
+        if elem_lat and elem_lng:
+            locations.append(loc_type, name, elem_lat, elem_lng)
     
+    return locations
+
+def get_facility_elements(lat, lng, radius=5000, types=None):
+    """Fetch raw Overpass elements, degrading to stale cache or local data on failure"""
+    try:
+        # Nearby requests are merged into one bbox query and smaller radii are
+        # answered from a cached superset by the planner
+        return overpass_planner.query(lat, lng, radius, types), "live"
     except Exception as e:
         print(f"Error getting critical locations: {e}")
+    
+    stale = overpass_planner.lookup_stale(lat, lng, radius, types)
+    if stale is not None:
+        return stale, "stale_cache"
+    
+    local = load_local_facilities()
+    if local:
+        return filter_elements(local, lat, lng, radius, set(types or FACILITY_QUERIES)), "local_data"
+    
+    return [], "unavailable"
+
+def warm_geocode(location_name):
+    result = get_coordinates(location_name)
+    if result["geocode_source"] == "unavailable":
+        raise RuntimeError("Nominatim unavailable")
+    return result
+
+def warm_facilities(lat, lng, radius=5000):
+    """Cache Overpass results wide enough that an incident anywhere in this tile is answered from them"""
+    overpass_planner.query(lat, lng, radius + cache_warmer.WARM_TILE_DEG / 2 * METERS_PER_DEGREE)
+
+cache_warmer.register("geocode", "nominatim", warm_geocode, scope="name")
+cache_warmer.register("facilities", "overpass", warm_facilities)
+
+@lru_cache(maxsize=1)
+def load_local_facilities():
+    """Load the offline facility snapshot configured by LOCAL_FACILITIES_FILE"""
+    if not LOCAL_FACILITIES_FILE:
+        return []
+    try:
+        with open(LOCAL_FACILITIES_FILE) as f:
+            return json.load(f).get("elements", [])
+    except (OSError, ValueError) as e:
+        print(f"Error loading local facilities: {e}")
         return []
 
+LOCATION_COLORS = FACILITY_COLORS
+
 def get_location_color(location_type):
     """Return color based on location type"""
-    colors = {
-        "hospital": "red",
-        "police": "blue",
-        "fire_station": "orange",
-        "park": "green"
-    }
-    return colors.get(location_type, "gray")
+    return LOCATION_COLORS.get(location_type, "gray")
 
 # Multi-Agent System
 class CoordinatorAgent:
@@ -219,13 +362,13 @@ class CoordinatorAgent:
         combined_text = f"""
 DISASTER RESPONSE PLAN: {disaster_info.get('disaster_type', 'Disaster').upper()} in {disaster_info.get('location', 'unknown location')}
 
-{life_preservation['text']}
+{life_preservation.text}
 
-{rescue['text']}
+{rescue.text}
 
-{infrastructure['text']}
+{infrastructure.text}
 
-{communication['text']}
+{communication.text}
 
 IMPORTANT: This is an automated initial response based on limited information.
         """
@@ -233,7 +376,7 @@ IMPORTANT: This is an automated initial response based on limited information.
         return {
             'text': combined_text.strip(),
             'questions': questions,
-            'routes': life_preservation['routes'] + rescue['routes']
+            'routes': life_preservation.routes + rescue.routes
         }
     
     def generate_questions(self, disaster_info):
@@ -268,7 +411,7 @@ class LifePreservationAgent:
         disaster_type = disaster_info.get('disaster_type', 'unknown')
         
         # Find evacuation points (parks for earthquakes, high ground for floods, etc.)
-        evacuation_points = self.identify_evacuation_points(disaster_type, critical_locations)
+        evacuation_points = self.identify_evacuation_points(disaster_type, critical_locations, disaster_info)
         
         # Generate evacuation routes
         routes = self.generate_routes(disaster_info, evacuation_points)
@@ -289,25 +432,36 @@ class LifePreservationAgent:
         
         if evacuation_points:
             text += "\nNEARBY EVACUATION POINTS:\n"
-            for i, point in enumerate(evacuation_points[:3], 1):
-                text += f"- {point['name']}\n"
+            top = evacuation_points[:3]
+            dem = get_dem() if disaster_type == 'flood' else None
+            heights = dem.elevations([p.lat for p in top], [p.lng for p in top]) if dem else [None] * len(top)
+            for point, height in zip(top, heights):
+                if height is not None and height == height:
+                    text += f"- {point.name} ({height:.0f} m elevation)\n"
+                else:
+                    text += f"- {point.name}\n"
         
-        return {
-            'text': text,
-            'routes': routes
-        }
+        return AgentResponse(text, routes)
     
-    def identify_evacuation_points(self, disaster_type, critical_locations):
+    def identify_evacuation_points(self, disaster_type, critical_locations, disaster_info=None):
         """Identify appropriate evacuation points based on disaster type"""
         if disaster_type == 'earthquake' or disaster_type == 'fire':
             # Open areas like parks are best for earthquakes
-            return [loc for loc in critical_locations if loc['type'] == 'park']
+            return critical_locations.of_types(['park'])
         elif disaster_type == 'flood':
-            # Higher elevation areas for floods (simplified)
-            return [loc for loc in critical_locations if loc['type'] in ['hospital', 'police', 'fire_station']]
+            # Highest ground reachable without crossing low terrain, when a DEM is configured
+            dem = get_dem()
+            lat = disaster_info.get('lat') if disaster_info else None
+            lng = disaster_info.get('lng') if disaster_info else None
+            if dem is not None and lat and lng:
+                ranked = rank_by_height(dem, critical_locations, (lat, lng))
+                if ranked:
+                    return ranked
+            # Without elevation data, sturdy buildings
+            return critical_locations.of_types(['hospital', 'police', 'fire_station'])
         else:
             # Default to sturdy buildings
-            return [loc for loc in critical_locations if loc['type'] in ['hospital', 'police', 'fire_station']]
+            return critical_locations.of_types(['hospital', 'police', 'fire_station'])
     
     def generate_routes(self, disaster_info, evacuation_points):
         """Generate simple evacuation routes (straight lines in this simplified version)"""
@@ -319,11 +473,11 @@ class LifePreservationAgent:
             return routes
         
         for point in evacuation_points[:2]:  # Limit to 2 routes
-            routes.append({
-                'name': f"Evacuation to {point['name']}",
-                'coordinates': [[disaster_lat, disaster_lng], [point['lat'], point['lng']]],
-                'color': 'green'
-            })
+            routes.append(Route(
+                f"Evacuation to {point.name}",
+                [[disaster_lat, disaster_lng], [point.lat, point.lng]],
+                'green'
+            ))
         
         return routes
 
@@ -349,17 +503,13 @@ class InfrastructureAgent:
             text += "- Power outages are likely; have flashlights and batteries ready.\n"
             text += "- Water and other utilities may be disrupted.\n"
         
-        return {
-            'text': text,
-            'routes': []
-        }
+        return AgentResponse(text)
 
 class RescueOperationsAgent:
     def respond(self, disaster_info, critical_locations):
         """Generate rescue operation recommendations"""
         # Find emergency services
-        emergency_services = [loc for loc in critical_locations 
-                             if loc['type'] in ['hospital', 'police', 'fire_station']]
+        emergency_services = critical_locations.of_types(['hospital', 'police', 'fire_station'])
         
         # Generate routes for emergency services
         routes = self.generate_emergency_routes(disaster_info, emergency_services)
@@ -369,7 +519,7 @@ class RescueOperationsAgent:
         if emergency_services:
             text += "Nearest emergency facilities:\n"
             for i, service in enumerate(emergency_services[:3], 1):
-                text += f"- {service['name']} ({service['type']})\n"
+                text += f"- {service.name} ({service.type})\n"
         else:
             text += "No nearby emergency services identified in the system.\n"
         
@@ -378,10 +528,7 @@ class RescueOperationsAgent:
         text += "- If trapped, make noise to alert rescuers\n"
         text += "- If trained in first aid, assist others until help arrives\n"
         
-        return {
-            'text': text,
-            'routes': routes
-        }
+        return AgentResponse(text, routes)
     
     def generate_emergency_routes(self, disaster_info, emergency_services):
         """Generate routes for emergency services to reach the disaster area"""
@@ -393,11 +540,11 @@ class RescueOperationsAgent:
             return routes
         
         for service in emergency_services[:2]:  # Limit to 2 routes
-            routes.append({
-                'name': f"Response route from {service['name']}",
-                'coordinates': [[service['lat'], service['lng']], [disaster_lat, disaster_lng]],
-                'color': 'red'
-            })
+            routes.append(Route(
+                f"Response route from {service.name}",
+                [[service.lat, service.lng], [disaster_lat, disaster_lng]],
+                'red'
+            ))
         
         return routes
 
@@ -410,111 +557,388 @@ class CommunicationAgent:
         text += "- Report your status to friends/family via social media if possible\n"
         text += "- Share critical information about the situation with authorities\n"
         
-        return {
-            'text': text,
-            'routes': []
-        }
+        return AgentResponse(text)
 
 # Initialize agents
 coordinator = CoordinatorAgent()
 
 # Generate map visualization
-def generate_map(disaster_info, critical_locations, routes):
-    """Generate an interactive map with disaster location, critical facilities, and routes"""
+def generate_map(disaster_info, critical_locations, routes, incident_id=None,
+                 map_name='disaster_map.html'):
+    """Generate an interactive map with disaster location, critical facilities, and routes
+
+    The page is saved as static/<map_name>. In "clustered" render mode the facilities are not embedded; the map fetches
+    them for `incident_id` by viewport and clusters them client-side. In
+    "shell" mode nothing is rendered: the incident summary is stored for the
+    prebuilt shell and the returned file name points the shell at it.
+    """
     lat = disaster_info.get('lat', 40.7128)
     lng = disaster_info.get('lng', -74.0060)
+    label = f"{disaster_info.get('disaster_type', 'Disaster')} - {disaster_info.get('location', 'Unknown')}"
     
-    m = folium.Map(location=[lat, lng], zoom_start=14)
-    
-    # Add disaster marker
-    folium.Marker(
-        [lat, lng],
-        popup=f"{disaster_info.get('disaster_type', 'Disaster')} - {disaster_info.get('location', 'Unknown')}",
-        icon=folium.Icon(color='black', icon='warning-sign')
-    ).add_to(m)
-    
-    # Add circle around disaster area
-    folium.Circle(
-        radius=1000,
-        location=[lat, lng],
-        color='crimson',
-        fill=True,
-        fill_opacity=0.2
-    ).add_to(m)
-    
-    # Add critical locations
-    for loc in critical_locations:
-        folium.Marker(
-            [loc['lat'], loc['lng']],
-            popup=f"{loc['name']} ({loc['type']})",
-            icon=folium.Icon(color=loc['type_color'], icon=get_icon_for_type(loc['type']))
-        ).add_to(m)
-    
-    # Add routes
-    for route in routes:
-        folium.PolyLine(
-            route['coordinates'],
-            color=route['color'],
-            weight=4,
-            opacity=0.8,
-            popup=route['name']
-        ).add_to(m)
+    if MAP_RENDER_MODE == "shell" and incident_id:
+        incident_facilities.set_map_data(incident_id, {
+            "center": [lat, lng],
+            "zoom": 14,
+            "label": label,
+            "radius": 1000,
+            "routes": [route.to_dict() for route in routes]
+        })
+        shell_file, _ = get_map_shell()
+        return f"{shell_file}#incident={incident_id}"
     
-    # Save the map
-    static_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
-    os.makedirs(static_folder, exist_ok=True)
-    map_file = os.path.join(static_folder, 'disaster_map.html')
-    m.save(map_file)
+    # Build and save the page, in a worker process when the CPU pool is enabled
+    map_file = os.path.join(STATIC_FOLDER, map_name)
+    os.makedirs(os.path.dirname(map_file), exist_ok=True)
+    lazy_incident_id = incident_id if MAP_RENDER_MODE == "clustered" else None
+    render_map(map_file, (lat, lng), label, critical_locations, routes, LOCATION_COLORS, lazy_incident_id)
     
-    return 'disaster_map.html'
+    return map_name
+
+def map_job_key(disaster_info, critical_locations, routes, incident_id):
+    """Content hash of everything generate_map draws, so identical maps render once"""
+    digest = hashlib.sha1(json.dumps([
+        MAP_RENDER_MODE,
+        disaster_info.get('lat'), disaster_info.get('lng'),
+        disaster_info.get('disaster_type'), disaster_info.get('location'),
+        [route.to_dict() for route in routes]
+    ], default=str).encode())
+    if MAP_RENDER_MODE == "clustered":
+        # The page fetches this incident's facilities, so it is specific to the incident
+        digest.update(incident_id.encode())
+    else:
+        for loc in critical_locations:
+            digest.update(f"{loc.type}|{loc.name}|{loc.lat}|{loc.lng}\n".encode())
+    return digest.hexdigest()[:20]
+
+def render_map_job(disaster_info, critical_locations, routes, incident_id, map_name):
+    """Map job body: render static/<map_name> unless an identical map is already there"""
+    if not os.path.exists(os.path.join(STATIC_FOLDER, map_name)):
+        with app.app_context(), stage("map"):
+            generate_map(disaster_info, critical_locations, routes, incident_id, map_name)
+        prune_map_files()
+    result = {"map_file": map_name, "map_url": map_url_for(map_name, incident_id)}
+    pubsub.publish(f"incident:{incident_id}", "map", result,
+                   disaster_info.get('lat'), disaster_info.get('lng'))
+    return result
+
+def prune_map_files(keep=None):
+    """Delete all but the newest `keep` background-rendered maps"""
+    keep = MAP_FILES_KEEP if keep is None else keep
+    files = sorted(glob.glob(os.path.join(STATIC_FOLDER, 'maps', 'disaster_map.*.html')),
+                   key=os.path.getmtime, reverse=True)
+    for path in files[keep:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+@lru_cache(maxsize=1)
+def get_map_shell():
+    """Build the fingerprinted map shell once per process; returns (filename, html)"""
+    return load_map_layers().render_map_shell(LOCATION_COLORS)
 
 def get_icon_for_type(loc_type):
     """Return appropriate icon for location type"""
-    icons = {
-        'hospital': 'plus',
-        'police': 'flag',
-        'fire_station': 'fire-extinguisher',
-        'park': 'tree'
-    }
-    return icons.get(loc_type, 'info-sign')
+    return FACILITY_ICONS.get(loc_type, 'info-sign')
+
+# Incident pipeline: a follow-up report re-runs only the stages whose inputs changed
+incident_pipeline = Pipeline()
+incident_states = IncidentStateStore()
+
+@incident_pipeline.stage("geocode", ["location"],
+                         keep=lambda geo: geo["geocode_source"] != "unavailable")
+def geocode_stage(location):
+    with stage("geocode"):
+        return get_coordinates(location)
+
+@incident_pipeline.stage("overpass", ["incident_id", "geocode"],
+                         keep=lambda found: found[1] != "unavailable")
+def facilities_stage(incident_id, geo):
+    """(FacilitySet, source) around the geocoded location"""
+    path = {}
+    with stage("overpass"):
+        critical_locations = get_critical_locations(geo, path=path)
+    # Keep the facilities for viewport queries from the clustered map
+    incident_facilities.put(incident_id, critical_locations)
+    return critical_locations, path.get("facilities")
+
+# Later stages only read the routes, so a plan with the same routes leaves the map alone
+@incident_pipeline.stage("agents", ["incident", "geocode", "overpass"],
+                         key=lambda plan: [route.to_dict() for route in plan["routes"]])
+def agents_stage(incident, geo, found):
+    disaster_info = Incident.from_dict(incident.to_dict())
+    disaster_info.update(geo)
+    with stage("agents"):
+        return coordinator.process_disaster(disaster_info, found[0])
+
+@incident_pipeline.stage("map", ["incident_id", "headline", "geocode", "overpass", "agents"],
+                         keep=lambda result: result["map"] != "skipped")
+def map_stage(incident_id, headline, geo, found, plan):
+    """{"map_file", "map_job", "map"}; "map" is skipped, cached, queued or rendered"""
+    disaster_info = Incident(disaster_type=headline[0], location=headline[1])
+    disaster_info.update(geo)
+    critical_locations, routes = found[0], plan["routes"]
+    
+    # Keep the placeholder when the location could not be resolved
+    if disaster_info.get('lat') is None or disaster_info.get('lng') is None:
+        return {"map_file": 'placeholder_map.html', "map_job": None, "map": "skipped"}
+    if ASYNC_MAP_RENDER and MAP_RENDER_MODE != "shell":
+        # Answer with the plan now; the client polls /api/jobs/<map_job> for the map
+        key = map_job_key(disaster_info, critical_locations, routes, incident_id)
+        map_file = f"maps/disaster_map.{key}.html"
+        if os.path.exists(os.path.join(STATIC_FOLDER, map_file)):
+            return {"map_file": map_file, "map_job": None, "map": "cached"}
+        map_job = job_queue("maps").submit(
+            "map", key, render_map_job,
+            disaster_info, critical_locations, routes, incident_id, map_file).id
+        return {"map_file": map_file, "map_job": map_job, "map": "queued"}
+    with stage("map"):
+        map_file = generate_map(disaster_info, critical_locations, routes, incident_id)
+    return {"map_file": map_file, "map_job": None, "map": "rendered"}
+
+def publish_incident_updates(incident_id, ran, outputs):
+    """Push what this report changed to clients following the incident or watching its area"""
+    geo = outputs["geocode"]
+    lat, lng = geo.get("lat"), geo.get("lng")
+    topic = f"incident:{incident_id}"
+    if "overpass" in ran:
+        critical_locations, source = outputs["overpass"]
+        pubsub.publish(topic, "facilities", {
+            "count": len(critical_locations), "source": source,
+            "url": f"/api/facilities?incident={incident_id}"
+        }, lat, lng)
+    if "agents" in ran:
+        plan = outputs["agents"]
+        disaster_type, location = outputs["headline"]
+        pubsub.publish(topic, "plan", {
+            "disaster_type": disaster_type, "location": location,
+            "text": plan["text"], "questions": plan["questions"]
+        }, lat, lng)
+        pubsub.publish(topic, "routes", {"routes": [route.to_dict() for route in plan["routes"]]}, lat, lng)
+    # Queued maps are published by render_map_job when they finish
+    map_result = outputs["map"]
+    if "map" in ran and map_result["map"] in ("rendered", "cached"):
+        pubsub.publish(topic, "map", {"map_file": map_result["map_file"],
+                                      "map_url": map_url_for(map_result["map_file"], incident_id)}, lat, lng)
+
+def export_incident(incident_id):
+    state = incident_states.get(incident_id)
+    return {"incident": state.incident.to_dict()} if state is not None else None
+
+def import_incident(incident_id, data):
+    # Stage results are not moved; the next report recomputes them on the new owner
+    incident_states.create(Incident.from_dict(data["incident"]), incident_id)
+
+sharding.register("incident", incident_states.ids, export_incident, import_incident, incident_states.drop)
+
+def reports_other_disaster(incident, report):
+    """True when both name a disaster type and the types differ"""
+    known = [t for t in (incident.get("disaster_type"), report.get("disaster_type")) if t and t != "unknown"]
+    return len(known) == 2 and known[0] != known[1]
+
+def pipeline_metrics():
+    return [
+        ("disaster_pipeline_stage_total", "counter", "Incident pipeline stages run or reused from a previous report",
+         [({"stage": name, "result": result}, count)
+          for name, counts in incident_pipeline.stats().items() for result, count in counts.items()]),
+        ("disaster_incident_states", "gauge", "Incidents with state kept for follow-up reports",
+         [({}, incident_states.stats()["incidents"])]),
+    ]
+
+metrics.REGISTRY.register_collector(pipeline_metrics)
 
 # Flask routes
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return render_template('index2.html')
 
 @app.route('/static/<path:filename>')
 def serve_static(filename):
     return send_from_directory('static', filename)
 
+@app.route('/map-shell/<filename>')
+def serve_map_shell(filename):
+    shell_file, shell_html = get_map_shell()
+    if filename != shell_file:
+        return jsonify({"error": "Unknown map shell"}), 404
+    # The name carries a content fingerprint, so the page never changes
+    response = make_response(shell_html)
+    response.headers['Content-Type'] = 'text/html; charset=utf-8'
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response.set_etag(shell_file)
+    return response.make_conditional(request)
+
+def map_url_for(map_file, incident_id=None):
+    """URL the frontend should load for a generate_map result
+
+    Rendered maps live on the node that owns the incident, so their URL
+    names it for the shard router.
+    """
+    if map_file.startswith('map_shell.'):
+        return f"/map-shell/{map_file}"
+    if incident_id:
+        return f"/static/{map_file}?incident={incident_id}"
+    return f"/static/{map_file}"
+
+@app.route('/api/incidents/<incident_id>/map', methods=['GET'])
+def incident_map_data(incident_id):
+    """Per-incident summary drawn by the prebuilt map shell"""
+    index = incident_facilities.get(incident_id)
+    if index is None or index.map_data is None:
+        return jsonify({"error": "Unknown incident"}), 404
+    if wants_compact(request):
+        response = jsonify(dict(index.map_data, routes=encode_routes_compact(index.map_data["routes"]),
+                                format="compact"))
+    else:
+        response = jsonify(index.map_data)
+    response.headers['Vary'] = 'Accept'
+    return response
+
 @app.route('/api/respond', methods=['POST'])
 def respond():
     data = request.json
     user_input = data.get('message', '')
     
-    # Parse the disaster information
-    disaster_info = parse_disaster_input(user_input)
+    # Parse the disaster information; the model call is timed as "llm", the rest as "parse"
+    report = extract_incident(user_input)
+    
+    # A report carrying the incident_id of an earlier answer is a follow-up:
+    # its facts are merged in, unless it names a different kind of disaster
+    state = incident_states.get(data.get('incident_id'))
+    if state is not None and reports_other_disaster(state.incident, report):
+        # The new incident is in the same place unless the report names another
+        if report.get("location") in (None, "", "unknown location"):
+            with state.lock:
+                report.location = state.incident.location
+        state = None
+    if state is None:
+        state = incident_states.create(report, sharding.new_id())
     
-    # Get critical locations
-    critical_locations = get_critical_locations(disaster_info)
+    with state.lock:
+        if state.incident is not report:
+            state.incident.merge(report)
+        incident = state.incident
+        outputs, ran = incident_pipeline.run(state, {
+            "incident_id": state.id,
+            "incident": incident,
+            "location": incident.get("location", ""),
+            "headline": [incident.get("disaster_type"), incident.get("location")],
+        })
     
-    # Process with multi-agent system
-    response = coordinator.process_disaster(disaster_info, critical_locations)
+    publish_incident_updates(state.id, ran, outputs)
+    geo = outputs["geocode"]
+    if "geocode" in ran and geo.get("lat") is not None:
+        # Follow-ups and neighbouring reports will likely come from the surrounding tiles
+        cache_warmer.warm_area(geo["lat"], geo["lng"], skip_center=True)
     
-    # Generate map
-    map_file = generate_map(disaster_info, critical_locations, response['routes'])
+    response = outputs["agents"]
+    found = outputs["overpass"]
+    map_result = outputs["map"]
+    
+    # Record which path (live, degraded or reused) each stage took
+    response_path = {
+        "parse": report.parse_source,
+        "geocode": outputs["geocode"]["geocode_source"]
+    }
+    if found[1]:
+        response_path["facilities"] = found[1]
+    map_file, map_job = map_result["map_file"], map_result["map_job"]
+    if "map" in ran:
+        response_path["map"] = map_result["map"]
+    else:
+        response_path["map"] = "unchanged"
+        if map_job and os.path.exists(os.path.join(STATIC_FOLDER, map_file)):
+            map_job = None
+    if map_job:
+        map_file = None
     
     return jsonify({
         'text_response': response['text'],
         'follow_up_questions': response['questions'],
-        'map_file': map_file
+        'map_file': map_file,
+        'map_url': map_url_for(map_file, state.id) if map_file else None,
+        'map_job': map_job,
+        'incident_id': state.id,
+        'recomputed': ran,
+        'response_path': response_path
     })
 
-# Create templates folder and index.html
+@app.route('/api/facilities', methods=['GET'])
+def facilities_in_bbox():
+    """Compact facility rows for an incident inside bbox=south,west,north,east"""
+    index = incident_facilities.get(request.args.get('incident', ''))
+    if index is None:
+        return jsonify({"error": "Unknown incident"}), 404
+    
+    try:
+        south, west, north, east = map(float, request.args.get('bbox', '').split(','))
+    except ValueError:
+        return jsonify({"error": "bbox must be south,west,north,east"}), 400
+    
+    limit = min(request.args.get('limit', 2000, type=int), 5000)
+    indices = index.query(south, west, north, east, limit=limit + 1)
+    if wants_compact(request):
+        payload = encode_facilities_compact(index.facilities, indices[:limit])
+    else:
+        payload = encode_facilities(index.facilities, indices[:limit])
+    payload["truncated"] = len(indices) > limit
+    response = jsonify(payload)
+    response.headers['Vary'] = 'Accept'
+    return response
+
+@app.route('/api/upstream-stats', methods=['GET'])
+def upstream_stats():
+    coalescing = coalescing_stats()
+    # The Overpass planner coalesces by bbox/type coverage rather than exact key
+    coalescing["overpass.query"] = {
+        "calls": overpass_planner.stats["requests"],
+        "executed": overpass_planner.stats["upstream_queries"],
+        "coalesced": overpass_planner.stats["joined"],
+        "cache_hits": overpass_planner.stats["cache_hits"],
+    }
+    return jsonify({"coalescing": coalescing, "providers": provider_stats(),
+                    "models": model_router.router_stats(), "warming": cache_warmer.warm_stats(),
+                    "extraction": extraction.extraction_stats()})
+
+def overpass_cache_metrics():
+    stats = overpass_planner.stats
+    return [
+        ("disaster_cache_hits_total", "counter", "Cache hits by cache",
+         [({"cache": "overpass"}, stats["cache_hits"])]),
+        ("disaster_cache_requests_total", "counter", "Cache lookups by cache",
+         [({"cache": "overpass"}, stats["requests"])]),
+    ]
+
+metrics.REGISTRY.register_collector(overpass_cache_metrics)
+
+# Create templates folder and index2.html
 def create_templates():
-    os.makedirs('templates', exist_ok=True)
-    with open('templates/index.html', 'w') as f:
-        f.write("""
+    """Write templates/index2.html unless it is already up to date
+
+    Skipped without error on a read-only filesystem, so containers can ship
+    the template prebuilt.
+    """
+    write_if_changed('templates/index2.html', INDEX_HTML)
+
+def write_if_changed(path, content):
+    """Write `content` to `path` only when it differs; returns True if written"""
+    try:
+        with open(path) as f:
+            if f.read() == content:
+                return False
+    except OSError:
+        pass
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content)
+        return True
+    except OSError as e:
+        print(f"Could not write {path}: {e}")
+        return False
+
+INDEX_HTML = """
 <!DOCTYPE html>
 <html lang="en">
 <head>
@@ -700,6 +1124,10 @@ def create_templates():
             const messageInput = document.getElementById('message-input');
             const sendButton = document.getElementById('send-button');
             const mapFrame = document.getElementById('map-frame');
+            // Follow-up answers are merged into the incident of the previous response
+            let incidentId = null;
+            let incidentStream = null;
+            let currentMapUrl = null;
             
             // Initialize with a placeholder map
             fetch('/static/placeholder_map.html')
@@ -792,6 +1220,37 @@ def create_templates():
                 }
             }
             
+            function showMap(url) {
+                if (url && url !== currentMapUrl) {
+                    currentMapUrl = url;
+                    mapFrame.src = url;
+                }
+            }
+            
+            // Pushed updates for the current incident; the map arrives here once rendered
+            function followIncident(id) {
+                if (!window.EventSource || (incidentStream && incidentStream.incidentId === id)) return;
+                if (incidentStream) incidentStream.close();
+                incidentStream = new EventSource(`/api/stream?incident=${id}`);
+                incidentStream.incidentId = id;
+                incidentStream.addEventListener('map', function(e) {
+                    showMap(JSON.parse(e.data).data.map_url);
+                });
+            }
+            
+            function pollMapJob(jobId) {
+                fetch(`/api/jobs/${jobId}?incident=${incidentId}`)
+                .then(response => response.json())
+                .then(job => {
+                    if (job.status === 'done') {
+                        showMap(job.result.map_url);
+                    } else if (job.status !== 'failed' && job.status !== undefined) {
+                        setTimeout(() => pollMapJob(jobId), 500);
+                    }
+                })
+                .catch(error => console.error('Error:', error));
+            }
+            
             function sendMessage(message) {
                 showLoading();
                 
@@ -800,17 +1259,23 @@ def create_templates():
                     headers: {
                         'Content-Type': 'application/json',
                     },
-                    body: JSON.stringify({ message }),
+                    body: JSON.stringify({ message, incident_id: incidentId }),
                 })
                 .then(response => response.json())
                 .then(data => {
                     hideLoading();
+                    incidentId = data.incident_id;
+                    followIncident(incidentId);
                     addBotMessage(data.text_response);
                     addQuestions(data.follow_up_questions);
                     
-                    // Update map
-                    if (data.map_file) {
-                        mapFrame.src = `/static/${data.map_file}`;
+                    // Update map, or wait for the background render (pushed, or polled without EventSource)
+                    if (data.map_url) {
+                        showMap(data.map_url);
+                    } else if (data.map_file) {
+                        showMap(`/static/${data.map_file}`);
+                    } else if (data.map_job && !window.EventSource) {
+                        pollMapJob(data.map_job);
                     }
                 })
                 .catch(error => {
@@ -841,16 +1306,45 @@ def create_templates():
     </script>
 </body>
 </html>
-        """)
+        """
 
 # Create placeholder map
 def create_placeholder_map():
-    os.makedirs('static', exist_ok=True)
-    m = folium.Map(location=[40.7128, -74.0060], zoom_start=10)
-    m.save('static/placeholder_map.html')
+    """Render static/placeholder_map.html once; an existing file is left alone"""
+    if os.path.exists('static/placeholder_map.html'):
+        return
+    m = load_folium().Map(location=[40.7128, -74.0060], zoom_start=10)
+    write_if_changed('static/placeholder_map.html', m.get_root().render())
+
+def prewarm_resources():
+    """Load the deferred clients and render the map shell in the background"""
+    loaders = [get_groq_client, get_geolocator, load_folium, load_map_layers, get_map_shell]
+    if CPU_POOL_WORKERS > 0:
+        loaders.append(cpu_pool().start)
+    return prewarm(*loaders)
+
+def start_background_work():
+    """Start region warming, and the prewarm when PREWARM_ON_START=1
+
+    Not run in CPU pool workers: spawn re-imports this file there as
+    __mp_main__, and each would otherwise warm regions through its own
+    rate limiters and start a pool of its own.
+    """
+    cache_warmer.schedule_regions()
+    # Workers started by a process manager opt in; `python disaster-response-chatbot.py` always prewarms
+    if os.getenv("PREWARM_ON_START") == "1":
+        prewarm_resources()
+
+startup_report.mark("app")
+if __name__ != '__mp_main__':
+    start_background_work()
+    startup_report.ready()
 
 # Main function
 if __name__ == '__main__':
     create_templates()
     create_placeholder_map()
+    # Serve immediately; the first map request only waits if the shell is still rendering
+    if os.getenv("PREWARM_ON_START") != "1":
+        prewarm_resources()
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,254 @@
+# elevation.py
+"""Terrain heights from a memory-mapped DEM raster
+
+ELEVATION_DEM_FILE points at a single-band elevation grid in lat/lng
+coordinates: an uncompressed GeoTIFF (stripped or tiled), or a raw ESRI
+grid (.flt/.bil) next to its .hdr. The raster is opened with numpy.memmap,
+so a country-sized DEM costs no RAM up front and a lookup only pages in the
+cells it touches. Lookups are vectorized: a batch of points is one gather
+on the mapped array. Cells are sampled nearest-neighbour.
+
+Compressed GeoTIFFs cannot be mapped; convert them once with
+`gdal_translate -co COMPRESS=NONE in.tif out.tif`.
+"""
+import os
+import struct
+import threading
+import time
+from array import array
+
+from models import FacilitySubset
+from startup import lazy_resource
+
+ELEVATION_DEM_FILE = os.getenv("ELEVATION_DEM_FILE")
+# Vertices sampled along each straight evacuation route when ranking by height
+ELEVATION_ROUTE_SAMPLES = int(os.getenv("ELEVATION_ROUTE_SAMPLES", "16"))
+
+_lock = threading.Lock()
+_stats = {"lookups": 0, "points": 0, "seconds_sum": 0.0}
+
+
+class DEM:
+    """Elevation grid with its north-west corner at (north, west) and cells of yres x xres degrees
+
+    `grid` is a (rows, cols) array, or for tiled GeoTIFFs a
+    (tile rows, tile cols, tile height, tile width) array.
+    """
+
+    def __init__(self, path, grid, width, height, west, north, xres, yres, nodata=None):
+        self.path = path
+        self.grid = grid
+        self.width = width
+        self.height = height
+        self.west = west
+        self.north = north
+        self.xres = xres
+        self.yres = yres
+        self.nodata = nodata
+
+    def elevations(self, lats, lngs):
+        """Heights in metres for arrays of points; NaN outside the raster or on nodata cells"""
+        import numpy as np
+
+        start = time.perf_counter()
+        lats = np.asarray(lats, dtype=np.float64)
+        lngs = np.asarray(lngs, dtype=np.float64)
+        rows = np.floor((self.north - lats) / self.yres).astype(np.int64)
+        cols = np.floor((lngs - self.west) / self.xres).astype(np.int64)
+        inside = (rows >= 0) & (rows < self.height) & (cols >= 0) & (cols < self.width)
+        rows, cols = np.where(inside, rows, 0), np.where(inside, cols, 0)
+        if self.grid.ndim == 2:
+            values = self.grid[rows, cols]
+        else:
+            tile_h, tile_w = self.grid.shape[2:]
+            values = self.grid[rows // tile_h, cols // tile_w, rows % tile_h, cols % tile_w]
+        heights = values.astype(np.float64)
+        if self.nodata is not None:
+            inside &= values != self.nodata
+        heights[~inside] = np.nan
+        with _lock:
+            _stats["lookups"] += 1
+            _stats["points"] += heights.size
+            _stats["seconds_sum"] += time.perf_counter() - start
+        return heights
+
+    def elevation(self, lat, lng):
+        height = float(self.elevations([lat], [lng])[0])
+        return None if height != height else height
+
+    def info(self):
+        return {"path": self.path, "width": self.width, "height": self.height,
+                "cell_deg": [self.xres, self.yres], "tiled": self.grid.ndim == 4}
+
+
+# -- raw ESRI grids ------------------------------------------------------------
+
+_HDR_DTYPES = {(32, "FLOAT"): "f4", (32, "SIGNEDINT"): "i4", (16, "SIGNEDINT"): "i2",
+               (16, "UNSIGNEDINT"): "u2", (8, "SIGNEDINT"): "i1", (8, "UNSIGNEDINT"): "u1"}
+
+
+def open_raw_grid(path):
+    """DEM from a .flt/.bil grid described by an ESRI .hdr (ncols, nrows, corner, cellsize)"""
+    import numpy as np
+
+    header = {}
+    with open(os.path.splitext(path)[0] + ".hdr") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2:
+                header[parts[0].lower()] = parts[1]
+    width, height = int(header["ncols"]), int(header["nrows"])
+    cell = float(header.get("cellsize") or header["xdim"])
+    yres = float(header.get("ydim", cell))
+    if "ulxmap" in header:
+        # BIL headers give the centre of the upper-left cell
+        west = float(header["ulxmap"]) - cell / 2
+        north = float(header["ulymap"]) + yres / 2
+    else:
+        west = float(header.get("xllcorner") or float(header["xllcenter"]) - cell / 2)
+        south = float(header.get("yllcorner") or float(header["yllcenter"]) - yres / 2)
+        north = south + height * yres
+    if path.lower().endswith(".flt"):
+        bits, pixel_type = 32, "FLOAT"
+    else:
+        bits, pixel_type = int(header.get("nbits", 16)), header.get("pixeltype", "SIGNEDINT").upper()
+    byteorder = header.get("byteorder", "LSBFIRST").upper()
+    dtype = np.dtype(("<" if byteorder in ("LSBFIRST", "I") else ">") + _HDR_DTYPES[(bits, pixel_type)])
+    nodata = header.get("nodata_value", header.get("nodata"))
+    grid = np.memmap(path, dtype=dtype, mode="r", shape=(height, width))
+    return DEM(path, grid, width, height, west, north, cell, yres,
+               float(nodata) if nodata is not None else None)
+
+
+# -- GeoTIFF -------------------------------------------------------------------
+
+_TIFF_TYPES = {1: "B", 2: "s", 3: "H", 4: "I", 11: "f", 12: "d", 16: "Q"}
+_SAMPLE_FORMATS = {1: "u", 2: "i", 3: "f"}
+
+
+def _read_ifd(f, order):
+    """Tags of the first image directory as {tag: tuple of values (or str for ASCII)}"""
+    f.seek(0)
+    header = f.read(8)
+    if struct.unpack(order + "H", header[2:4])[0] != 42:
+        raise ValueError("not a classic TIFF (BigTIFF is not supported)")
+    f.seek(struct.unpack(order + "I", header[4:8])[0])
+    tags = {}
+    for _ in range(struct.unpack(order + "H", f.read(2))[0]):
+        tag, kind, count, raw = struct.unpack(order + "HHI4s", f.read(12))
+        if kind not in _TIFF_TYPES:
+            continue
+        code = _TIFF_TYPES[kind]
+        size = struct.calcsize(code) * count
+        if size > 4:
+            here = f.tell()
+            f.seek(struct.unpack(order + "I", raw)[0])
+            raw = f.read(size)
+            f.seek(here)
+        if code == "s":
+            tags[tag] = raw[:count].rstrip(b"\0").decode("ascii", "replace")
+        else:
+            tags[tag] = struct.unpack(f"{order}{count}{code}", raw[:size])
+    return tags
+
+
+def _contiguous(offsets, counts):
+    return all(offsets[i] + counts[i] == offsets[i + 1] for i in range(len(offsets) - 1))
+
+
+def open_geotiff(path):
+    """DEM from an uncompressed, single-band GeoTIFF whose strips or tiles are stored in order"""
+    import numpy as np
+
+    with open(path, "rb") as f:
+        order = {b"II": "<", b"MM": ">"}.get(f.read(2))
+        if order is None:
+            raise ValueError("not a TIFF file")
+        tags = _read_ifd(f, order)
+    if tags.get(259, (1,))[0] != 1:
+        raise ValueError("compressed GeoTIFF; convert with gdal_translate -co COMPRESS=NONE")
+    if tags.get(277, (1,))[0] != 1:
+        raise ValueError("DEM must have a single band")
+    if 33550 not in tags or 33922 not in tags:
+        raise ValueError("missing GeoTIFF pixel scale or tiepoint")
+    width, height = tags[256][0], tags[257][0]
+    dtype = np.dtype(order + _SAMPLE_FORMATS[tags.get(339, (1,))[0]] + str(tags[258][0] // 8))
+    xres, yres = tags[33550][0], tags[33550][1]
+    i, j, _, x, y, _ = tags[33922][:6]
+    west, north = x - i * xres, y + j * yres
+    nodata = float(tags[42113]) if tags.get(42113) else None
+
+    if 322 in tags:
+        tile_w, tile_h = tags[322][0], tags[323][0]
+        offsets, counts = tags[324], tags[325]
+        if not _contiguous(offsets, counts):
+            raise ValueError("GeoTIFF tiles are not stored in order")
+        across, down = -(-width // tile_w), -(-height // tile_h)
+        grid = np.memmap(path, dtype=dtype, mode="r", offset=offsets[0],
+                         shape=(down, across, tile_h, tile_w))
+    else:
+        offsets, counts = tags[273], tags[279]
+        if not _contiguous(offsets, counts):
+            raise ValueError("GeoTIFF strips are not stored in order")
+        grid = np.memmap(path, dtype=dtype, mode="r", offset=offsets[0], shape=(height, width))
+    return DEM(path, grid, width, height, west, north, xres, yres, nodata)
+
+
+def open_dem(path):
+    if path.lower().endswith((".tif", ".tiff")):
+        return open_geotiff(path)
+    return open_raw_grid(path)
+
+
+@lazy_resource("dem")
+def get_dem():
+    """The configured DEM, or None when ELEVATION_DEM_FILE is unset or unreadable"""
+    if not ELEVATION_DEM_FILE:
+        return None
+    try:
+        dem = open_dem(ELEVATION_DEM_FILE)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Error opening DEM {ELEVATION_DEM_FILE}: {e}")
+        return None
+    print(f"DEM {dem.path} mapped: {dem.width}x{dem.height} cells")
+    return dem
+
+
+def rank_by_height(dem, facilities, origin, samples=None):
+    """Facilities ordered for flood evacuation, highest safe ground first
+
+    Each candidate is scored by the lowest ground on the straight route from
+    `origin` (lat, lng) to it, sampled at `samples` vertices, so a shelter on
+    a hill behind a flooded valley ranks below one reached along a ridge;
+    ties go to the higher destination. Returns a FacilitySubset without the
+    facilities that fall off the raster.
+    """
+    import numpy as np
+
+    samples = max(samples or ELEVATION_ROUTE_SAMPLES, 2)
+    base = facilities.base
+    indices = facilities.indices
+    indices = (np.arange(indices.start, indices.stop) if isinstance(indices, range)
+               else np.frombuffer(indices, dtype=np.uint32))
+    if not len(indices):
+        return FacilitySubset(base, array("I"))
+    # Read the coordinate columns in place
+    lats = np.frombuffer(base.lats, dtype=np.float64)[indices]
+    lngs = np.frombuffer(base.lngs, dtype=np.float64)[indices]
+    steps = np.linspace(0.0, 1.0, samples)
+    # (facilities, samples) vertices from the origin to each candidate, looked up in one batch
+    vertex_lats = origin[0] + (lats[:, None] - origin[0]) * steps
+    vertex_lngs = origin[1] + (lngs[:, None] - origin[1]) * steps
+    heights = dem.elevations(vertex_lats.ravel(), vertex_lngs.ravel()).reshape(len(indices), samples)
+    # The origin itself is the flooded spot, so it does not count towards the floor
+    floors = np.where(np.isnan(heights), -np.inf, heights)[:, 1:].min(axis=1)
+    tops = heights[:, -1]
+    on_raster = ~np.isnan(tops)
+    order = np.lexsort((-tops[on_raster], -floors[on_raster]))
+    return FacilitySubset(base, array("I", indices[on_raster][order].tolist()))
+
+
+def elevation_stats():
+    dem = get_dem() if get_dem.loaded() else None
+    with _lock:
+        return dict(_stats, dem=dem.info() if dem else None)
@@ -0,0 +1,327 @@
+# extraction.py
+"""Schema-constrained incident extraction from LLM answers
+
+The extraction prompt carries INCIDENT_SCHEMA and the call is made in the
+provider's JSON mode, so the answer should be one JSON object. It is
+streamed through StreamingObjectParser, which reports each top-level member
+as soon as its value is complete; the disaster app starts geocoding the
+moment "location" closes, while the rest of the answer is still arriving.
+
+The full answer is then checked against the schema. Malformed JSON gets one
+local repair pass (code fences, surrounding prose, trailing commas, an
+unterminated object). Anything still invalid is sent back to the model once
+with the errors (model_router's repair retry). Outcomes are counted, so
+extraction_stats() shows how often the first answer was already usable.
+"""
+import json
+import os
+import re
+import threading
+
+# Ask for the provider's JSON mode (response_format json_object)
+EXTRACTION_JSON_MODE = os.getenv("EXTRACTION_JSON_MODE", "1") == "1"
+# Stream the answer so fields are acted on before it is complete
+EXTRACTION_STREAM = os.getenv("EXTRACTION_STREAM", "1") == "1"
+
+INCIDENT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "disaster_type": {"type": "string", "minLength": 1,
+                          "description": "earthquake, flood, fire, hurricane, tornado, tsunami, ... or unknown"},
+        "location": {"type": "string", "minLength": 1,
+                     "description": "city, neighbourhood or region, or \"unknown location\""},
+        "severity": {"type": "object", "additionalProperties": {"type": ["string", "number"]},
+                     "description": "e.g. {\"magnitude\": 7.1} or {\"category\": 4}; {} if not given"},
+        "details": {"type": "string", "description": "other critical details, \"\" if none"},
+    },
+    "required": ["disaster_type", "location", "severity", "details"],
+}
+
+EXTRACTION_PROMPT = """You are an AI specialized in disaster response. Extract the disaster type, location, severity and any other critical details from the user input.
+Format the response as JSON: a single object matching this JSON schema, with no other text.
+""" + json.dumps(INCIDENT_SCHEMA)
+
+_TYPES = {"string": str, "number": (int, float), "object": dict, "array": list, "boolean": bool}
+
+_lock = threading.Lock()
+_stats = {"first_pass": 0, "local_repair": 0, "model_repair": 0, "invalid": 0, "error": 0}
+
+
+def request_options():
+    return {"response_format": {"type": "json_object"}} if EXTRACTION_JSON_MODE else {}
+
+
+def extraction_messages(user_input):
+    return [{"role": "system", "content": EXTRACTION_PROMPT}, {"role": "user", "content": user_input}]
+
+
+def schema_errors(value, schema, path="$"):
+    """Violations of the JSON Schema subset used here (type, required, properties, minLength)"""
+    types = schema.get("type")
+    if types is not None:
+        allowed = tuple(_TYPES[name] for name in ([types] if isinstance(types, str) else types))
+        # bool is an int subclass but not a JSON number
+        if not isinstance(value, allowed) or (isinstance(value, bool) and bool not in allowed):
+            return [f"{path} must be {' or '.join([types] if isinstance(types, str) else types)}"]
+    errors = []
+    if isinstance(value, str) and len(value.strip()) < schema.get("minLength", 0):
+        errors.append(f"{path} must not be empty")
+    if isinstance(value, dict):
+        errors += [f"{path}.{name} is required" for name in schema.get("required", ()) if name not in value]
+        properties = schema.get("properties", {})
+        for name, item in value.items():
+            item_schema = properties.get(name, schema.get("additionalProperties"))
+            if isinstance(item_schema, dict):
+                errors += schema_errors(item, item_schema, f"{path}.{name}")
+    return errors
+
+
+def normalize(data):
+    """Coerce harmless variations (case, a bare severity, missing optional fields) before validation"""
+    if isinstance(data.get("disaster_type"), str):
+        data["disaster_type"] = data["disaster_type"].strip().lower()
+    if isinstance(data.get("location"), str):
+        data["location"] = data["location"].strip()
+    severity = data.get("severity")
+    if severity in (None, ""):
+        data["severity"] = {}
+    elif isinstance(severity, (str, int, float)) and not isinstance(severity, bool):
+        data["severity"] = {"level": severity}
+    details = data.get("details")
+    if details is None:
+        data["details"] = ""
+    elif isinstance(details, list):
+        data["details"] = "; ".join(str(item) for item in details)
+    return data
+
+
+def repair_json(text):
+    """One cheap pass at turning a near-JSON answer into JSON; the result may still be invalid"""
+    match = re.search(r"```(?:json)?\s*(.*?)(?:```|$)", text, re.DOTALL)
+    if match:
+        text = match.group(1)
+    start = text.find("{")
+    if start < 0:
+        return text
+    # Copy the object, dropping trailing commas, up to its closing brace; a
+    # truncated one gets its open string and containers closed
+    out, stack, in_string, escaped = [], [], False, False
+    for c in text[start:]:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c in "{[":
+            stack.append("}" if c == "{" else "]")
+        elif c in "}]":
+            _drop_trailing_comma(out)
+            if not stack:
+                break
+            stack.pop()
+            out.append(c)
+            if not stack:
+                break
+            continue
+        out.append(c)
+    if in_string:
+        out.append('"')
+    for closer in reversed(stack):
+        _drop_trailing_comma(out)
+        out.append(closer)
+    return "".join(out)
+
+
+def _drop_trailing_comma(out):
+    while out and out[-1].isspace():
+        out.pop()
+    if out and out[-1] == ",":
+        out.pop()
+
+
+class Validation:
+    """validate() for model_router.complete that remembers how the accepted answer was obtained"""
+
+    def __init__(self, schema=INCIDENT_SCHEMA):
+        self.schema = schema
+        self.attempts = 0
+        self.repaired = False
+
+    def __call__(self, content):
+        self.attempts += 1
+        self.repaired = False
+        try:
+            data = json.loads(content or "")
+        except ValueError:
+            data = json.loads(repair_json(content or ""))
+            self.repaired = True
+        if not isinstance(data, dict):
+            raise ValueError("the answer must be a JSON object")
+        errors = schema_errors(normalize(data), self.schema)
+        if errors:
+            raise ValueError("; ".join(errors))
+        return data
+
+    def outcome(self):
+        if self.attempts > 1:
+            return "model_repair"
+        return "local_repair" if self.repaired else "first_pass"
+
+
+def repair_messages(messages, content, error):
+    """The conversation for the one repair retry: the rejected answer and what was wrong with it"""
+    return list(messages) + [
+        {"role": "assistant", "content": content or ""},
+        {"role": "user", "content": f"That answer was not valid: {error}. "
+                                    "Reply with only the corrected JSON object."},
+    ]
+
+
+class _Message:
+    __slots__ = ("content",)
+
+    def __init__(self, content):
+        self.content = content
+
+
+class _Choice:
+    __slots__ = ("message",)
+
+    def __init__(self, content):
+        self.message = _Message(content)
+
+
+class StreamedCompletion:
+    """A streamed answer put back together: choices[0].message.content and usage"""
+    __slots__ = ("choices", "usage")
+
+    def __init__(self, content, usage=None):
+        self.choices = [_Choice(content)]
+        self.usage = usage
+
+
+def chunk_usage(chunk):
+    """Token usage, which Groq sends on the final streamed chunk"""
+    usage = getattr(chunk, "usage", None)
+    if usage is None:
+        usage = getattr(getattr(chunk, "x_groq", None), "usage", None)
+    return usage
+
+
+def record(outcome):
+    """Count one extraction: first_pass, local_repair, model_repair, invalid or error"""
+    with _lock:
+        _stats[outcome] += 1
+
+
+def extraction_stats():
+    with _lock:
+        stats = dict(_stats)
+    answered = sum(stats.values()) - stats["error"]
+    stats["first_pass_rate"] = round(stats["first_pass"] / answered, 4) if answered else None
+    return stats
+
+
+class StreamingObjectParser:
+    """Incremental parser reporting the top-level members of a streamed JSON object
+
+    feed() takes the answer in pieces; `callbacks[name](value)` runs once
+    when member `name` is complete. Text before the opening brace is
+    skipped, and members deeper than the top level are only delimited, not
+    parsed, until their top-level member closes.
+    """
+
+    def __init__(self, callbacks=None):
+        self.callbacks = callbacks or {}
+        self.reset()
+
+    def reset(self):
+        self.fields = {}
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._expect = "object"  # object, key, colon, value, in_value, comma, done
+        self._key = None
+        self._scalar = False
+        # Pieces of the key or value being read; only these are kept, not the whole answer
+        self._parts = None
+        self._from = None  # where the current piece starts in the chunk being scanned
+
+    def _begin(self, i):
+        self._parts, self._from = [], i
+
+    def _end(self, chunk, i):
+        """The captured text up to (not including) chunk[i]"""
+        self._parts.append(chunk[self._from:i])
+        raw = "".join(self._parts)
+        self._parts = self._from = None
+        return raw
+
+    def _emit(self, raw):
+        try:
+            value = json.loads(raw)
+        except ValueError:
+            return
+        self.fields[self._key] = value
+        callback = self.callbacks.get(self._key)
+        if callback is not None:
+            callback(value)
+
+    def feed(self, chunk):
+        if self._parts is not None:
+            self._from = 0
+        for i, c in enumerate(chunk):
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif c == "\\":
+                    self._escaped = True
+                elif c == '"':
+                    self._in_string = False
+                    if self._depth == 1 and self._expect == "key":
+                        self._key = json.loads(self._end(chunk, i + 1))
+                        self._expect = "colon"
+                    elif self._depth == 1 and self._expect == "in_value":
+                        self._emit(self._end(chunk, i + 1))
+                        self._expect = "comma"
+                continue
+            if self._expect in ("object", "done"):
+                if c == "{" and self._expect == "object":
+                    self._depth, self._expect = 1, "key"
+                continue
+            if self._depth == 1 and self._expect == "in_value" and self._scalar and c in ",}":
+                self._emit(self._end(chunk, i).strip())
+                self._expect = "comma"
+            if c == '"':
+                self._in_string = True
+                if self._depth == 1 and self._expect == "key":
+                    self._begin(i)
+                elif self._depth == 1 and self._expect == "value":
+                    self._begin(i)
+                    self._expect, self._scalar = "in_value", False
+            elif c in "{[":
+                if self._depth == 1 and self._expect == "value":
+                    self._begin(i)
+                    self._expect, self._scalar = "in_value", False
+                self._depth += 1
+            elif c in "}]":
+                self._depth -= 1
+                if self._depth == 1 and self._expect == "in_value":
+                    self._emit(self._end(chunk, i + 1))
+                    self._expect = "comma"
+                elif self._depth == 0:
+                    self._expect = "done"
+            elif self._depth == 1:
+                if c == ":" and self._expect == "colon":
+                    self._expect = "value"
+                elif c == "," and self._expect == "comma":
+                    self._expect = "key"
+                elif self._expect == "value" and not c.isspace():
+                    self._begin(i)
+                    self._expect, self._scalar = "in_value", True
+        if self._parts is not None:
+            self._parts.append(chunk[self._from:])
@@ -0,0 +1,82 @@
+# facility_index.py
+"""Per-incident facility storage with a grid index for bounding-box queries"""
+import math
+import threading
+from collections import OrderedDict
+
+from models import FACILITY_TYPES, type_code
+
+
+class FacilityIndex:
+    """Uniform lat/lng grid over a FacilitySet so viewport queries skip distant cells"""
+
+    def __init__(self, facilities, cell_deg=0.01):
+        self.facilities = facilities
+        self.cell_deg = cell_deg
+        # Incident summary drawn by the prebuilt map shell (center, routes, ...)
+        self.map_data = None
+        self.cells = {}
+        for i, (lat, lng) in enumerate(zip(facilities.lats, facilities.lngs)):
+            self.cells.setdefault(self._cell(lat, lng), []).append(i)
+
+    def _cell(self, lat, lng):
+        return (math.floor(lat / self.cell_deg), math.floor(lng / self.cell_deg))
+
+    def query(self, south, west, north, east, limit=None):
+        """Indices of facilities inside the bbox, at most `limit` of them"""
+        (row0, col0), (row1, col1) = self._cell(south, west), self._cell(north, east)
+        cell_count = (row1 - row0 + 1) * (col1 - col0 + 1)
+        if cell_count > len(self.cells):
+            # Viewport spans more cells than are occupied; walk the occupied ones instead
+            candidates = (i for members in self.cells.values() for i in members)
+        else:
+            candidates = (i for row in range(row0, row1 + 1) for col in range(col0, col1 + 1)
+                          for i in self.cells.get((row, col), ()))
+        lats, lngs = self.facilities.lats, self.facilities.lngs
+        result = []
+        for i in candidates:
+            if south <= lats[i] <= north and west <= lngs[i] <= east:
+                result.append(i)
+                if limit is not None and len(result) >= limit:
+                    break
+        return result
+
+
+def encode_facilities(facilities, indices):
+    """Compact array payload: one [id, lat, lng, type_code, name] row per facility"""
+    rows = []
+    for i in indices:
+        rows.append([i, round(facilities.lats[i], 6), round(facilities.lngs[i], 6),
+                     type_code(facilities.types[facilities.type_codes[i]]), facilities.names[i]])
+    return {"types": FACILITY_TYPES + ["other"], "facilities": rows}
+
+
+class IncidentFacilityStore:
+    """Bounded map of incident id -> FacilityIndex, evicting the least recently used"""
+
+    def __init__(self, max_incidents=256):
+        self.max_incidents = max_incidents
+        self._lock = threading.Lock()
+        self._indexes = OrderedDict()
+
+    def put(self, incident_id, facilities):
+        index = FacilityIndex(facilities)
+        with self._lock:
+            self._indexes[incident_id] = index
+            self._indexes.move_to_end(incident_id)
+            while len(self._indexes) > self.max_incidents:
+                self._indexes.popitem(last=False)
+        return index
+
+    def set_map_data(self, incident_id, map_data):
+        index = self.get(incident_id)
+        if index is not None:
+            index.map_data = map_data
+        return index is not None
+
+    def get(self, incident_id):
+        with self._lock:
+            index = self._indexes.get(incident_id)
+            if index is not None:
+                self._indexes.move_to_end(incident_id)
+            return index
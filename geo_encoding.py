@@ -0,0 +1,134 @@
+# geo_encoding.py
+"""Compact encodings for routes and facility collections
+
+Two coordinate codecs are provided:
+- Encoded Polyline (Google's algorithm): printable ASCII, safe inside JSON.
+- Delta + zigzag varint: raw bytes, the smallest form for binary transports.
+
+Clients opt in to the compact JSON form with `?format=compact` or
+`Accept: application/vnd.disaster.compact+json`; everyone else keeps the
+plain JSON payloads.
+"""
+from models import FACILITY_TYPES, type_code
+
+COMPACT_MIME = "application/vnd.disaster.compact+json"
+
+
+def wants_compact(request):
+    """True if the client negotiated the compact payload format"""
+    if request.args.get("format") == "compact":
+        return True
+    return COMPACT_MIME in request.headers.get("Accept", "")
+
+
+def encode_polyline(coordinates, precision=5):
+    """Encode [[lat, lng], ...] with the Encoded Polyline Algorithm"""
+    factor = 10 ** precision
+    chunks = []
+    prev_lat = prev_lng = 0
+    for lat, lng in coordinates:
+        ilat, ilng = int(round(lat * factor)), int(round(lng * factor))
+        for delta in (ilat - prev_lat, ilng - prev_lng):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            chunks.append(chr(value + 63))
+        prev_lat, prev_lng = ilat, ilng
+    return "".join(chunks)
+
+
+def decode_polyline(encoded, precision=5):
+    """Decode an Encoded Polyline string back to [[lat, lng], ...]"""
+    factor = 10 ** precision
+    coordinates = []
+    index = lat = lng = 0
+    length = len(encoded)
+    while index < length:
+        deltas = []
+        for _ in range(2):
+            shift = result = 0
+            while True:
+                byte = ord(encoded[index]) - 63
+                index += 1
+                result |= (byte & 0x1f) << shift
+                shift += 5
+                if byte < 0x20:
+                    break
+            deltas.append(~(result >> 1) if result & 1 else result >> 1)
+        lat += deltas[0]
+        lng += deltas[1]
+        coordinates.append([lat / factor, lng / factor])
+    return coordinates
+
+
+def encode_varint_coords(coordinates, precision=6):
+    """Encode [[lat, lng], ...] as zigzag varint deltas"""
+    factor = 10 ** precision
+    out = bytearray()
+    prev_lat = prev_lng = 0
+    for lat, lng in coordinates:
+        ilat, ilng = int(round(lat * factor)), int(round(lng * factor))
+        for delta in (ilat - prev_lat, ilng - prev_lng):
+            value = (delta << 1) ^ (delta >> 63)
+            while value >= 0x80:
+                out.append((value & 0x7f) | 0x80)
+                value >>= 7
+            out.append(value)
+        prev_lat, prev_lng = ilat, ilng
+    return bytes(out)
+
+
+def decode_varint_coords(data, precision=6):
+    """Decode zigzag varint deltas back to [[lat, lng], ...]"""
+    factor = 10 ** precision
+    coordinates = []
+    values = []
+    value = shift = 0
+    for byte in data:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        values.append((value >> 1) ^ -(value & 1))
+        value = shift = 0
+    lat = lng = 0
+    for i in range(0, len(values) - 1, 2):
+        lat += values[i]
+        lng += values[i + 1]
+        coordinates.append([lat / factor, lng / factor])
+    return coordinates
+
+
+def encode_routes_compact(routes):
+    """Routes with polyline-encoded geometry instead of coordinate pair lists"""
+    return [
+        {"name": route["name"], "color": route["color"], "polyline": encode_polyline(route["coordinates"])}
+        for route in routes
+    ]
+
+
+def encode_facilities_compact(facilities, indices):
+    """Columnar payload for `indices` of a FacilitySet: ids, one polyline for all points,
+    type codes and names
+
+    Type colors are not sent; clients map type codes to colors themselves.
+    """
+    return {
+        "format": "compact",
+        "types": FACILITY_TYPES + ["other"],
+        "ids": list(indices),
+        "points": encode_polyline([(facilities.lats[i], facilities.lngs[i]) for i in indices]),
+        "type_codes": [type_code(facilities.types[facilities.type_codes[i]]) for i in indices],
+        "names": [facilities.names[i] for i in indices],
+    }
+
+
+def decode_facilities_compact(payload):
+    """Inverse of encode_facilities_compact, as dicts like the pipeline's facilities"""
+    points = decode_polyline(payload["points"])
+    return [
+        {"id": facility_id, "lat": lat, "lng": lng, "type": payload["types"][code], "name": name}
+        for facility_id, (lat, lng), code, name
+        in zip(payload["ids"], points, payload["type_codes"], payload["names"])
+    ]
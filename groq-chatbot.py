@@ -1,8 +1,13 @@
 import os
+import argparse
+import asyncio
 from dotenv import load_dotenv
 import groq
 import time
 import json
+from conversation_log import ConversationLog
+from extraction import chunk_usage
+import model_router
 
 # Load environment variables
 load_dotenv()
@@ -10,11 +15,21 @@ load_dotenv()
 # Initialize the Groq client
 client = groq.Groq(api_key=os.getenv("GROQ_API_KEY"))
 
+# Append-only conversation log shared by every session; see conversation_log.py
+DEFAULT_LOG = "conversation_history.jsonl"
+
+def chunk_text(chunk):
+    """Text carried by one streamed completion chunk, or None"""
+    return chunk.choices[0].delta.content if chunk.choices else None
+
 class ChatBot:
-    def __init__(self, model="llama3-70b-8192"):
-        """Initialize the chatbot with a specific model"""
+    def __init__(self, model=None, session="default"):
+        """Initialize the chatbot; without a model each turn is routed to a model tier"""
         self.model = model
+        self.session = session
         self.conversation_history = []
+        self._logs = {}  # filename -> open ConversationLog
+        self._saved = {}  # filename -> turns of this conversation already in that log
         self.system_prompt = """You are a expert in disaster response. You are handling multiple agents in the disaster response.
                                 1: Prioritizing human lives: Always prioritize the safety and well-being of people affected by the disaster.
                                 2: Provide immediate aid and rescue to the affected areas.
@@ -33,49 +48,150 @@ class ChatBot:
         messages.extend(self.conversation_history)
         return messages
         
-    def generate_response(self, user_input):
-        """Generate a response based on the conversation history and user input"""
+    def _route(self):
+        """(kind, tier) for the pending user turn, or (None, None) when the model is pinned"""
+        if self.model:
+            return None, None
+        kind = model_router.classify_chat(self.conversation_history[-1]["content"],
+                                          self.conversation_history[:-1])
+        return kind, model_router.select(kind)
+    
+    def _request(self, stream, tier=None):
+        """Keyword arguments for a chat completion over the current history"""
+        params = tier.params() if tier else {"model": self.model, "temperature": 0.7, "max_tokens": 1024}
+        return dict(params, messages=self.format_messages(), top_p=1, stream=stream)
+    
+    def _result(self, response, tokens_used, start_time, stream, first_token_time=None, model=None):
+        """Record the assistant turn and build the metrics dict"""
+        self.add_message("assistant", response)
+        result = {
+            "response": response,
+            "tokens_used": tokens_used,
+            "response_time": time.time() - start_time,
+            "model": model or self.model
+        }
+        if stream:
+            result["time_to_first_token"] = (first_token_time - start_time) if first_token_time else None
+        return result
+    
+    def _error_result(self, error, stream):
+        print(f"Error generating response: {error}")
+        result = {
+            "response": "I'm sorry, I encountered an error. Please try again.",
+            "tokens_used": 0,
+            "response_time": 0,
+            "error": str(error)
+        }
+        if stream:
+            result["time_to_first_token"] = None
+        return result
+    
+    def generate_response(self, user_input, stream=False, on_token=None):
+        """Generate a response based on the conversation history and user input
+
+        With `stream`, `on_token` is called with each piece of text as it
+        arrives and the result also reports time_to_first_token.
+        """
         # Add user message to history
         self.add_message("user", user_input)
         
+        kind, tier = self._route()
+        
         # Call the Groq API
         try:
             start_time = time.time()
             
-            completion = client.chat.completions.create(
-                model=self.model,
-                messages=self.format_messages(),
-                temperature=0.7,
-                max_tokens=1024,
-                top_p=1,
-                stream=False
-            )
-            
-            end_time = time.time()
-            
-            # Extract the response
-            response = completion.choices[0].message.content
-            
-            # Add assistant response to history
-            self.add_message("assistant", response)
+            if not stream:
+                if tier:
+                    # Routed calls fall back to the big model on an error or empty answer
+                    completion, content, tier = model_router.complete(
+                        client.chat.completions.create, kind, self.format_messages(), top_p=1, stream=False)
+                else:
+                    completion = client.chat.completions.create(**self._request(False))
+                    content = completion.choices[0].message.content
+                # Extract the response
+                return self._result(content, completion.usage.total_tokens, start_time, False,
+                                    model=tier and tier.model)
             
-            # Calculate metrics
-            tokens_used = completion.usage.total_tokens
-            response_time = end_time - start_time
-            
-            return {
-                "response": response,
-                "tokens_used": tokens_used,
-                "response_time": response_time
-            }
+            while True:
+                attempt_start = time.time()
+                parts, usage, first_token_time, error = [], None, None, None
+                try:
+                    for chunk in client.chat.completions.create(**self._request(True, tier)):
+                        text = chunk_text(chunk)
+                        if text:
+                            first_token_time = first_token_time or time.time()
+                            parts.append(text)
+                            if on_token:
+                                on_token(text)
+                        usage = chunk_usage(chunk) or usage
+                except Exception as e:
+                    if not tier:
+                        raise
+                    error = e
+                content = "".join(parts)
+                if tier:
+                    # Text already passed to on_token cannot be taken back, so only a silent failure falls back
+                    fallback = self._settle(kind, tier, attempt_start, content, usage, error, retry=not parts)
+                    if fallback:
+                        tier = fallback
+                        continue
+                return self._result(content, usage.total_tokens if usage else 0,
+                                    start_time, True, first_token_time, tier and tier.model)
             
         except Exception as e:
-            print(f"Error generating response: {e}")
-            return {
-                "response": "I'm sorry, I encountered an error. Please try again.",
-                "tokens_used": 0,
-                "response_time": 0
-            }
+            return self._error_result(e, stream)
+    
+    async def generate_response_async(self, async_client, user_input, stream=False):
+        """generate_response over a groq.AsyncGroq client, for concurrent batch runs"""
+        self.add_message("user", user_input)
+        kind, tier = self._route()
+        try:
+            start_time = time.time()
+            while True:
+                attempt_start = time.time()
+                parts, usage, first_token_time, error = [], None, None, None
+                try:
+                    if not stream:
+                        completion = await async_client.chat.completions.create(**self._request(False, tier))
+                        parts, usage = [completion.choices[0].message.content or ""], completion.usage
+                    else:
+                        async for chunk in await async_client.chat.completions.create(**self._request(True, tier)):
+                            text = chunk_text(chunk)
+                            if text:
+                                first_token_time = first_token_time or time.time()
+                                parts.append(text)
+                            usage = chunk_usage(chunk) or usage
+                except Exception as e:
+                    if not tier:
+                        raise
+                    error = e
+                content = "".join(parts)
+                if tier:
+                    fallback = self._settle(kind, tier, attempt_start, content, usage, error)
+                    if fallback:
+                        tier = fallback
+                        continue
+                return self._result(content, usage.total_tokens if usage else 0,
+                                    start_time, stream, first_token_time, tier and tier.model)
+        except Exception as e:
+            return self._error_result(e, stream)
+    
+    def _settle(self, kind, tier, attempt_start, content, usage, error, retry=True):
+        """Record a routed attempt; returns the tier to retry on after an error or empty answer, else None
+
+        A failure that cannot fall back is raised, as model_router.complete
+        does for the non-stream path.
+        """
+        elapsed = time.time() - attempt_start
+        if error is None and content.strip():
+            model_router.record(tier, kind, elapsed, usage)
+            return None
+        fallback = model_router.fall_back(tier, kind, elapsed, error or "empty completion",
+                                          "error" if error else "invalid", usage, retry=retry)
+        if fallback is None:
+            raise error or ValueError("empty completion")
+        return fallback
     
     def display_conversation(self):
         """Display the entire conversation history"""
@@ -86,30 +202,108 @@ class ChatBot:
             print(f"{prefix}{content}")
             print("-" * 50)
     
-    def save_conversation(self, filename="conversation_history.json"):
-        """Save the conversation history to a file"""
-        with open(filename, "w") as f:
-            json.dump(self.conversation_history, f, indent=2)
+    def _log(self, filename):
+        if filename not in self._logs:
+            self._logs[filename] = ConversationLog(filename)
+        return self._logs[filename]
+    
+    def save_conversation(self, filename=DEFAULT_LOG):
+        """Append the turns not yet saved to the conversation log
+
+        A .json filename keeps the old format: the whole history rewritten as one JSON array.
+        """
+        if filename.endswith(".json"):
+            with open(filename, "w") as f:
+                json.dump(self.conversation_history, f, indent=2)
+        else:
+            saved = self._saved.get(filename, 0)
+            self._log(filename).extend(self.session, self.conversation_history[saved:])
+            self._saved[filename] = len(self.conversation_history)
         print(f"Conversation saved to {filename}")
     
-    def load_conversation(self, filename="conversation_history.json"):
-        """Load a conversation history from a file"""
-        try:
+    def load_conversation(self, filename=DEFAULT_LOG, session=None, last=None):
+        """Load a session (the current one by default) from a conversation log
+
+        `last` limits loading to that many most recent turns.
+        """
+        if not os.path.exists(filename):
+            print(f"File {filename} not found. Starting with an empty conversation.")
+            return
+        if filename.endswith(".json"):
             with open(filename, "r") as f:
                 self.conversation_history = json.load(f)
-            print(f"Conversation loaded from {filename}")
-        except FileNotFoundError:
-            print(f"File {filename} not found. Starting with an empty conversation.")
+        else:
+            self.session = session or self.session
+            self.conversation_history = self._log(filename).tail(self.session, last)
+            self._saved = {filename: len(self.conversation_history)}
+        print(f"Conversation loaded from {filename}")
+
+
+def load_prompts(filename):
+    """Prompts from a file: one per line, or JSON Lines objects with a "prompt" field"""
+    prompts = []
+    with open(filename, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            prompts.append(json.loads(line)["prompt"] if line.startswith("{") else line)
+    return prompts
+
+
+async def run_batch(prompts, parallelism=4, model=None, stream=False):
+    """Run each prompt as its own conversation, at most `parallelism` at a time"""
+    async_client = groq.AsyncGroq(api_key=os.getenv("GROQ_API_KEY"))
+    semaphore = asyncio.Semaphore(parallelism)
+    
+    async def run_one(index, prompt):
+        async with semaphore:
+            result = await ChatBot(model).generate_response_async(async_client, prompt, stream)
+        print(f"[{index + 1}/{len(prompts)}] {result['response_time']:.2f}s, {result['tokens_used']} tokens, {result.get('model')}")
+        return dict(result, index=index, prompt=prompt)
+    
+    try:
+        return await asyncio.gather(*(run_one(i, prompt) for i, prompt in enumerate(prompts)))
+    finally:
+        await async_client.close()
+
+
+def batch_main(args):
+    """Run a prompt file concurrently and write one JSON result per line"""
+    prompts = load_prompts(args.batch)
+    start_time = time.time()
+    results = asyncio.run(run_batch(prompts, args.parallel, args.model, args.stream))
+    wall_time = time.time() - start_time
+    
+    output = args.output or args.batch + ".results.jsonl"
+    with open(output, "w") as f:
+        for result in results:
+            f.write(json.dumps(result) + "\n")
+    
+    ok = [r for r in results if "error" not in r]
+    latencies = sorted(r["response_time"] for r in ok)
+    print("=" * 50)
+    print(f"{len(ok)}/{len(results)} prompts succeeded in {wall_time:.2f}s "
+          f"(parallelism {args.parallel}, {len(results) / wall_time:.2f} prompts/s)")
+    if latencies:
+        print(f"Response time p50 {latencies[len(latencies) // 2]:.2f}s, max {latencies[-1]:.2f}s, "
+              f"tokens {sum(r['tokens_used'] for r in ok)}")
+    if args.stream:
+        ttft = sorted(r["time_to_first_token"] for r in ok if r.get("time_to_first_token") is not None)
+        if ttft:
+            print(f"Time to first token p50 {ttft[len(ttft) // 2]:.2f}s")
+    print(f"Results written to {output}")
 
 
 def main():
     """Main function to run the chatbot"""
-    print("Welcome to the Groq-powered Chatbot!")
-    print("Type 'exit' to end the conversation.")
-    print("Type 'save' to save the conversation.")
-    print("Type 'load' to load a previous conversation.")
-    print("Type 'history' to display the conversation history.")
-    print("=" * 50)
+    parser = argparse.ArgumentParser(description="Groq-powered disaster response chatbot")
+    parser.add_argument("--stream", action="store_true", help="print tokens as they arrive")
+    parser.add_argument("--model", help="pin one model (default: route each turn to a model tier)")
+    parser.add_argument("--batch", metavar="FILE", help="run the prompts in FILE concurrently and exit")
+    parser.add_argument("--parallel", type=int, default=4, help="concurrent requests in batch mode")
+    parser.add_argument("--output", help="batch results file (default: FILE.results.jsonl)")
+    args = parser.parse_args()
     
     # Check if API key is set
     if not os.getenv("GROQ_API_KEY"):
@@ -117,8 +311,21 @@ def main():
         print("Please create a .env file with your Groq API key or set it directly.")
         return
     
+    if args.batch:
+        batch_main(args)
+        return
+    
+    print("Welcome to the Groq-powered Chatbot!")
+    print("Type 'exit' to end the conversation.")
+    print("Type 'save' to save the conversation.")
+    print("Type 'load' to load a previous conversation.")
+    print("Type 'history' to display the conversation history.")
+    print("Type 'stream' to toggle streaming output.")
+    print("=" * 50)
+    
     # Create chatbot instance
-    chatbot = ChatBot()
+    chatbot = ChatBot(args.model)
+    stream = args.stream
     
     # Start conversation loop
     while True:
@@ -133,21 +340,35 @@ def main():
             continue
         
         elif user_input.lower() == "load":
-            filename = input("Enter filename (default: conversation_history.json): ")
+            filename = input(f"Enter filename (default: {DEFAULT_LOG}): ")
             if not filename:
-                filename = "conversation_history.json"
-            chatbot.load_conversation(filename)
+                filename = DEFAULT_LOG
+            session = input(f"Enter session (default: {chatbot.session}): ")
+            chatbot.load_conversation(filename, session or None)
             continue
         
         elif user_input.lower() == "history":
             chatbot.display_conversation()
             continue
         
-        # Generate and display response
-        result = chatbot.generate_response(user_input)
+        elif user_input.lower() == "stream":
+            stream = not stream
+            print(f"Streaming {'on' if stream else 'off'}")
+            continue
         
-        print(f"Bot: {result['response']}")
-        print(f"[Tokens: {result['tokens_used']}, Response time: {result['response_time']:.2f}s]")
+        # Generate and display response
+        if stream:
+            print("Bot: ", end="", flush=True)
+            result = chatbot.generate_response(
+                user_input, stream=True, on_token=lambda text: print(text, end="", flush=True))
+            print()
+            ttft = result["time_to_first_token"]
+            print(f"[Tokens: {result['tokens_used']}, Response time: {result['response_time']:.2f}s, "
+                  f"First token: {f'{ttft:.2f}s' if ttft is not None else 'n/a'}]")
+        else:
+            result = chatbot.generate_response(user_input)
+            print(f"Bot: {result['response']}")
+            print(f"[Tokens: {result['tokens_used']}, Response time: {result['response_time']:.2f}s]")
         print("-" * 50)
 
 
@@ -0,0 +1,158 @@
+# incident_state.py
+"""Per-incident state and a memoized stage pipeline for follow-up reports
+
+The first report of an incident runs every stage. A follow-up ("magnitude
+7.1") carries the incident id from the previous answer: its facts are merged
+into the stored Incident and only the stages whose inputs changed run again.
+
+Each stage names the values it reads. Its output is memoized under a
+fingerprint of those inputs, and downstream stages see the output's
+fingerprint rather than the output itself. By default that is the input
+fingerprint; a stage can fingerprint its output by value instead, so a
+re-run that produces the same routes does not invalidate the map. Results a
+stage does not keep (an unavailable provider) are retried on the next
+report, and so is everything downstream of them.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+INCIDENT_SESSIONS_MAX = int(os.getenv("INCIDENT_SESSIONS_MAX", "1024"))
+# Seconds after the last report before an incident's state is dropped
+INCIDENT_SESSION_TTL = float(os.getenv("INCIDENT_SESSION_TTL", "3600"))
+
+
+def _plain(value):
+    return value.to_dict() if hasattr(value, "to_dict") else str(value)
+
+
+def fingerprint(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True, default=_plain).encode()).hexdigest()[:16]
+
+
+class Stage:
+    __slots__ = ("name", "fn", "inputs", "key", "keep")
+
+    def __init__(self, name, fn, inputs, key=None, keep=None):
+        self.name = name
+        self.fn = fn
+        self.inputs = inputs
+        self.key = key  # key(output) -> value fingerprinted in place of the inputs
+        self.keep = keep  # keep(output) -> False for results worth retrying next time
+
+
+class Pipeline:
+    """Stages run in declaration order; each may read inputs and earlier stage outputs"""
+
+    def __init__(self):
+        self.stages = []
+        self._lock = threading.Lock()
+        self._counts = {}  # stage -> {"runs", "reused"}
+
+    def stage(self, name, inputs, key=None, keep=None):
+        """Decorator registering fn(*inputs) as the stage `name`"""
+        def decorator(fn):
+            self.stages.append(Stage(name, fn, inputs, key, keep))
+            with self._lock:
+                self._counts[name] = {"runs": 0, "reused": 0}
+            return fn
+        return decorator
+
+    def run(self, state, values):
+        """Compute every stage for `values`, reusing state's memo where inputs are unchanged
+
+        Returns ({name: output} for inputs and stages, [names of stages that ran]).
+        """
+        prints = {name: fingerprint(value) for name, value in values.items()}
+        outputs = dict(values)
+        ran = []
+        for stage in self.stages:
+            key = fingerprint([prints[name] for name in stage.inputs])
+            memo = state.memo.get(stage.name)
+            if memo is not None and memo[0] == key:
+                _, output, output_print = memo
+                count = "reused"
+            else:
+                output = stage.fn(*[outputs[name] for name in stage.inputs])
+                if stage.keep is None or stage.keep(output):
+                    output_print = fingerprint(stage.key(output)) if stage.key else key
+                    state.memo[stage.name] = (key, output, output_print)
+                else:
+                    output_print = uuid.uuid4().hex
+                    state.memo.pop(stage.name, None)
+                ran.append(stage.name)
+                count = "runs"
+            with self._lock:
+                self._counts[stage.name][count] += 1
+            outputs[stage.name] = output
+            prints[stage.name] = output_print
+        return outputs, ran
+
+    def stats(self):
+        with self._lock:
+            return {name: dict(counts) for name, counts in self._counts.items()}
+
+
+class IncidentState:
+    __slots__ = ("id", "incident", "memo", "lock", "touched")
+
+    def __init__(self, incident_id, incident):
+        self.id = incident_id
+        self.incident = incident
+        self.memo = {}  # stage -> (input fingerprint, output, output fingerprint)
+        self.lock = threading.Lock()  # one report per incident at a time
+        self.touched = time.monotonic()
+
+
+class IncidentStateStore:
+    """Bounded map of incident id -> IncidentState, evicting idle and least recently used"""
+
+    def __init__(self, max_incidents=INCIDENT_SESSIONS_MAX, ttl=INCIDENT_SESSION_TTL):
+        self.max_incidents = max_incidents
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._states = OrderedDict()
+        self._counts = {"created": 0, "followups": 0, "expired": 0}
+
+    def get(self, incident_id):
+        """The live state for `incident_id`, or None when unknown or expired"""
+        if not incident_id:
+            return None
+        with self._lock:
+            state = self._states.get(incident_id)
+            if state is None:
+                return None
+            if time.monotonic() - state.touched > self.ttl:
+                del self._states[incident_id]
+                self._counts["expired"] += 1
+                return None
+            state.touched = time.monotonic()
+            self._states.move_to_end(incident_id)
+            self._counts["followups"] += 1
+            return state
+
+    def create(self, incident, incident_id=None):
+        state = IncidentState(incident_id or uuid.uuid4().hex, incident)
+        with self._lock:
+            self._states[state.id] = state
+            self._counts["created"] += 1
+            while len(self._states) > self.max_incidents:
+                self._states.popitem(last=False)
+        return state
+
+    def ids(self):
+        with self._lock:
+            return list(self._states)
+
+    def drop(self, incident_id):
+        with self._lock:
+            self._states.pop(incident_id, None)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counts, incidents=len(self._states))
+
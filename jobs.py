@@ -0,0 +1,210 @@
+# jobs.py
+"""In-process background job queues with retry, deduplication and depth metrics
+
+Slow work that the caller does not need in order to answer (map rendering,
+POI enrichment) is submitted here, and the endpoint returns a job id at once.
+Clients poll GET /api/jobs/<id> until the job is done. A job submitted with
+the same (kind, key) as one that is still queued or running returns that job
+instead of running the work twice.
+"""
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from flask import jsonify
+
+
+class Job:
+    __slots__ = ("id", "kind", "key", "fn", "args", "kwargs", "status", "attempts",
+                 "result", "error", "created", "started", "finished", "done")
+
+    def __init__(self, kind, key, fn, args, kwargs):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.key = key
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.status = "queued"
+        self.attempts = 0
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "attempts": self.attempts,
+            "result": self.result,
+            "error": self.error,
+            "queued_ms": round(((self.started or time.time()) - self.created) * 1000, 1),
+            "run_ms": round((self.finished - self.started) * 1000, 1) if self.finished and self.started else None,
+        }
+
+
+class JobQueue:
+    """FIFO queue drained by daemon worker threads, started on the first submit"""
+
+    def __init__(self, name, workers=2, max_retries=2, retry_delay=0.5, keep_finished=512):
+        self.name = name
+        self.workers = workers
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.keep_finished = keep_finished
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()  # id -> Job, oldest first
+        self._active = {}  # (kind, key) -> queued or running Job
+        self._threads = []
+        self._counts = {"submitted": 0, "deduplicated": 0, "completed": 0, "failed": 0, "retried": 0}
+        self._running = 0
+        self._delayed = 0
+
+    def submit(self, kind, key, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs); returns the new Job or the identical one already pending"""
+        with self._lock:
+            if key is not None:
+                existing = self._active.get((kind, key))
+                if existing is not None:
+                    self._counts["deduplicated"] += 1
+                    return existing
+            job = Job(kind, key, fn, args, kwargs)
+            self._jobs[job.id] = job
+            if key is not None:
+                self._active[(kind, key)] = job
+            self._counts["submitted"] += 1
+            self._trim()
+            if not self._threads:
+                self._start_workers()
+        self._queue.put(job)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _start_workers(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"jobs-{self.name}-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _trim(self):
+        # Forget the oldest finished jobs; pending ones are never dropped
+        excess = len(self._jobs) - self.keep_finished
+        for job_id in list(self._jobs):
+            if excess <= 0:
+                break
+            if self._jobs[job_id].done.is_set():
+                del self._jobs[job_id]
+                excess -= 1
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            with self._lock:
+                self._running += 1
+            job.status = "running"
+            job.attempts += 1
+            if job.started is None:
+                job.started = time.time()
+            try:
+                result = job.fn(*job.args, **job.kwargs)
+            except Exception as e:
+                self._failed(job, e)
+            else:
+                job.result = result
+                job.error = None
+                self._finish(job, "done", "completed")
+            finally:
+                with self._lock:
+                    self._running -= 1
+
+    def _failed(self, job, error):
+        job.error = str(error)
+        if job.attempts <= self.max_retries:
+            delay = self.retry_delay * 2 ** (job.attempts - 1)
+            print(f"Job {job.kind} {job.id} failed (attempt {job.attempts}), retrying in {delay:.1f}s: {error}")
+            job.status = "retrying"
+            with self._lock:
+                self._counts["retried"] += 1
+                self._delayed += 1
+            timer = threading.Timer(delay, self._requeue, [job])
+            timer.daemon = True
+            timer.start()
+        else:
+            print(f"Job {job.kind} {job.id} failed after {job.attempts} attempts: {error}")
+            self._finish(job, "failed", "failed")
+
+    def _requeue(self, job):
+        with self._lock:
+            self._delayed -= 1
+        job.status = "queued"
+        self._queue.put(job)
+
+    def _finish(self, job, status, count):
+        job.finished = time.time()
+        job.status = status
+        # Drop references to the inputs; only the result is kept for polling
+        job.fn = job.args = job.kwargs = None
+        with self._lock:
+            self._counts[count] += 1
+            if job.key is not None and self._active.get((job.kind, job.key)) is job:
+                del self._active[(job.kind, job.key)]
+        job.done.set()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counts, depth=self._queue.qsize() + self._delayed,
+                        running=self._running, workers=self.workers)
+
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def job_queue(name):
+    """Shared queue for `name`, sized by JOBS_<NAME>_WORKERS / _MAX_RETRIES"""
+    with _queues_lock:
+        if name not in _queues:
+            prefix = f"JOBS_{name.upper()}_"
+            _queues[name] = JobQueue(
+                name,
+                workers=int(os.getenv(prefix + "WORKERS", "2")),
+                max_retries=int(os.getenv(prefix + "MAX_RETRIES", "2")),
+            )
+        return _queues[name]
+
+
+def job_queue_stats():
+    with _queues_lock:
+        queues = list(_queues.values())
+    return {q.name: q.stats() for q in queues}
+
+
+def find_job(job_id):
+    with _queues_lock:
+        queues = list(_queues.values())
+    for q in queues:
+        job = q.get(job_id)
+        if job is not None:
+            return job
+    return None
+
+
+def init_app(app):
+    """Serve GET /api/jobs/<id> for polling background job status and results"""
+    @app.route('/api/jobs/<job_id>', methods=['GET'])
+    def job_status(job_id):
+        job = find_job(job_id)
+        if job is None:
+            return jsonify({"error": "Unknown job"}), 404
+        return jsonify(job.to_dict())
@@ -0,0 +1,233 @@
+# map_layers.py
+"""Custom folium layers and the prebuilt map shell for the disaster map"""
+import hashlib
+import re
+
+import folium
+from branca.element import MacroElement
+from folium.elements import JSCSSMixin
+from folium.plugins import MarkerCluster
+from jinja2 import Template
+
+from models import FACILITY_ICONS
+
+# Defines decodePolyline(str) and disasterFacilityLoader(map, url, colors). The
+# loader returns load(incidentId), which fetches the padded viewport from the
+# facilities endpoint in the compact format and adds unseen facilities to a
+# Leaflet.markercluster group. Calling it with a new incident resets the layer.
+FACILITY_LOADER_JS = """
+function decodePolyline(encoded) {
+    var points = [], index = 0, lat = 0, lng = 0;
+    while (index < encoded.length) {
+        var deltas = [];
+        for (var k = 0; k < 2; k++) {
+            var shift = 0, result = 0, b;
+            do {
+                b = encoded.charCodeAt(index++) - 63;
+                result |= (b & 0x1f) << shift;
+                shift += 5;
+            } while (b >= 0x20);
+            deltas.push(result & 1 ? ~(result >> 1) : result >> 1);
+        }
+        lat += deltas[0];
+        lng += deltas[1];
+        points.push([lat / 1e5, lng / 1e5]);
+    }
+    return points;
+}
+function disasterFacilityLoader(map, url, colors) {
+    var cluster = L.markerClusterGroup({chunkedLoading: true, disableClusteringAtZoom: 17});
+    var seen = {};
+    var current = null;
+    map.addLayer(cluster);
+    function load(incidentId) {
+        if (incidentId !== undefined && incidentId !== current) {
+            current = incidentId;
+            seen = {};
+            cluster.clearLayers();
+        }
+        if (!current) return;
+        var b = map.getBounds().pad(0.25);
+        var bbox = [b.getSouth(), b.getWest(), b.getNorth(), b.getEast()]
+            .map(function(v) { return v.toFixed(5); }).join(',');
+        var requested = current;
+        fetch(url + '?format=compact&incident=' + encodeURIComponent(requested) + '&bbox=' + bbox)
+            .then(function(response) { return response.json(); })
+            .then(function(data) {
+                if (requested !== current || !data.ids) return;
+                var points = decodePolyline(data.points);
+                var markers = [];
+                data.ids.forEach(function(id, i) {
+                    if (seen[id]) return;
+                    seen[id] = true;
+                    var type = data.types[data.type_codes[i]];
+                    var marker = L.circleMarker(points[i], {
+                        radius: 7, weight: 2, color: colors[type] || 'gray', fillOpacity: 0.8
+                    });
+                    marker.bindPopup(data.names[i] + ' (' + type + ')');
+                    markers.push(marker);
+                });
+                cluster.addLayers(markers);
+            });
+    }
+    map.on('moveend', function() { load(); });
+    return load;
+}
+"""
+
+
+class LazyFacilityLayer(JSCSSMixin, MacroElement):
+    """Client-side clustered facilities fetched by viewport from the facilities endpoint
+
+    Nothing per facility is written into the map HTML. On every pan/zoom the
+    page requests the padded viewport bbox in the compact format (one
+    polyline for all points plus type codes and names) and adds only facilities it has not
+    seen yet to a Leaflet.markercluster group.
+    """
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        {{ this.loader_js }}
+        disasterFacilityLoader({{ this._parent.get_name() }}, {{ this.url|tojson }},
+                               {{ this.colors|tojson }})({{ this.incident_id|tojson }});
+        {% endmacro %}
+    """)
+
+    default_js = MarkerCluster.default_js
+    default_css = MarkerCluster.default_css
+
+    def __init__(self, incident_id, colors, url="/api/facilities"):
+        super().__init__()
+        self._name = "LazyFacilityLayer"
+        self.incident_id = incident_id
+        self.colors = colors
+        self.url = url
+        self.loader_js = FACILITY_LOADER_JS
+
+
+class IncidentShellLayer(JSCSSMixin, MacroElement):
+    """Draws whichever incident is named in the page fragment (#incident=<id>)
+
+    The incident summary (center, label, hazard radius, routes) comes from
+    `incident_url` and facilities from the viewport loader, so the page itself
+    is identical for every incident and can be cached indefinitely.
+    """
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        {{ this.loader_js }}
+        (function() {
+            var map = {{ this._parent.get_name() }};
+            var overlay = L.layerGroup().addTo(map);
+            var loadFacilities = disasterFacilityLoader(map, {{ this.facilities_url|tojson }},
+                                                        {{ this.colors|tojson }});
+            function showIncident() {
+                var match = /incident=([^&]+)/.exec(window.location.hash);
+                if (!match) return;
+                var incidentId = decodeURIComponent(match[1]);
+                fetch({{ this.incident_url|tojson }}.replace('{id}', encodeURIComponent(incidentId)) + '?format=compact')
+                    .then(function(response) { return response.json(); })
+                    .then(function(data) {
+                        overlay.clearLayers();
+                        map.setView(data.center, data.zoom);
+                        L.marker(data.center, {
+                            icon: L.AwesomeMarkers.icon({icon: 'warning-sign', markerColor: 'black', prefix: 'glyphicon'})
+                        }).bindPopup(data.label).addTo(overlay);
+                        L.circle(data.center, {
+                            radius: data.radius, color: 'crimson', fill: true, fillOpacity: 0.2
+                        }).addTo(overlay);
+                        data.routes.forEach(function(route) {
+                            L.polyline(decodePolyline(route.polyline), {color: route.color, weight: 4, opacity: 0.8})
+                                .bindPopup(route.name).addTo(overlay);
+                        });
+                        loadFacilities(incidentId);
+                    });
+            }
+            window.addEventListener('hashchange', showIncident);
+            showIncident();
+        })();
+        {% endmacro %}
+    """)
+
+    default_js = MarkerCluster.default_js
+    default_css = MarkerCluster.default_css
+
+    def __init__(self, colors, incident_url="/api/incidents/{id}/map", facilities_url="/api/facilities"):
+        super().__init__()
+        self._name = "IncidentShellLayer"
+        self.colors = colors
+        self.incident_url = incident_url
+        self.facilities_url = facilities_url
+        self.loader_js = FACILITY_LOADER_JS
+
+
+def build_incident_map(center, label, facilities, routes, colors, lazy_incident_id=None):
+    """Folium map of one incident: the disaster marker and radius, facilities and routes
+
+    With `lazy_incident_id` the facilities are not embedded; a LazyFacilityLayer
+    fetches them for that incident instead. Routes are Route objects or dicts.
+    """
+    m = folium.Map(location=list(center), zoom_start=14)
+    
+    # Add disaster marker
+    folium.Marker(
+        list(center),
+        popup=label,
+        icon=folium.Icon(color='black', icon='warning-sign')
+    ).add_to(m)
+    
+    # Add circle around disaster area
+    folium.Circle(
+        radius=1000,
+        location=list(center),
+        color='crimson',
+        fill=True,
+        fill_opacity=0.2
+    ).add_to(m)
+    
+    # Add critical locations
+    if lazy_incident_id:
+        LazyFacilityLayer(lazy_incident_id, colors).add_to(m)
+    else:
+        for loc in facilities:
+            folium.Marker(
+                [loc.lat, loc.lng],
+                popup=f"{loc.name} ({loc.type})",
+                icon=folium.Icon(color=colors.get(loc.type, 'gray'),
+                                 icon=FACILITY_ICONS.get(loc.type, 'info-sign'))
+            ).add_to(m)
+    
+    # Add routes
+    for route in routes:
+        folium.PolyLine(
+            route['coordinates'],
+            color=route['color'],
+            weight=4,
+            opacity=0.8,
+            popup=route['name']
+        ).add_to(m)
+    return m
+
+
+def render_map_shell(colors, location=(40.7128, -74.0060)):
+    """Render the incident-independent map page once
+
+    Returns (filename, html) where the filename embeds a content fingerprint,
+    so the page can be served with an immutable, long-lived cache policy.
+    """
+    m = folium.Map(location=list(location), zoom_start=10)
+    IncidentShellLayer(colors).add_to(m)
+    html = m.get_root().render()
+    # folium names elements with random ids; normalise them so the fingerprint is stable
+    html = _stable_ids(html)
+    fingerprint = hashlib.sha256(html.encode()).hexdigest()[:12]
+    return f"map_shell.{fingerprint}.html", html
+
+
+def _stable_ids(html):
+    names = {}
+
+    def replace(match):
+        return names.setdefault(match.group(0), f"{match.group(1)}_{len(names)}")
+
+    return re.sub(r"\b([a-z_]+)_[0-9a-f]{32}\b", replace, html)
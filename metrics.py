@@ -0,0 +1,352 @@
+# metrics.py
+"""In-process metrics with Prometheus text exposition and per-stage request timing"""
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Response, current_app, g, has_app_context, has_request_context, request
+
+from cache_warmer import warm_stats
+from cpu_pool import cpu_pool_stats
+from elevation import elevation_stats
+from extraction import extraction_stats
+from jobs import job_queue_stats
+from model_router import router_stats
+from profiler import profiler_stats
+from pubsub import pubsub_stats
+from sharding import sharding_stats
+from startup import startup_collector
+from upstream import coalescing_stats, provider_stats
+
+# Latency buckets in seconds, spanning cache hits to slow LLM completions
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    body = ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                    for k, v in pairs)
+    return "{" + body + "}"
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(_label_key(labels), 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._series = {}  # label key -> [bucket counts..., sum, count]
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, series):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_format_labels(key, [('le', bound)])} {cumulative}")
+                lines.append(f"{self.name}_bucket{_format_labels(key, [('le', '+Inf')])} {series[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {series[-2]:.6f}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {series[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._collectors = []
+
+    def counter(self, name, help_text):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = Counter(name, help_text)
+            return self._metrics[name]
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = Histogram(name, help_text, buckets)
+            return self._metrics[name]
+
+    def register_collector(self, collector):
+        """Add a callable returning [(name, type, help, [(labels_dict, value), ...]), ...]
+
+        Collectors are evaluated at scrape time, for values that already live
+        elsewhere (cache statistics, provider state) and would be stale if copied.
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        for collector in collectors:
+            for name, metric_type, help_text, samples in collector():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(_label_key(labels))} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "disaster_stage_duration_seconds", "Time spent in each request pipeline stage")
+REQUEST_SECONDS = REGISTRY.histogram(
+    "disaster_http_request_duration_seconds", "End-to-end HTTP request latency")
+LLM_TOKENS = REGISTRY.counter(
+    "disaster_llm_tokens_total", "LLM tokens consumed, by call site and token kind")
+
+
+def _upstream_collector():
+    coalescing = coalescing_stats()
+    providers = provider_stats()
+    return [
+        ("disaster_upstream_calls_executed_total", "counter", "Upstream calls actually sent, per call site",
+         [({"call": name}, stats["executed"]) for name, stats in coalescing.items()]),
+        ("disaster_upstream_calls_coalesced_total", "counter", "Upstream calls served by an in-flight identical call",
+         [({"call": name}, stats["coalesced"]) for name, stats in coalescing.items()]),
+        ("disaster_provider_failures_total", "counter", "Failed calls per upstream provider",
+         [({"provider": name}, stats["failures"]) for name, stats in providers.items()]),
+        ("disaster_provider_rate_limited_total", "counter", "Calls rejected by the provider rate limiter",
+         [({"provider": name}, stats["rate_limited_rejections"]) for name, stats in providers.items()]),
+        ("disaster_provider_circuit_open", "gauge", "1 if the provider circuit breaker is not closed",
+         [({"provider": name}, int(stats["circuit"] != "closed")) for name, stats in providers.items()]),
+    ]
+
+
+REGISTRY.register_collector(_upstream_collector)
+
+
+def _jobs_collector():
+    queues = job_queue_stats()
+    return [
+        ("disaster_job_queue_depth", "gauge", "Jobs waiting to run, including ones backing off before a retry",
+         [({"queue": name}, stats["depth"]) for name, stats in queues.items()]),
+        ("disaster_jobs_running", "gauge", "Jobs currently executing",
+         [({"queue": name}, stats["running"]) for name, stats in queues.items()]),
+        ("disaster_jobs_total", "counter", "Background jobs by outcome",
+         [({"queue": name, "outcome": outcome}, stats[outcome]) for name, stats in queues.items()
+          for outcome in ("submitted", "deduplicated", "completed", "failed", "retried")]),
+    ]
+
+
+REGISTRY.register_collector(_jobs_collector)
+
+
+def _cpu_pool_collector():
+    stats = cpu_pool_stats()
+    return [
+        ("disaster_cpu_pool_workers", "gauge", "Configured CPU pool worker processes (0 renders inline)",
+         [({}, stats["workers"])]),
+        ("disaster_cpu_pool_tasks_total", "counter", "CPU-bound tasks by where they ran or how they ended",
+         [({"outcome": outcome}, stats[outcome]) for outcome in ("submitted", "failed", "inline")]),
+    ]
+
+
+REGISTRY.register_collector(_cpu_pool_collector)
+
+
+def _model_router_collector():
+    tiers = list(router_stats().values())
+
+    def samples(field):
+        return [({"tier": t["tier"], "kind": t["kind"], "model": t["model"]}, t[field]) for t in tiers]
+
+    return [
+        ("disaster_llm_tier_calls_total", "counter", "LLM calls per model tier and call kind", samples("calls")),
+        ("disaster_llm_tier_seconds_total", "counter", "Total LLM call latency per tier and kind",
+         [(labels, round(value, 6)) for labels, value in samples("seconds_sum")]),
+        ("disaster_llm_tier_prompt_tokens_total", "counter", "Prompt tokens per tier and kind", samples("prompt_tokens")),
+        ("disaster_llm_tier_completion_tokens_total", "counter", "Completion tokens per tier and kind",
+         samples("completion_tokens")),
+        ("disaster_llm_tier_errors_total", "counter", "Failed LLM calls per tier and kind", samples("error")),
+        ("disaster_llm_tier_invalid_total", "counter", "Answers rejected by validation per tier and kind",
+         samples("invalid")),
+        ("disaster_llm_tier_fallbacks_total", "counter", "Calls retried on the fallback tier", samples("fallback")),
+    ]
+
+
+REGISTRY.register_collector(_model_router_collector)
+
+
+def _elevation_collector():
+    stats = elevation_stats()
+    return [
+        ("disaster_elevation_lookups_total", "counter", "Batched DEM elevation lookups", [({}, stats["lookups"])]),
+        ("disaster_elevation_points_total", "counter", "Points looked up in the DEM", [({}, stats["points"])]),
+        ("disaster_elevation_seconds_total", "counter", "Total time spent in DEM lookups",
+         [({}, round(stats["seconds_sum"], 6))]),
+    ]
+
+
+REGISTRY.register_collector(_elevation_collector)
+
+
+def _pubsub_collector():
+    stats = pubsub_stats()
+    return [
+        ("disaster_pubsub_subscribers", "gauge", "Open live-update streams", [({}, stats["subscribers"])]),
+        ("disaster_pubsub_events_total", "counter", "Live-update events by outcome",
+         [({"outcome": outcome}, stats[outcome])
+          for outcome in ("published", "fanout", "delivered", "coalesced", "dropped")]),
+    ]
+
+
+REGISTRY.register_collector(_pubsub_collector)
+
+
+def _sharding_collector():
+    stats = sharding_stats()
+    if not stats["enabled"]:
+        return []
+    return [
+        ("disaster_shard_nodes", "gauge", "Nodes in this process's hash ring", [({}, len(stats["nodes"]))]),
+        ("disaster_shard_handoff_total", "counter", "Keys moved between nodes by step",
+         [({"step": step}, stats[step]) for step in ("copied", "imported", "released", "copy_errors")]),
+        ("disaster_shard_replica_total", "counter", "Replicated geo cache entries by cache and outcome",
+         [({"cache": name, "outcome": outcome}, counts[outcome])
+          for name, counts in stats["caches"].items() for outcome in ("hits", "pushed", "received")]),
+    ]
+
+
+REGISTRY.register_collector(_sharding_collector)
+
+
+def _cache_warmer_collector():
+    stats = warm_stats()
+    return [
+        ("disaster_warm_pending", "gauge", "Cache-warming lookups waiting for budget", [({}, stats["pending"])]),
+        ("disaster_warm_lookups_total", "counter", "Cache-warming lookups by outcome",
+         [({"outcome": outcome}, stats[outcome])
+          for outcome in ("queued", "warmed", "failed", "skipped", "dropped", "deferred")]),
+    ]
+
+
+REGISTRY.register_collector(_cache_warmer_collector)
+
+
+def _extraction_collector():
+    stats = extraction_stats()
+    return [
+        ("disaster_extractions_total", "counter", "Incident extractions by how the answer was obtained",
+         [({"outcome": outcome}, stats[outcome])
+          for outcome in ("first_pass", "local_repair", "model_repair", "invalid", "error")]),
+    ]
+
+
+REGISTRY.register_collector(_extraction_collector)
+
+
+def _profiler_collector():
+    stats = profiler_stats()
+    return [
+        ("disaster_profiles_total", "counter", "Request profiles by trigger, and slow-watch profiles discarded",
+         [({"outcome": outcome}, stats[outcome]) for outcome in ("requested", "slow", "discarded")]),
+        ("disaster_profile_samples_total", "counter", "Stack samples taken by the request profiler", [({}, stats["samples"])]),
+    ]
+
+
+REGISTRY.register_collector(_profiler_collector)
+REGISTRY.register_collector(startup_collector)
+
+
+def _app_name():
+    if has_app_context():
+        return current_app.config.get("METRICS_APP", current_app.name)
+    return "cli"
+
+
+@contextmanager
+def stage(name):
+    """Time a pipeline stage into the stage histogram and the Server-Timing header"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, app=_app_name(), stage=name)
+        if has_request_context():
+            g.setdefault("stage_timings", []).append((name, elapsed))
+
+
+def record_tokens(call, usage):
+    """Record token usage from a Groq completion's `usage` object"""
+    if usage is None:
+        return
+    app_name = _app_name()
+    LLM_TOKENS.inc(getattr(usage, "prompt_tokens", 0) or 0, app=app_name, call=call, kind="prompt")
+    LLM_TOKENS.inc(getattr(usage, "completion_tokens", 0) or 0, app=app_name, call=call, kind="completion")
+
+
+def init_app(app, name):
+    """Time every request, emit Server-Timing headers and serve GET /metrics"""
+    app.config["METRICS_APP"] = name
+
+    @app.before_request
+    def _start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def _record_request(response):
+        start = g.get("request_start")
+        if start is not None:
+            REQUEST_SECONDS.observe(time.perf_counter() - start, app=name,
+                                    endpoint=request.endpoint or "unknown")
+        timings = g.get("stage_timings")
+        if timings:
+            response.headers["Server-Timing"] = ", ".join(
+                f"{stage_name};dur={elapsed * 1000:.1f}" for stage_name, elapsed in timings)
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
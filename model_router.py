@@ -0,0 +1,189 @@
+# model_router.py
+"""Route each LLM call to a model tier by what the call is for
+
+Calls are classified as "extraction" (structured JSON parsing), "followup"
+(a short message continuing a conversation) or "plan" (a full response
+plan). Each kind maps to a tier with its own model, max_tokens and
+temperature. When the chosen tier errors or its answer fails validation, the
+call is retried once on the fallback tier, normally the big model.
+
+    MODEL_TIER_FAST=llama3-8b-8192 MODEL_ROUTE_FOLLOWUP=full python app.py
+"""
+import os
+import re
+import threading
+import time
+
+from upstream import UpstreamUnavailable
+
+
+class Tier:
+    __slots__ = ("name", "model", "max_tokens", "temperature")
+
+    def __init__(self, name, model, max_tokens, temperature):
+        self.name = name
+        self.model = model
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+
+    def params(self):
+        return {"model": self.model, "max_tokens": self.max_tokens, "temperature": self.temperature}
+
+
+# name: (model, max_tokens, temperature); each is overridable with
+# MODEL_TIER_<NAME>, MODEL_TIER_<NAME>_MAX_TOKENS and MODEL_TIER_<NAME>_TEMPERATURE
+TIER_DEFAULTS = {
+    "fast": ("llama3-8b-8192", 500, 0.3),
+    "full": ("llama3-70b-8192", 1024, 0.5),
+}
+
+# kind: tier, overridable with MODEL_ROUTE_<KIND>
+ROUTE_DEFAULTS = {
+    "extraction": "fast",
+    "followup": "fast",
+    "plan": "full",
+}
+
+FALLBACK_TIER = os.getenv("MODEL_FALLBACK_TIER", "full")
+# Longest message (in words) still treated as a follow-up
+FOLLOWUP_MAX_WORDS = int(os.getenv("MODEL_FOLLOWUP_MAX_WORDS", "15"))
+
+# A message naming a disaster starts a new plan even mid-conversation
+DISASTER_TERMS = re.compile(
+    r"\b(earthquake|quake|flood|flooding|fire|wildfire|hurricane|cyclone|typhoon|storm|"
+    r"tornado|tsunami|landslide|explosion|evacuat\w*)\b", re.IGNORECASE)
+
+
+def _load_tiers():
+    tiers = {}
+    for name, (model, max_tokens, temperature) in TIER_DEFAULTS.items():
+        prefix = f"MODEL_TIER_{name.upper()}"
+        tiers[name] = Tier(
+            name,
+            os.getenv(prefix, model),
+            int(os.getenv(prefix + "_MAX_TOKENS", max_tokens)),
+            float(os.getenv(prefix + "_TEMPERATURE", temperature)),
+        )
+    return tiers
+
+
+TIERS = _load_tiers()
+ROUTES = {kind: os.getenv(f"MODEL_ROUTE_{kind.upper()}", tier) for kind, tier in ROUTE_DEFAULTS.items()}
+
+# Fail at startup, not on the first call that needs the misconfigured tier
+for _setting, _tier in [("MODEL_FALLBACK_TIER", FALLBACK_TIER)] + [
+        (f"MODEL_ROUTE_{kind.upper()}", tier) for kind, tier in ROUTES.items()]:
+    if _tier not in TIERS:
+        raise ValueError(f"{_setting}={_tier!r} is not a model tier; choose one of {', '.join(sorted(TIERS))}")
+
+
+def classify_chat(user_message, history):
+    """"followup" for a short, disaster-free message after an assistant turn, else "plan\""""
+    answered = any(message.get("role") == "assistant" for message in history)
+    if (answered and len(user_message.split()) <= FOLLOWUP_MAX_WORDS
+            and not DISASTER_TERMS.search(user_message)):
+        return "followup"
+    return "plan"
+
+
+def select(kind):
+    """Tier configured for a call kind"""
+    return TIERS[ROUTES.get(kind, FALLBACK_TIER)]
+
+
+def require_text(content):
+    """Default validation: a non-empty answer"""
+    if not content or not content.strip():
+        raise ValueError("empty completion")
+    return content
+
+
+_lock = threading.Lock()
+_stats = {}  # (tier, kind) -> counters
+
+
+def record(tier, kind, seconds, usage=None, outcome="ok"):
+    """Count one call on `tier`; outcome is ok, error, invalid or fallback"""
+    with _lock:
+        stats = _stats.setdefault((tier.name, kind), {
+            "model": tier.model, "calls": 0, "seconds_sum": 0.0, "prompt_tokens": 0,
+            "completion_tokens": 0, "error": 0, "invalid": 0, "fallback": 0,
+        })
+        if outcome in ("error", "invalid", "fallback"):
+            stats[outcome] += 1
+        if outcome != "fallback":
+            stats["calls"] += 1
+            stats["seconds_sum"] += seconds
+        if usage is not None:
+            stats["prompt_tokens"] += getattr(usage, "prompt_tokens", 0) or 0
+            stats["completion_tokens"] += getattr(usage, "completion_tokens", 0) or 0
+
+
+def fallback_tier(tier):
+    """The tier a failed call on `tier` is retried on, or None when `tier` is the fallback"""
+    return None if tier.name == FALLBACK_TIER else TIERS[FALLBACK_TIER]
+
+
+def fall_back(tier, kind, seconds, reason, outcome="error", usage=None, retry=True):
+    """Record a failed ("error") or rejected ("invalid") call; returns the tier to retry on, or None
+
+    For calls complete() cannot make, such as streams and async clients.
+    With `retry=False` the failure is only recorded, e.g. once part of a
+    stream has already been shown.
+    """
+    record(tier, kind, seconds, usage, outcome=outcome)
+    fallback = fallback_tier(tier) if retry else None
+    if fallback is not None:
+        what = "failed" if outcome == "error" else "answer rejected"
+        print(f"Model tier {tier.name} {what} for {kind}, falling back: {reason}")
+        record(tier, kind, 0, outcome="fallback")
+    return fallback
+
+
+def router_stats():
+    with _lock:
+        return {f"{tier}/{kind}": dict(stats, tier=tier, kind=kind) for (tier, kind), stats in _stats.items()}
+
+
+def complete(create, kind, messages, validate=require_text, repair=None, **kwargs):
+    """Run `create(model=..., messages=..., ...)` on the tier for `kind`
+
+    `validate(content)` returns the parsed value or raises ValueError. On a
+    provider error or a rejected answer the call is repeated on the fallback
+    tier. Rate limiting and open circuits are not retried there, since both
+    tiers share the provider. With `repair(messages, content, error)`, a
+    rejected answer is retried once with the messages it returns, on the
+    same tier when that is already the fallback. Returns (response, value, tier).
+    """
+    tiers = [select(kind)]
+    if tiers[0].name != FALLBACK_TIER or repair is not None:
+        tiers.append(TIERS[FALLBACK_TIER])
+    for attempt, tier in enumerate(tiers):
+        last = attempt == len(tiers) - 1
+        start = time.perf_counter()
+        try:
+            response = create(messages=messages, **tier.params(), **kwargs)
+        except UpstreamUnavailable:
+            record(tier, kind, time.perf_counter() - start, outcome="error")
+            raise
+        except Exception as e:
+            record(tier, kind, time.perf_counter() - start, outcome="error")
+            if last:
+                raise
+            print(f"Model tier {tier.name} failed for {kind}, falling back: {e}")
+            record(tier, kind, 0, outcome="fallback")
+            continue
+        elapsed = time.perf_counter() - start
+        try:
+            value = validate(response.choices[0].message.content)
+        except ValueError as e:
+            record(tier, kind, elapsed, response.usage, outcome="invalid")
+            if last:
+                raise
+            print(f"Model tier {tier.name} answer rejected for {kind}, falling back: {e}")
+            record(tier, kind, 0, outcome="fallback")
+            if repair is not None:
+                messages = repair(messages, response.choices[0].message.content, e)
+            continue
+        record(tier, kind, elapsed, response.usage)
+        return response, value, tier
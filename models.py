@@ -0,0 +1,258 @@
+# models.py
+"""Compact data models for incidents, facilities, routes and agent output
+
+Facilities are stored column-wise in a FacilitySet (coordinate arrays, one
+byte per type code, a list of names) instead of one dict per facility.
+Stages receive FacilityView / FacilitySubset objects that index into the
+shared columns rather than copying them. Every model also answers
+`obj['key']` and `obj.get('key')` so code written against the old dicts
+keeps working.
+"""
+from array import array
+
+# Order defines the type codes used in arrays and compact payloads
+FACILITY_TYPES = ["hospital", "police", "fire_station", "park"]
+
+FACILITY_COLORS = {
+    "hospital": "red",
+    "police": "blue",
+    "fire_station": "orange",
+    "park": "green"
+}
+
+# Glyphicon names for folium marker icons
+FACILITY_ICONS = {
+    "hospital": "plus",
+    "police": "flag",
+    "fire_station": "fire-extinguisher",
+    "park": "tree"
+}
+
+
+def type_code(loc_type):
+    """Enum code for a facility type; unknown types share the trailing "other" code"""
+    return FACILITY_TYPES.index(loc_type) if loc_type in FACILITY_TYPES else len(FACILITY_TYPES)
+
+
+class _Mapping:
+    """Dict-style read access for slotted models"""
+    __slots__ = ()
+    _keys = ()
+
+    def __getitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self._keys else default
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self._keys}
+
+
+class FacilityView(_Mapping):
+    """One facility of a FacilitySet, read in place"""
+    __slots__ = ("_set", "index")
+    _keys = ("type", "name", "lat", "lng", "type_color")
+
+    def __init__(self, facility_set, index):
+        self._set = facility_set
+        self.index = index
+
+    @property
+    def type(self):
+        return self._set.types[self._set.type_codes[self.index]]
+
+    @property
+    def name(self):
+        return self._set.names[self.index]
+
+    @property
+    def lat(self):
+        return self._set.lats[self.index]
+
+    @property
+    def lng(self):
+        return self._set.lngs[self.index]
+
+    @property
+    def type_color(self):
+        return FACILITY_COLORS.get(self.type, "gray")
+
+    def __repr__(self):
+        return f"FacilityView({self.type!r}, {self.name!r}, {self.lat}, {self.lng})"
+
+
+class _FacilitySequence:
+    """Shared sequence behaviour for FacilitySet and FacilitySubset"""
+    __slots__ = ()
+
+    def __iter__(self):
+        base = self.base
+        for i in self.indices:
+            yield FacilityView(base, i)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return FacilitySubset(self.base, self.indices[item])
+        return FacilityView(self.base, self.indices[item])
+
+    def of_types(self, types):
+        """Subset view of the facilities whose type is in `types`"""
+        base = self.base
+        codes = {base.types.index(t) for t in types if t in base.types}
+        type_codes = base.type_codes
+        return FacilitySubset(base, array("I", (i for i in self.indices if type_codes[i] in codes)))
+
+
+class FacilitySet(_FacilitySequence):
+    """Struct-of-arrays facility collection"""
+    __slots__ = ("lats", "lngs", "type_codes", "names", "types")
+
+    def __init__(self):
+        self.lats = array("d")
+        self.lngs = array("d")
+        self.type_codes = array("B")
+        self.names = []
+        # Per-set type table; unknown types are appended after the known ones
+        self.types = list(FACILITY_TYPES)
+
+    @property
+    def base(self):
+        return self
+
+    @property
+    def indices(self):
+        return range(len(self.lats))
+
+    def append(self, loc_type, name, lat, lng):
+        if loc_type not in self.types:
+            self.types.append(loc_type)
+        self.type_codes.append(self.types.index(loc_type))
+        self.names.append(name)
+        self.lats.append(lat)
+        self.lngs.append(lng)
+
+    @classmethod
+    def from_dicts(cls, facilities):
+        facility_set = cls()
+        for facility in facilities:
+            facility_set.append(facility["type"], facility["name"], facility["lat"], facility["lng"])
+        return facility_set
+
+
+class FacilitySubset(_FacilitySequence):
+    """Index-array view over a FacilitySet; filtering and slicing copy no facility data"""
+    __slots__ = ("base", "indices")
+
+    def __init__(self, base, indices):
+        self.base = base
+        self.indices = indices
+
+
+class Route(_Mapping):
+    __slots__ = ("name", "coordinates", "color")
+    _keys = __slots__
+
+    def __init__(self, name, coordinates, color):
+        self.name = name
+        self.coordinates = coordinates
+        self.color = color
+
+
+class AgentResponse(_Mapping):
+    __slots__ = ("text", "routes")
+    _keys = __slots__
+
+    def __init__(self, text, routes=None):
+        self.text = text
+        self.routes = routes or []
+
+
+class Incident(_Mapping):
+    """Parsed disaster report; fields the LLM adds beyond the known ones go to `extra`"""
+    __slots__ = ("disaster_type", "location", "severity", "details", "lat", "lng",
+                 "parse_source", "geocode_source", "extra")
+    _keys = __slots__[:-1]
+
+    # None means "not reported"; get() then falls back to the caller's default like dict.get
+    def __init__(self, disaster_type=None, location=None, severity=None, details=None,
+                 lat=None, lng=None, parse_source=None, geocode_source=None):
+        self.disaster_type = disaster_type
+        self.location = location
+        self.severity = severity
+        self.details = details
+        self.lat = lat
+        self.lng = lng
+        self.parse_source = parse_source
+        self.geocode_source = geocode_source
+        self.extra = {}
+
+    @classmethod
+    def from_dict(cls, data):
+        incident = cls()
+        incident.update(data)
+        return incident
+
+    def update(self, data):
+        for key, value in data.items():
+            if key in self._keys:
+                setattr(self, key, value)
+            else:
+                self.extra[key] = value
+
+    def merge(self, report):
+        """Fold the facts a follow-up report adds into this incident; returns the changed fields
+
+        Unknown values ("unknown", "unknown location", empty severity) keep
+        what is already known, severity dicts are combined and new details
+        are appended. Coordinates and sources are left to the pipeline.
+        """
+        changed = []
+        for key in ("disaster_type", "location"):
+            value = report.get(key)
+            if value and value not in ("unknown", "unknown location") and value != getattr(self, key):
+                setattr(self, key, value)
+                changed.append(key)
+        severity = report.get("severity")
+        if severity:
+            if isinstance(severity, dict) and isinstance(self.severity, dict):
+                severity = dict(self.severity, **severity)
+            if severity != self.severity:
+                self.severity = severity
+                changed.append("severity")
+        details = report.get("details")
+        if details and details != self.details:
+            if isinstance(details, str) and isinstance(self.details, str) and self.details:
+                if details not in self.details:
+                    self.details = f"{self.details} {details}"
+                    changed.append("details")
+            else:
+                self.details = details
+                changed.append("details")
+        for key, value in report.extra.items():
+            if self.extra.get(key) != value:
+                self.extra[key] = value
+                changed.append(key)
+        return changed
+
+    def get(self, key, default=None):
+        if key in self._keys:
+            value = getattr(self, key)
+            return default if value is None else value
+        return self.extra.get(key, default)
+
+    def __getitem__(self, key):
+        if key in self._keys:
+            return getattr(self, key)
+        return self.extra[key]
+
+    def to_dict(self):
+        return dict(self.extra, **super().to_dict())
@@ -0,0 +1,253 @@
+# overpass_planner.py
+"""Overpass query planner: batches nearby lookups and reuses cached supersets"""
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from upstream import provider, get_json
+
+OVERPASS_URL = os.getenv("OVERPASS_URL", "http://overpass-api.de/api/interpreter")
+
+# Overpass selectors for every facility type the GIS component understands
+FACILITY_QUERIES = {
+    "hospital": ['node["amenity"="hospital"]'],
+    "police": ['node["amenity"="police"]'],
+    "fire_station": ['node["amenity"="fire_station"]'],
+    "park": ['node["leisure"="park"]', 'way["leisure"="park"]', 'relation["leisure"="park"]'],
+}
+
+EARTH_RADIUS_M = 6371000
+METERS_PER_DEGREE = 111320
+
+
+def haversine_m(lat1, lng1, lat2, lng2):
+    """Great-circle distance between two points in meters"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+def radius_bbox(lat, lng, radius):
+    """Bounding box (south, west, north, east) enclosing a circle of `radius` meters"""
+    dlat = radius / METERS_PER_DEGREE
+    dlng = radius / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01))
+    return (lat - dlat, lng - dlng, lat + dlat, lng + dlng)
+
+
+def bbox_union(a, b):
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+
+def bbox_contains(outer, inner):
+    return (outer[0] <= inner[0] and outer[1] <= inner[1]
+            and outer[2] >= inner[2] and outer[3] >= inner[3])
+
+
+def element_type(element):
+    """Facility type of a raw Overpass element (amenity or leisure tag)"""
+    tags = element.get("tags", {})
+    return tags.get("amenity") or tags.get("leisure")
+
+
+def element_coords(element):
+    """(lat, lng) of a raw Overpass element, using the center for ways and relations"""
+    if element.get("type") == "node":
+        return element.get("lat"), element.get("lon")
+    if "center" in element:
+        center = element["center"]
+        return center.get("lat"), center.get("lon")
+    # `out bb` gives bounds; Overpass's own center is the middle of the same box
+    bounds = element.get("bounds")
+    if not bounds:
+        return None, None
+    return (bounds["minlat"] + bounds["maxlat"]) / 2, (bounds["minlon"] + bounds["maxlon"]) / 2
+
+
+def element_distance_m(element, lat, lng):
+    """Meters from (lat, lng) to an element: to its bounding box when it has one, else to its point"""
+    bounds = element.get("bounds")
+    if bounds:
+        e_lat = min(max(lat, bounds["minlat"]), bounds["maxlat"])
+        e_lng = min(max(lng, bounds["minlon"]), bounds["maxlon"])
+    else:
+        e_lat, e_lng = element_coords(element)
+        if e_lat is None or e_lng is None:
+            return None
+    return haversine_m(lat, lng, e_lat, e_lng)
+
+
+def build_bbox_query(bbox, types):
+    """Build one Overpass QL query covering `types` inside `bbox`"""
+    area = "{:.6f},{:.6f},{:.6f},{:.6f}".format(*bbox)
+    clauses = []
+    for loc_type in sorted(types):
+        for selector in FACILITY_QUERIES[loc_type]:
+            clauses.append(f"  {selector}({area});")
+    # Bounds rather than centers, so a large park reaching into the circle is kept
+    return "[out:json];\n(\n" + "\n".join(clauses) + "\n);\nout bb;"
+
+
+def filter_elements(elements, lat, lng, radius, types):
+    """Keep tagged elements of `types` within `radius` meters of (lat, lng)
+
+    Ways and relations count when any part of their bounding box is in
+    range, close to the geometry test the old around: filter made.
+    """
+    result = []
+    for element in elements:
+        if "tags" not in element or element_type(element) not in types:
+            continue
+        distance = element_distance_m(element, lat, lng)
+        if distance is not None and distance <= radius:
+            result.append(element)
+    return result
+
+
+class _Batch:
+    """A pending or in-flight bbox query shared by every request merged into it"""
+
+    def __init__(self, bbox, types):
+        self.bbox = bbox
+        self.types = set(types)
+        self.closed = False
+        self.done = threading.Event()
+        self.elements = None
+        self.error = None
+        self.merge = False  # hold open for the merge window before sending
+
+
+class OverpassPlanner:
+    """Merge concurrent nearby requests into one bbox query and answer from cached supersets
+
+    A request is served, in order of preference, by:
+    1. a cached result whose bbox covers the request circle and whose types are a superset,
+    2. an in-flight query that will produce such a result (single-flight),
+    3. a pending batch it can join while the merge window is still open,
+    4. a new batch, for which the calling thread becomes the leader.
+
+    The leader only holds its batch open for the merge window when other
+    lookups are pending or in flight; a lone lookup is sent at once.
+    """
+
+    def __init__(self, url=OVERPASS_URL, merge_window=0.05, max_span_deg=0.5,
+                 cache_size=128, cache_ttl=900, stale_ttl=86400, timeout=30):
+        self.url = url
+        self.merge_window = merge_window
+        self.max_span_deg = max_span_deg
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.stale_ttl = stale_ttl
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()  # (bbox, frozenset(types)) -> (fetched_at, elements)
+        self._pending = []
+        self._inflight = []
+        self.stats = {"requests": 0, "cache_hits": 0, "joined": 0, "upstream_queries": 0}
+
+    def query(self, lat, lng, radius=5000, types=None):
+        """Return raw Overpass elements of `types` within `radius` meters of (lat, lng)"""
+        types = set(types or FACILITY_QUERIES)
+        bbox = radius_bbox(lat, lng, radius)
+
+        with self._lock:
+            self.stats["requests"] += 1
+            elements = self._lookup_cache(bbox, types, self.cache_ttl)
+            if elements is not None:
+                self.stats["cache_hits"] += 1
+                return filter_elements(elements, lat, lng, radius, types)
+
+            batch = self._find_inflight(bbox, types) or self._join_pending(bbox, types)
+            leader = batch is None
+            if leader:
+                batch = _Batch(bbox, types)
+                # Only a busy planner is likely to see another lookup within the window
+                batch.merge = bool(self._pending or self._inflight)
+                self._pending.append(batch)
+            else:
+                self.stats["joined"] += 1
+
+        if leader:
+            self._run(batch)
+        else:
+            batch.done.wait()
+
+        if batch.error is not None:
+            raise batch.error
+        return filter_elements(batch.elements, lat, lng, radius, types)
+
+    def lookup_stale(self, lat, lng, radius=5000, types=None):
+        """Answer from any cached superset up to `stale_ttl` old, or None (degraded mode)"""
+        types = set(types or FACILITY_QUERIES)
+        with self._lock:
+            elements = self._lookup_cache(radius_bbox(lat, lng, radius), types, self.stale_ttl)
+        if elements is None:
+            return None
+        return filter_elements(elements, lat, lng, radius, types)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def _lookup_cache(self, bbox, types, max_age):
+        now = time.time()
+        for key in list(self._cache):
+            fetched_at, elements = self._cache[key]
+            age = now - fetched_at
+            if age > self.stale_ttl:
+                del self._cache[key]
+                continue
+            if age > max_age:
+                continue
+            cached_bbox, cached_types = key
+            if bbox_contains(cached_bbox, bbox) and types <= cached_types:
+                self._cache.move_to_end(key)
+                return elements
+        return None
+
+    def _find_inflight(self, bbox, types):
+        for batch in self._inflight:
+            if bbox_contains(batch.bbox, bbox) and types <= batch.types:
+                return batch
+        return None
+
+    def _join_pending(self, bbox, types):
+        for batch in self._pending:
+            merged = bbox_union(batch.bbox, bbox)
+            if (merged[2] - merged[0] <= self.max_span_deg
+                    and merged[3] - merged[1] <= self.max_span_deg):
+                batch.bbox = merged
+                batch.types |= types
+                return batch
+        return None
+
+    def _run(self, batch):
+        if self.merge_window and batch.merge:
+            time.sleep(self.merge_window)
+        with self._lock:
+            self._pending.remove(batch)
+            batch.closed = True
+            self._inflight.append(batch)
+            self.stats["upstream_queries"] += 1
+        try:
+            elements = self._fetch(batch.bbox, batch.types)
+            with self._lock:
+                self._cache[(batch.bbox, frozenset(batch.types))] = (time.time(), elements)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            batch.elements = elements
+        except Exception as e:
+            batch.error = e
+        finally:
+            with self._lock:
+                self._inflight.remove(batch)
+            batch.done.set()
+
+    def _fetch(self, bbox, types):
+        query = build_bbox_query(bbox, types)
+        data = provider("overpass").call(get_json, self.url, params={"data": query},
+                                         timeout=self.timeout)
+        return data.get("elements", [])
@@ -0,0 +1,255 @@
+# profiler.py
+"""On-demand sampling profiles of single requests, kept in a ring buffer
+
+A request is profiled when it asks to be (an X-Profile: 1 header or a
+?profile=1 argument) or, with PROFILE_SLOW_MS set, when it turns out to be
+slower than that. A single daemon thread samples the stacks of the request
+threads being watched: every PROFILE_INTERVAL_MS for requested profiles and
+every PROFILE_SLOW_INTERVAL_MS while waiting to see if a request is slow.
+The samples are wall-clock, so time blocked on Groq, TomTom, Overpass or
+Nominatim shows up under the frames that made the call. Work handed to job
+queues or the CPU pool is not on the request thread; the stage timings
+show how long the request waited for it.
+
+Finished profiles go to a ring of the last PROFILE_RING, with the request's
+stage timings. GET /api/profiles lists them, GET /api/profiles/<id> returns
+one as collapsed stacks (flamegraph.pl, inferno and speedscope read these)
+and GET /api/profiles/collapsed merges all of them, optionally for one
+path. Values are milliseconds of sampled time.
+
+With neither trigger in use no thread is started and a request costs at
+most one header lookup. Requesting a profile and the /api/profiles routes need
+PROFILE_TOKEN, sent as X-Profile-Token; without it neither is available and
+only slow capture can fill the ring.
+"""
+import hmac
+import itertools
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+from flask import Response, g, jsonify, request
+
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+# Keep the profile of any request slower than this; 0 disables slow capture
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "0"))
+PROFILE_SLOW_INTERVAL_MS = float(os.getenv("PROFILE_SLOW_INTERVAL_MS", "20"))
+PROFILE_RING = int(os.getenv("PROFILE_RING", "50"))
+PROFILE_MAX_DEPTH = int(os.getenv("PROFILE_MAX_DEPTH", "96"))
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+
+_labels = {}  # code object -> frame label
+
+
+def _label(code):
+    label = _labels.get(code)
+    if label is None:
+        name = getattr(code, "co_qualname", code.co_name)
+        label = f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ":")
+        _labels[code] = label
+    return label
+
+
+def collapse(frame, max_depth=PROFILE_MAX_DEPTH):
+    """The stack under `frame` as one collapsed line, outermost frame first"""
+    labels = []
+    while frame is not None and len(labels) < max_depth:
+        labels.append(_label(frame.f_code))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+class Capture:
+    """The samples and metadata of one profiled request"""
+
+    def __init__(self, capture_id, ident, interval, trigger):
+        self.id = capture_id
+        self.ident = ident
+        self.interval = interval
+        self.trigger = trigger
+        self.next_due = 0.0
+        self.stacks = {}  # collapsed stack -> samples
+        self.samples = 0
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.method = request.method
+        self.path = request.path
+        self.endpoint = request.endpoint
+        self.status = None
+        self.duration_ms = None
+        self.stages = []
+
+    def add(self, frame):
+        stack = collapse(frame)
+        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+        self.samples += 1
+
+    def weighted(self):
+        """Collapsed stacks weighted in milliseconds, so profiles sampled at different rates merge"""
+        ms = self.interval * 1000
+        return {stack: round(count * ms) for stack, count in self.stacks.items()}
+
+    def summary(self):
+        return {"id": self.id, "trigger": self.trigger, "method": self.method, "path": self.path,
+                "endpoint": self.endpoint, "status": self.status, "started": self.started,
+                "duration_ms": self.duration_ms, "samples": self.samples,
+                "interval_ms": self.interval * 1000,
+                "stages": [{"stage": name, "ms": round(elapsed * 1000, 1)} for name, elapsed in self.stages]}
+
+
+class Sampler:
+    """One thread sampling the stacks of the watched request threads, each at its capture's interval"""
+
+    def __init__(self):
+        self._captures = {}  # thread ident -> Capture
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._thread = None
+
+    def watch(self, capture):
+        with self._lock:
+            self._captures[capture.ident] = capture
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self._thread.start()
+            self._wake.notify()
+
+    def unwatch(self, capture):
+        with self._lock:
+            if self._captures.get(capture.ident) is capture:
+                del self._captures[capture.ident]
+
+    def _run(self):
+        while True:
+            # Sampling under the lock means an unwatched capture is never written to again
+            with self._lock:
+                while not self._captures:
+                    self._wake.wait()
+                now = time.perf_counter()
+                due = [capture for capture in self._captures.values() if capture.next_due <= now]
+                if due:
+                    frames = sys._current_frames()
+                    for capture in due:
+                        frame = frames.get(capture.ident)
+                        if frame is not None:
+                            capture.add(frame)
+                        capture.next_due = now + capture.interval
+                    del frames, frame
+                wait = min(capture.next_due for capture in self._captures.values()) - time.perf_counter()
+            time.sleep(max(wait, 0.001))
+
+
+_sampler = Sampler()
+_lock = threading.Lock()
+_ring = deque(maxlen=PROFILE_RING)
+_ids = itertools.count(1)
+_stats = {"requested": 0, "slow": 0, "discarded": 0, "samples": 0}
+
+
+def _authorized():
+    token = request.headers.get("X-Profile-Token", "")
+    return bool(PROFILE_TOKEN) and hmac.compare_digest(token.encode(), PROFILE_TOKEN.encode())
+
+
+def _requested():
+    if not PROFILE_TOKEN:
+        return False
+    flag = request.headers.get("X-Profile") or request.args.get("profile")
+    return flag not in (None, "", "0") and _authorized()
+
+
+def start_request():
+    if _requested():
+        trigger, interval = "requested", PROFILE_INTERVAL_MS
+    elif PROFILE_SLOW_MS > 0:
+        trigger, interval = "slow", PROFILE_SLOW_INTERVAL_MS
+    else:
+        return
+    capture = Capture(f"{next(_ids):x}", threading.get_ident(), interval / 1000, trigger)
+    g.profile = capture
+    _sampler.watch(capture)
+
+
+def finish_request(capture):
+    _sampler.unwatch(capture)
+    capture.duration_ms = round((time.perf_counter() - capture.start) * 1000, 1)
+    capture.stages = list(g.get("stage_timings") or ())
+    with _lock:
+        _stats["samples"] += capture.samples
+        if capture.trigger == "slow" and capture.duration_ms < PROFILE_SLOW_MS:
+            _stats["discarded"] += 1
+            return
+        _stats[capture.trigger] += 1
+        _ring.append(capture)
+
+
+def profiles():
+    with _lock:
+        return list(_ring)
+
+
+def profiler_stats():
+    with _lock:
+        return dict(_stats, kept=len(_ring))
+
+
+def render_collapsed(captures):
+    """Collapsed-stack text: one "frame;frame;frame value" line per distinct stack"""
+    merged = {}
+    for capture in captures:
+        for stack, ms in capture.weighted().items():
+            merged[stack] = merged.get(stack, 0) + ms
+    return "".join(f"{stack} {ms}\n" for stack, ms in sorted(merged.items()) if ms)
+
+
+def init_app(app):
+    """Profile requested and slow requests, and serve the ring under /api/profiles when PROFILE_TOKEN is set"""
+    @app.before_request
+    def _start_profile():
+        start_request()
+
+    @app.after_request
+    def _tag_profile(response):
+        capture = g.get("profile")
+        if capture is not None:
+            capture.status = response.status_code
+            if capture.trigger == "requested":
+                response.headers["X-Profile-Id"] = capture.id
+        return response
+
+    @app.teardown_request
+    def _finish_profile(exc):
+        capture = g.pop("profile", None)
+        if capture is not None:
+            finish_request(capture)
+
+    if not PROFILE_TOKEN:
+        return
+
+    @app.route('/api/profiles', methods=['GET'])
+    def list_profiles():
+        if not _authorized():
+            return jsonify({"error": "Bad profile token"}), 403
+        return jsonify({"profiles": [capture.summary() for capture in reversed(profiles())],
+                        "stats": profiler_stats()})
+
+    @app.route('/api/profiles/collapsed', methods=['GET'])
+    def collapsed_profiles():
+        if not _authorized():
+            return jsonify({"error": "Bad profile token"}), 403
+        path = request.args.get("path")
+        captures = [capture for capture in profiles() if path is None or capture.path == path]
+        return Response(render_collapsed(captures), mimetype="text/plain")
+
+    @app.route('/api/profiles/<profile_id>', methods=['GET'])
+    def get_profile(profile_id):
+        if not _authorized():
+            return jsonify({"error": "Bad profile token"}), 403
+        capture = next((capture for capture in profiles() if capture.id == profile_id), None)
+        if capture is None:
+            return jsonify({"error": "Unknown or expired profile"}), 404
+        if request.args.get("format") == "json":
+            return jsonify(dict(capture.summary(), stacks=capture.weighted()))
+        return Response(render_collapsed([capture]), mimetype="text/plain")
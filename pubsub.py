@@ -0,0 +1,265 @@
+# pubsub.py
+"""Live incident updates pushed to browsers over Server-Sent Events
+
+Publishers call publish(topic, key, data). Clients hold one
+GET /api/stream?incident=<id>&bbox=s,w,n,e connection and receive events
+for the incidents they follow plus any located event inside their bbox.
+
+Each event is encoded to its SSE frame once and the same bytes are handed
+to every subscriber. A subscriber's queue is bounded and coalescing: a new
+event replaces the pending one with the same (topic, key), so a slow
+client skips intermediate states and gets the latest plan, routes or map.
+When a queue is full the oldest pending event is dropped and the client is
+sent a "resync" event telling it to refetch. New subscribers start with
+the latest event per key of their topics.
+
+The broker is in-process. Another implementation with the same
+publish/subscribe/unsubscribe/stats methods can be installed with
+set_broker(). Each open stream holds a server worker, so many thousands of
+clients per node need a cooperative server (gunicorn -k gevent).
+"""
+import itertools
+import json
+import math
+import os
+import threading
+from collections import OrderedDict
+
+from flask import Response, jsonify, request
+
+# Pending events per subscriber before the oldest is dropped
+PUBSUB_MAX_PENDING = int(os.getenv("PUBSUB_MAX_PENDING", "64"))
+PUBSUB_MAX_SUBSCRIBERS = int(os.getenv("PUBSUB_MAX_SUBSCRIBERS", "50000"))
+# Seconds between keep-alive comments on an idle stream
+PUBSUB_HEARTBEAT = float(os.getenv("PUBSUB_HEARTBEAT", "15"))
+# Topics whose latest events are kept for new subscribers
+PUBSUB_TOPICS_KEEP = int(os.getenv("PUBSUB_TOPICS_KEEP", "4096"))
+
+_RESYNC_FRAME = b"event: resync\ndata: {}\n\n"
+_KEEPALIVE_FRAME = b": keepalive\n\n"
+
+
+class Event:
+    __slots__ = ("seq", "topic", "key", "lat", "lng", "frame")
+
+    def __init__(self, seq, topic, key, data, lat=None, lng=None):
+        self.seq = seq
+        self.topic = topic
+        self.key = key
+        self.lat = lat
+        self.lng = lng
+        payload = json.dumps({"topic": topic, "data": data}, separators=(",", ":"))
+        self.frame = f"id: {seq}\nevent: {key}\ndata: {payload}\n\n".encode()
+
+
+class Subscription:
+    """One client's bounded, coalescing queue of pending events"""
+    __slots__ = ("topics", "bbox", "cells", "max_pending", "lagged", "closed", "counts", "_pending", "_lock", "_ready")
+
+    def __init__(self, topics, bbox=None, max_pending=PUBSUB_MAX_PENDING):
+        self.topics = tuple(topics)
+        self.bbox = bbox  # (south, west, north, east) or None
+        self.cells = ()
+        self.max_pending = max_pending
+        self.lagged = False
+        self.closed = False
+        self.counts = {"delivered": 0, "coalesced": 0, "dropped": 0}
+        self._pending = OrderedDict()  # (topic, key) -> Event
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+
+    def offer(self, event):
+        with self._lock:
+            slot = (event.topic, event.key)
+            if slot in self._pending:
+                self.counts["coalesced"] += 1
+            elif len(self._pending) >= self.max_pending:
+                self._pending.popitem(last=False)
+                self.counts["dropped"] += 1
+                self.lagged = True
+            self._pending[slot] = event
+        self._ready.set()
+
+    def drain(self, timeout=None):
+        """Wait up to `timeout` for events; returns (frames, lagged)"""
+        self._ready.wait(timeout)
+        with self._lock:
+            frames = [event.frame for event in self._pending.values()]
+            self._pending.clear()
+            self._ready.clear()
+            lagged, self.lagged = self.lagged, False
+            self.counts["delivered"] += len(frames)
+        return frames, lagged
+
+    def wants(self, event):
+        south, west, north, east = self.bbox
+        return south <= event.lat <= north and west <= event.lng <= east
+
+    def close(self):
+        self.closed = True
+        self._ready.set()
+
+
+class LocalBroker:
+    """In-process broker: topic index plus a coarse grid index of geofenced subscribers"""
+
+    def __init__(self, max_pending=PUBSUB_MAX_PENDING, cell_deg=0.5, max_cells=1024):
+        self.max_pending = max_pending
+        self.cell_deg = cell_deg
+        self.max_cells = max_cells  # larger geofences are checked on every located event
+        self._lock = threading.Lock()
+        self._topics = {}  # topic -> set of Subscription
+        self._cells = {}  # grid cell -> set of Subscription
+        self._wide = set()
+        self._latest = OrderedDict()  # topic -> {key: Event}
+        self._seq = itertools.count(1)
+        self._subscribers = 0
+        self._counts = {"published": 0, "fanout": 0}
+        self._closed_counts = {"delivered": 0, "coalesced": 0, "dropped": 0}
+        self._live = set()
+
+    def _cell(self, lat, lng):
+        return (math.floor(lat / self.cell_deg), math.floor(lng / self.cell_deg))
+
+    def subscribe(self, topics=(), bbox=None):
+        """Register a subscriber; it starts with the latest event per key of its topics"""
+        sub = Subscription(topics, bbox, self.max_pending)
+        with self._lock:
+            if self._subscribers >= PUBSUB_MAX_SUBSCRIBERS:
+                return None
+            self._subscribers += 1
+            self._live.add(sub)
+            for topic in sub.topics:
+                self._topics.setdefault(topic, set()).add(sub)
+            if bbox is not None:
+                (row0, col0), (row1, col1) = self._cell(bbox[0], bbox[1]), self._cell(bbox[2], bbox[3])
+                if (row1 - row0 + 1) * (col1 - col0 + 1) > self.max_cells:
+                    self._wide.add(sub)
+                else:
+                    sub.cells = [(row, col) for row in range(row0, row1 + 1) for col in range(col0, col1 + 1)]
+                    for cell in sub.cells:
+                        self._cells.setdefault(cell, set()).add(sub)
+            snapshot = [event for topic in sub.topics for event in self._latest.get(topic, {}).values()]
+        for event in sorted(snapshot, key=lambda e: e.seq):
+            sub.offer(event)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            if sub not in self._live:
+                return
+            self._live.discard(sub)
+            self._subscribers -= 1
+            for topic in sub.topics:
+                subs = self._topics.get(topic)
+                if subs is not None:
+                    subs.discard(sub)
+                    if not subs:
+                        del self._topics[topic]
+            for cell in sub.cells:
+                subs = self._cells.get(cell)
+                if subs is not None:
+                    subs.discard(sub)
+                    if not subs:
+                        del self._cells[cell]
+            self._wide.discard(sub)
+            for name, count in sub.counts.items():
+                self._closed_counts[name] += count
+        sub.close()
+
+    def publish(self, topic, key, data, lat=None, lng=None):
+        """Send `data` as event `key` on `topic`; located events also reach matching geofences"""
+        # Encoded once, outside the lock; every subscriber gets the same bytes
+        event = Event(next(self._seq), topic, key, data, lat, lng)
+        with self._lock:
+            targets = set(self._topics.get(topic, ()))
+            if lat is not None and lng is not None:
+                nearby = self._cells.get(self._cell(lat, lng), ())
+                targets.update(sub for sub in nearby if sub.wants(event))
+                targets.update(sub for sub in self._wide if sub.wants(event))
+            latest = self._latest.pop(topic, {})
+            latest[key] = event
+            self._latest[topic] = latest
+            while len(self._latest) > PUBSUB_TOPICS_KEEP:
+                self._latest.popitem(last=False)
+            self._counts["published"] += 1
+            self._counts["fanout"] += len(targets)
+        for sub in targets:
+            sub.offer(event)
+        return event
+
+    def stats(self):
+        with self._lock:
+            totals = dict(self._closed_counts)
+            for sub in self._live:
+                for name, count in sub.counts.items():
+                    totals[name] += count
+            return dict(self._counts, **totals, subscribers=self._subscribers, topics=len(self._topics))
+
+
+_broker = LocalBroker()
+
+
+def broker():
+    return _broker
+
+
+def set_broker(new_broker):
+    """Install another broker implementation (same publish/subscribe/unsubscribe/stats)"""
+    global _broker
+    _broker = new_broker
+
+
+def publish(topic, key, data, lat=None, lng=None):
+    return _broker.publish(topic, key, data, lat, lng)
+
+
+def pubsub_stats():
+    return _broker.stats()
+
+
+def stream_frames(sub, source=None, heartbeat=None):
+    """SSE byte frames for a subscription until the client goes away"""
+    source = source or _broker
+    heartbeat = PUBSUB_HEARTBEAT if heartbeat is None else heartbeat
+    try:
+        yield b"retry: 3000\n\n"
+        while not sub.closed:
+            frames, lagged = sub.drain(heartbeat)
+            if lagged:
+                yield _RESYNC_FRAME
+            if frames:
+                yield b"".join(frames)
+            elif not lagged:
+                yield _KEEPALIVE_FRAME
+    finally:
+        source.unsubscribe(sub)
+
+
+def init_app(app):
+    """Serve GET /api/stream?incident=<id>[,<id>]&bbox=south,west,north,east as text/event-stream"""
+    @app.route('/api/stream', methods=['GET'])
+    def event_stream():
+        topics = [f"incident:{incident_id}" for incident_id in request.args.get('incident', '').split(',')
+                  if incident_id]
+        bbox = None
+        if request.args.get('bbox'):
+            try:
+                bbox = tuple(map(float, request.args['bbox'].split(',')))
+            except ValueError:
+                bbox = ()
+            if len(bbox) != 4:
+                return jsonify({"error": "bbox must be south,west,north,east"}), 400
+        if not topics and bbox is None:
+            return jsonify({"error": "Subscribe to an incident or a bbox"}), 400
+        source = _broker
+        sub = source.subscribe(topics, bbox)
+        if sub is None:
+            return jsonify({"error": "Too many subscribers"}), 503
+        response = Response(stream_frames(sub, source), mimetype='text/event-stream')
+        # Also covers a client that disconnects before the first frame is sent
+        response.call_on_close(lambda: source.unsubscribe(sub))
+        response.headers['Cache-Control'] = 'no-cache'
+        # Stop reverse proxies from buffering the stream
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
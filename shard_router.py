@@ -0,0 +1,292 @@
+# shard_router.py
+"""Local router for a sharded deployment: each request goes to the node owning its chat or incident
+
+    python shard_router.py --spawn app.py --nodes 3
+    python shard_router.py --node http://127.0.0.1:5001 --node http://127.0.0.1:5002
+
+--spawn starts that many copies of an app on consecutive ports with
+SHARD_NODES, SHARD_SELF, SECRET_KEY and SHARD_TOKEN set (and their own
+CONVERSATION_LOG file when one is configured). Nodes started by hand need
+the same variables.
+
+The routing key is the chat_id in the Flask session cookie (read with the
+shared SECRET_KEY), an "incident_id" in a JSON body, an "incident" query
+argument or an /api/incidents/<id>/ path. Requests without one go to the
+nodes in turn, and the node mints an id it owns.
+
+POST /admin/nodes {"nodes": [...]} rebalances onto a new member list; a
+joining node must already be running with the new SHARD_NODES. While it
+runs, writes (anything but GET, HEAD and OPTIONS) to keys that change owner,
+and writes without a key, which may mint one, wait for it to finish; those
+already in flight are let finish before anything is copied, so no turn
+lands on the old owner after its state was copied. Writes that wait longer
+than SHARD_PAUSE_TIMEOUT get a 503. If any node fails to copy its moving
+state, nothing switches and the report says "aborted".
+GET /admin/nodes shows the ring. Both need X-Shard-Token.
+"""
+import argparse
+import itertools
+import os
+import re
+import secrets
+import signal
+import subprocess
+import sys
+import threading
+import time
+from http.cookiejar import DefaultCookiePolicy
+
+from flask import Flask, Response, jsonify, request, session
+from werkzeug.wsgi import ClosingIterator
+
+import sharding
+from sharding import HashRing
+
+# Not forwarded in either direction (RFC 9110 hop-by-hop fields)
+HOP_HEADERS = {"connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+               "te", "trailer", "transfer-encoding", "upgrade", "host"}
+# Set again by the router's own server
+RESPONSE_SKIP_HEADERS = HOP_HEADERS | {"server", "date"}
+SHARD_CONNECT_TIMEOUT = float(os.getenv("SHARD_CONNECT_TIMEOUT", "3"))
+# Seconds a write waits for a rebalance, and a rebalance for writes in flight
+SHARD_PAUSE_TIMEOUT = float(os.getenv("SHARD_PAUSE_TIMEOUT", "30"))
+READ_METHODS = {"GET", "HEAD", "OPTIONS"}
+INCIDENT_PATH = re.compile(r"^/api/incidents/([^/]+)/")
+
+router = Flask(__name__, static_folder=None)
+router.secret_key = os.getenv("SECRET_KEY")
+
+_lock = threading.Lock()
+_ring = HashRing()
+_turns = itertools.cycle(())
+_http = None
+_rebalance_lock = threading.Lock()
+_gate = threading.Condition()
+_moving = None  # the ring being moved to, during a rebalance
+_writes = {}  # in-flight write token -> routing key
+
+
+def set_ring(ring):
+    global _ring, _turns
+    with _lock:
+        _ring = ring
+        _turns = itertools.cycle(ring.nodes)
+
+
+def http():
+    global _http
+    if _http is None:
+        import requests
+        _http = requests.Session()
+        # Cookies belong to the browser; a shared jar would hand one user's session to the next
+        _http.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return _http
+
+
+def routing_key():
+    if router.secret_key and session.get("chat_id"):
+        return session["chat_id"]
+    data = request.get_json(silent=True) if request.is_json else None
+    if isinstance(data, dict) and data.get("incident_id"):
+        return str(data["incident_id"])
+    if request.args.get("incident"):
+        return request.args["incident"].split(",")[0]
+    match = INCIDENT_PATH.match(request.path)
+    return match.group(1) if match else None
+
+
+def pick_node(key):
+    with _lock:
+        return _ring.owner(key) if key else next(_turns, None)
+
+
+def _moves(key):
+    """Whether a write for `key` must wait for the rebalance in progress; call with _gate held"""
+    return _moving is not None and (key is None or _ring.owner(key) != _moving.owner(key))
+
+
+def admit_write(key):
+    """Wait out a rebalance moving `key`, then count the write in flight; returns its token, or None on timeout"""
+    with _gate:
+        if not _gate.wait_for(lambda: not _moves(key), timeout=SHARD_PAUSE_TIMEOUT):
+            return None
+        token = object()
+        _writes[token] = key
+        return token
+
+
+def finish_write(token):
+    with _gate:
+        _writes.pop(token, None)
+        _gate.notify_all()
+
+
+@router.route('/admin/nodes', methods=['GET', 'POST'])
+def admin_nodes():
+    if not sharding.authorized():
+        return jsonify({"error": "Bad shard token"}), 403
+    if request.method == 'GET':
+        return jsonify({"nodes": list(_ring.nodes)})
+    members = (request.get_json(silent=True) or {}).get("nodes")
+    if not isinstance(members, list) or not members:
+        return jsonify({"error": "nodes must be a non-empty list of node URLs"}), 400
+    return jsonify(rebalance([node.rstrip("/") for node in members]))
+
+
+def rebalance(members):
+    """Move onto a new member list with writes to the moving keys paused"""
+    global _moving
+    with _rebalance_lock:
+        new = HashRing(members)
+        with _gate:
+            _moving = new
+            drained = _gate.wait_for(lambda: not any(_moves(key) for key in _writes.values()),
+                                     timeout=SHARD_PAUSE_TIMEOUT)
+        try:
+            if not drained:
+                return {"nodes": list(_ring.nodes), "aborted": True,
+                        "error": "writes to moving keys still in flight"}
+            return _rebalance(_ring, new)
+        finally:
+            with _gate:
+                _moving = None
+                _gate.notify_all()
+
+
+def _rebalance(old, new):
+    """Copy moved state to the new owners, switch the ring once every copy succeeded, then release the old copies"""
+    nodes = sorted(set(old.nodes) | set(new.nodes))
+    report = {"nodes": list(new.nodes), "copied": {}, "released": {}}
+    failed = False
+    for node in nodes:
+        try:
+            report["copied"][node] = sharding._post(node, "/api/shard/members",
+                                                    {"nodes": list(new.nodes), "phase": "copy"})
+            failed = failed or bool(report["copied"][node]["errors"])
+        except Exception as e:
+            report["copied"][node] = {"error": str(e)}
+            failed = True
+    if failed:
+        # Nothing has switched; copies already made sit unused on nodes that do not own them yet
+        report["nodes"] = list(old.nodes)
+        report["aborted"] = True
+        return report
+    for node in nodes:
+        try:
+            sharding._post(node, "/api/shard/members", {"nodes": list(new.nodes), "phase": "switch"})
+        except Exception as e:
+            print(f"Error switching {node} to the new ring: {e}")
+    set_ring(new)
+    for node in old.nodes:
+        try:
+            report["released"][node] = sharding._post(node, "/api/shard/release", {})["released"]
+        except Exception as e:
+            report["released"][node] = {"error": str(e)}
+    return report
+
+
+@router.route('/', defaults={'path': ''}, methods=['GET', 'POST', 'PUT', 'PATCH', 'DELETE'])
+@router.route('/<path:path>', methods=['GET', 'POST', 'PUT', 'PATCH', 'DELETE'])
+def forward(path):
+    key = routing_key()
+    token = None
+    if request.method not in READ_METHODS:
+        token = admit_write(key)
+        if token is None:
+            return jsonify({"error": "Rebalancing, try again"}), 503, {"Retry-After": "1"}
+    try:
+        return _forward(pick_node(key), token)
+    except Exception:
+        finish_write(token)
+        raise
+
+
+def _forward(node, token):
+    if node is None:
+        finish_write(token)
+        return jsonify({"error": "No nodes configured"}), 503
+    url = node + request.path
+    if request.query_string:
+        url += "?" + request.query_string.decode()
+    headers = {name: value for name, value in request.headers if name.lower() not in HOP_HEADERS}
+    try:
+        upstream = http().request(request.method, url, headers=headers, data=request.get_data(),
+                                  stream=True, allow_redirects=False, timeout=(SHARD_CONNECT_TIMEOUT, None))
+    except Exception as e:
+        print(f"Error forwarding to {node}: {e}")
+        finish_write(token)
+        return jsonify({"error": "Node unavailable", "node": node}), 502
+    # Relay bytes as they arrive, still encoded, so event streams and gzip pass through untouched.
+    # direct_passthrough skips Response.close(), so the body closes the upstream itself, and a
+    # streamed write stays in flight until its last byte has been relayed
+    body = ClosingIterator(upstream.raw.stream(decode_content=False),
+                           [upstream.close, lambda: finish_write(token)])
+    response = Response(body, status=upstream.status_code,
+                        headers=[(name, value) for name, value in upstream.raw.headers.items()
+                                 if name.lower() not in RESPONSE_SKIP_HEADERS],
+                        direct_passthrough=True)
+    response.headers['X-Shard-Node'] = node
+    return response
+
+
+def spawn(app_file, count, base_port):
+    """Start `count` copies of `app_file`; returns (node URLs, processes)"""
+    members = [f"http://127.0.0.1:{base_port + i}" for i in range(count)]
+    processes = []
+    for port, node in zip(range(base_port, base_port + count), members):
+        env = dict(os.environ, SHARD_NODES=",".join(members), SHARD_SELF=node)
+        if env.get("CONVERSATION_LOG"):
+            env["CONVERSATION_LOG"] = f"{env['CONVERSATION_LOG']}.{port}"
+        processes.append(subprocess.Popen(
+            [sys.executable, "-m", "flask", "--app", app_file, "run", "--port", str(port)], env=env))
+    return members, processes
+
+
+def wait_ready(members, timeout=60):
+    deadline = time.monotonic() + timeout
+    for node in members:
+        while True:
+            try:
+                http().get(node + "/api/shard", headers={"X-Shard-Token": sharding.SHARD_TOKEN},
+                           timeout=1).raise_for_status()
+                break
+            except Exception:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--node", action="append", default=[], help="base URL of a running node")
+    parser.add_argument("--spawn", metavar="APP", help="start --nodes copies of this app file")
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--base-port", type=int, default=5001)
+    parser.add_argument("--port", type=int, default=5000)
+    args = parser.parse_args()
+
+    # Nodes and router must share these; generate them once for spawned nodes
+    os.environ.setdefault("SECRET_KEY", secrets.token_hex(24))
+    os.environ.setdefault("SHARD_TOKEN", secrets.token_hex(16))
+    router.secret_key = os.environ["SECRET_KEY"]
+    sharding.SHARD_TOKEN = os.environ["SHARD_TOKEN"]
+    members, processes = list(args.node), []
+    if args.spawn:
+        spawned, processes = spawn(args.spawn, args.nodes, args.base_port)
+        members += spawned
+        wait_ready(spawned)
+    if not members:
+        parser.error("give --node URLs or --spawn an app")
+    set_ring(HashRing(node.rstrip("/") for node in members))
+    print(f"Routing to {', '.join(_ring.nodes)}")
+    # Stop the spawned nodes on kill as well as on Ctrl-C
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        router.run(port=args.port, threaded=True)
+    finally:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+# sharding.py
+"""Session-affinity sharding of chats and incidents across several app processes
+
+SHARD_NODES lists the base URLs of every node and SHARD_SELF is this node's
+own URL. A consistent-hash ring with SHARD_VNODES points per node maps each
+chat id or incident id to the node that owns it, and shard_router.py
+forwards every request to that owner, so a chat's history, an incident's
+state and its map stay in one process. Ids minted with new_id() are drawn
+until they hash to this node, so a new chat or incident is owned by the
+node that created it.
+
+Geo lookups stay cached per node. An entry used SHARD_HOT_HITS times on one
+node is pushed to every peer, so popular places are answered locally
+everywhere.
+
+Membership changes go through the router (POST /admin/nodes). Every node is
+sent the new member list and copies the state of the keys it will no longer
+own to their new owners. Only when every copy succeeded do the nodes and the
+router switch to the new ring, and every node then releases what it handed
+over; a failed copy leaves the old ring in place. The router holds writes
+to the moving keys from before the copy until the switch, so none land on
+an old owner after its state was copied.
+
+The /api/shard endpoints move whole chat histories, so they are only served
+when SHARD_NODES is set, and then SHARD_TOKEN must be set too. Without
+SHARD_NODES this process owns every key and nothing is replicated.
+"""
+import bisect
+import hashlib
+import hmac
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+from flask import jsonify, request
+
+SHARD_NODES = [node.strip().rstrip("/") for node in os.getenv("SHARD_NODES", "").split(",") if node.strip()]
+SHARD_SELF = os.getenv("SHARD_SELF", "").rstrip("/")
+SHARD_VNODES = int(os.getenv("SHARD_VNODES", "64"))
+# Uses of a geo entry on one node before it is pushed to the others
+SHARD_HOT_HITS = int(os.getenv("SHARD_HOT_HITS", "3"))
+SHARD_REPLICA_SIZE = int(os.getenv("SHARD_REPLICA_SIZE", "1024"))
+# Sent by nodes and the router on /api/shard/* and /admin/* calls
+SHARD_TOKEN = os.getenv("SHARD_TOKEN", "")
+SHARD_TIMEOUT = float(os.getenv("SHARD_TIMEOUT", "5"))
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hashing: adding or removing a node moves only the keys on its arcs"""
+
+    def __init__(self, nodes=(), vnodes=SHARD_VNODES):
+        self.nodes = tuple(sorted(set(nodes)))
+        self.vnodes = vnodes
+        points = sorted((_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def owner(self, key):
+        if not self._owners:
+            return None
+        return self._owners[bisect.bisect(self._hashes, _hash(key)) % len(self._owners)]
+
+
+_lock = threading.Lock()
+_ring = HashRing(SHARD_NODES)
+_handlers = {}  # kind -> (keys, export, load, release)
+_caches = {}
+_stats = {"minted": 0, "copied": 0, "imported": 0, "released": 0, "copy_errors": 0}
+
+
+def enabled():
+    return bool(_ring.nodes)
+
+
+def nodes():
+    return _ring.nodes
+
+
+def owner(key):
+    return _ring.owner(key) if enabled() else SHARD_SELF
+
+
+def owns(key):
+    return not enabled() or _ring.owner(key) == SHARD_SELF
+
+
+def new_id():
+    """A fresh hex id owned by this node"""
+    while True:
+        key = uuid.uuid4().hex
+        # A node that is leaving owns nothing; its ids move with the rest
+        if owns(key) or SHARD_SELF not in _ring.nodes:
+            with _lock:
+                _stats["minted"] += 1
+            return key
+
+
+def register(kind, keys, export, load, release):
+    """Hand-off hooks for one kind of per-key state
+
+    keys() lists the local keys, export(key) returns a JSON-able state,
+    load(key, state) installs one received from a peer and release(key)
+    drops a key that now lives elsewhere.
+    """
+    _handlers[kind] = (keys, export, load, release)
+
+
+def _post(node, path, payload):
+    import requests  # deferred like upstream.get_json
+
+    response = requests.post(node + path, json=payload, headers={"X-Shard-Token": SHARD_TOKEN},
+                             timeout=SHARD_TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+
+def copy_moved(members):
+    """Copy the state of keys that move under a new member list to their new owners, without switching"""
+    ring = HashRing(members)
+    copied, errors = 0, []
+    for kind, (keys, export, _, _) in _handlers.items():
+        outgoing = {}
+        for key in list(keys()):
+            target = ring.owner(key)
+            if target and target != SHARD_SELF:
+                state = export(key)
+                if state is not None:
+                    outgoing.setdefault(target, {})[key] = state
+        for target, items in outgoing.items():
+            try:
+                _post(target, "/api/shard/import", {"kind": kind, "items": items})
+                copied += len(items)
+            except Exception as e:
+                print(f"Error copying {len(items)} {kind} to {target}: {e}")
+                errors.append(target)
+    with _lock:
+        _stats["copied"] += copied
+        _stats["copy_errors"] += len(errors)
+    return {"copied": copied, "errors": errors}
+
+
+def switch_members(members):
+    global _ring
+    ring = HashRing(members)
+    with _lock:
+        _ring = ring
+
+
+def set_members(members):
+    """Copy moved state to the new owners, then switch to the new ring if every copy succeeded"""
+    result = copy_moved(members)
+    result["switched"] = not result["errors"]
+    if result["switched"]:
+        switch_members(members)
+    return result
+
+
+def release_moved():
+    """Drop local state for keys this node no longer owns"""
+    released = 0
+    for keys, _, _, release in _handlers.values():
+        for key in list(keys()):
+            if not owns(key):
+                release(key)
+                released += 1
+    with _lock:
+        _stats["released"] += released
+    return released
+
+
+class ReplicatedCache:
+    """Geo entries pushed by peers, plus the use counts that decide which local entries to push"""
+
+    def __init__(self, name, size=SHARD_REPLICA_SIZE, hot_hits=SHARD_HOT_HITS):
+        self.name = name
+        self.size = size
+        self.hot_hits = hot_hits
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._uses = OrderedDict()
+        self._counts = {"hits": 0, "pushed": 0, "received": 0}
+
+    def get(self, key):
+        """A peer's value for `key`, or None"""
+        if not enabled():
+            return None
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self._counts["hits"] += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            self._counts["received"] += 1
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def record(self, key, value):
+        """Count a local use of `key`; the use that makes it hot pushes it to every peer"""
+        if not enabled() or not isinstance(key, str):
+            return
+        with self._lock:
+            uses = self._uses.pop(key, 0) + 1
+            self._uses[key] = uses
+            while len(self._uses) > self.size:
+                self._uses.popitem(last=False)
+        if uses == self.hot_hits:
+            from jobs import job_queue
+
+            job_queue("shard").submit("replicate", (self.name, key), self._push, key, value)
+
+    def _push(self, key, value):
+        for node in _ring.nodes:
+            if node != SHARD_SELF:
+                try:
+                    _post(node, "/api/shard/cache", {"cache": self.name, "key": key, "value": value})
+                except Exception as e:
+                    print(f"Error replicating {self.name} entry to {node}: {e}")
+        with self._lock:
+            self._counts["pushed"] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counts, entries=len(self._entries))
+
+
+def replicated_cache(name):
+    if name not in _caches:
+        _caches[name] = ReplicatedCache(name)
+    return _caches[name]
+
+
+def sharding_stats():
+    with _lock:
+        stats = dict(_stats)
+    return dict(stats, enabled=enabled(), self=SHARD_SELF, nodes=list(_ring.nodes),
+                caches={name: cache.stats() for name, cache in _caches.items()})
+
+
+def authorized():
+    token = request.headers.get("X-Shard-Token", "")
+    return bool(SHARD_TOKEN) and hmac.compare_digest(token.encode(), SHARD_TOKEN.encode())
+
+
+def init_app(app):
+    """Serve the /api/shard endpoints nodes and the router use to move state, when sharding is configured"""
+    if not SHARD_NODES:
+        return
+    if not SHARD_TOKEN:
+        raise RuntimeError("SHARD_NODES is set but SHARD_TOKEN is empty; refusing to serve /api/shard")
+
+    @app.route('/api/shard', methods=['GET'])
+    def shard_info():
+        if not authorized():
+            return jsonify({"error": "Bad shard token"}), 403
+        return jsonify(sharding_stats())
+
+    @app.route('/api/shard/members', methods=['POST'])
+    def shard_members():
+        if not authorized():
+            return jsonify({"error": "Bad shard token"}), 403
+        data = request.get_json(silent=True) or {}
+        members = data.get("nodes")
+        if not isinstance(members, list):
+            return jsonify({"error": "nodes must be a list of node URLs"}), 400
+        # The router copies on every node first and switches them only once all copies succeeded
+        if data.get("phase") == "copy":
+            return jsonify(copy_moved(members))
+        if data.get("phase") == "switch":
+            switch_members(members)
+            return jsonify({"switched": True})
+        return jsonify(set_members(members))
+
+    @app.route('/api/shard/release', methods=['POST'])
+    def shard_release():
+        if not authorized():
+            return jsonify({"error": "Bad shard token"}), 403
+        return jsonify({"released": release_moved()})
+
+    @app.route('/api/shard/import', methods=['POST'])
+    def shard_import():
+        if not authorized():
+            return jsonify({"error": "Bad shard token"}), 403
+        data = request.get_json(silent=True) or {}
+        handler = _handlers.get(data.get("kind"))
+        if handler is None:
+            return jsonify({"error": "Unknown state kind"}), 400
+        items = data.get("items") or {}
+        for key, state in items.items():
+            handler[2](key, state)
+        with _lock:
+            _stats["imported"] += len(items)
+        return jsonify({"imported": len(items)})
+
+    @app.route('/api/shard/cache', methods=['POST'])
+    def shard_cache():
+        if not authorized():
+            return jsonify({"error": "Bad shard token"}), 403
+        data = request.get_json(silent=True) or {}
+        if not data.get("cache") or not isinstance(data.get("key"), str):
+            return jsonify({"error": "cache and key are required"}), 400
+        replicated_cache(data["cache"]).put(data["key"], data.get("value"))
+        return jsonify({"ok": True})
@@ -0,0 +1,110 @@
+# startup.py
+"""Cold-start timing for the Flask entry points
+
+Heavy dependencies (groq, folium, geopy, requests) are imported on first use
+rather than at module load. `lazy_resource` wraps those loaders so the cost
+moves to the first request (or a background prewarm), and both import-time
+phases and deferred loads are reported:
+
+    [startup] disaster-response ready in 182.4ms (imports 160.1ms, app 22.3ms)
+
+`python -X importtime disaster-response-chatbot.py` shows what is still on
+the critical path.
+"""
+import functools
+import os
+import threading
+import time
+
+_lock = threading.Lock()
+_reports = {}  # app name -> StartupReport
+_deferred = {}  # resource name -> seconds spent on its first load
+
+
+class StartupReport:
+    """Import-to-ready phases of one entry point, marked in order"""
+
+    def __init__(self, app_name):
+        self.app_name = app_name
+        self.start = time.perf_counter()
+        self._last = self.start
+        self.phases = []
+        self.ready_seconds = None
+        with _lock:
+            _reports[app_name] = self
+
+    def mark(self, phase):
+        """Close the phase running since the previous mark"""
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    def ready(self):
+        self.ready_seconds = time.perf_counter() - self.start
+        if os.getenv("STARTUP_REPORT", "1") == "1":
+            phases = ", ".join(f"{phase} {seconds * 1000:.1f}ms" for phase, seconds in self.phases)
+            print(f"[startup] {self.app_name} ready in {self.ready_seconds * 1000:.1f}ms ({phases})")
+
+    def to_dict(self):
+        return {
+            "ready_ms": round(self.ready_seconds * 1000, 1) if self.ready_seconds is not None else None,
+            "phases_ms": {phase: round(seconds * 1000, 1) for phase, seconds in self.phases},
+        }
+
+
+def lazy_resource(name):
+    """Decorator: build the resource once on first call and record how long that took"""
+    def decorator(factory):
+        lock = threading.Lock()
+        box = []
+
+        @functools.wraps(factory)
+        def get():
+            if box:
+                return box[0]
+            with lock:
+                if not box:
+                    start = time.perf_counter()
+                    box.append(factory())
+                    with _lock:
+                        _deferred[name] = time.perf_counter() - start
+            return box[0]
+
+        get.loaded = lambda: bool(box)
+        return get
+    return decorator
+
+
+def prewarm(*loaders):
+    """Run lazy loaders on a daemon thread so serving starts before they finish"""
+    def run():
+        for loader in loaders:
+            try:
+                loader()
+            except Exception as e:
+                print(f"Prewarm of {getattr(loader, '__name__', loader)} failed: {e}")
+
+    thread = threading.Thread(target=run, name="prewarm", daemon=True)
+    thread.start()
+    return thread
+
+
+def startup_stats():
+    with _lock:
+        return {
+            "apps": {name: report.to_dict() for name, report in _reports.items()},
+            "deferred_ms": {name: round(seconds * 1000, 1) for name, seconds in _deferred.items()},
+        }
+
+
+def startup_collector():
+    with _lock:
+        reports = list(_reports.values())
+        deferred = dict(_deferred)
+    return [
+        ("disaster_startup_seconds", "gauge", "Time from first import to a ready app, by phase",
+         [({"app": report.app_name, "phase": phase}, round(seconds, 6))
+          for report in reports for phase, seconds in report.phases]),
+        ("disaster_lazy_load_seconds", "gauge", "First-use load time of lazily imported resources",
+         [({"resource": name}, round(seconds, 6)) for name, seconds in deferred.items()]),
+    ]
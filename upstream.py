@@ -0,0 +1,280 @@
+# upstream.py
+"""Shared plumbing for calls to upstream providers (Groq, TomTom, Overpass, Nominatim)"""
+import os
+import threading
+import time
+from collections import deque
+
+
+class _Call:
+    """One in-flight upstream call whose result is shared by every waiter"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesce concurrent identical calls so only one reaches the provider
+
+    Unlike `lru_cache`, which only helps once the first call has returned,
+    callers that arrive while a call with the same key is in flight block on
+    it and receive its result (or its exception). Nothing is cached afterwards.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.calls = 0
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        """Run `fn(*args, **kwargs)` unless a call for `key` is already in flight"""
+        with self._lock:
+            self.calls += 1
+            call = self._calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                self.executed += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "executed": self.executed,
+                "coalesced": self.coalesced,
+                "in_flight": len(self._calls),
+            }
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def single_flight(name):
+    """Return the process-wide SingleFlight group for an upstream call site"""
+    with _flights_lock:
+        if name not in _flights:
+            _flights[name] = SingleFlight(name)
+        return _flights[name]
+
+
+def coalescing_stats():
+    """Per-call-site counts of executed and coalesced upstream calls"""
+    with _flights_lock:
+        flights = list(_flights.values())
+    return {flight.name: flight.stats() for flight in flights}
+
+
+class UpstreamUnavailable(Exception):
+    """The provider was not called because of local protection (rate limit or open circuit)"""
+
+
+class RateLimited(UpstreamUnavailable):
+    pass
+
+
+class CircuitOpen(UpstreamUnavailable):
+    pass
+
+
+class TokenBucket:
+    """Token-bucket rate limiter with FIFO queueing and a bounded wait
+
+    Each caller reserves the next free slot and sleeps until it, so waiting
+    callers are served in order without holding the lock. A caller whose
+    slot lies more than `max_wait` seconds in the future is rejected with
+    RateLimited instead of tying up a worker.
+    """
+
+    def __init__(self, rate, burst=1, max_wait=2.0):
+        self.rate = float(rate)
+        self.burst = max(1, int(burst))
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._interval = 1.0 / self.rate
+        # Theoretical arrival time of the next request (GCRA formulation)
+        self._tat = time.monotonic()
+        self.waited = 0
+        self.rejected = 0
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            tat = max(self._tat, now)
+            wait = tat - now - (self.burst - 1) * self._interval
+            if wait > self.max_wait:
+                self.rejected += 1
+                raise RateLimited(f"rate limit queue full ({wait:.2f}s wait)")
+            self._tat = tat + self._interval
+            if wait > 0:
+                self.waited += 1
+        if wait > 0:
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """Trip when the error rate over the last `window` calls exceeds `error_rate`
+
+    While open, calls fail fast with CircuitOpen. After `cooldown` seconds a
+    single trial call is let through (half-open); its outcome closes or
+    re-opens the circuit.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, window=20, min_calls=5, error_rate=0.5, cooldown=30.0):
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._outcomes = deque(maxlen=window)
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self.state = self.CLOSED
+        self.trips = 0
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.cooldown:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record(self, success):
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._trial_in_flight = False
+                if success:
+                    self.state = self.CLOSED
+                    self._outcomes.clear()
+                else:
+                    self._trip()
+                return
+            self._outcomes.append(success)
+            failures = self._outcomes.count(False)
+            if (len(self._outcomes) >= self.min_calls
+                    and failures / len(self._outcomes) >= self.error_rate):
+                self._trip()
+
+    def _trip(self):
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+        self.trips += 1
+
+
+class Provider:
+    """Rate limiter and circuit breaker guarding one upstream provider"""
+
+    def __init__(self, name, rate, burst=1, max_wait=2.0, breaker=None):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst, max_wait)
+        self.breaker = breaker or CircuitBreaker()
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.failures = 0
+
+    def call(self, fn, *args, **kwargs):
+        if not self.breaker.allow():
+            raise CircuitOpen(f"{self.name} circuit is open")
+        try:
+            self.bucket.acquire()
+        except RateLimited:
+            # A rejected reservation must not leave a half-open trial dangling
+            if self.breaker.state == CircuitBreaker.HALF_OPEN:
+                self.breaker.record(False)
+            raise
+        with self._lock:
+            self.calls += 1
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            with self._lock:
+                self.failures += 1
+            self.breaker.record(False)
+            raise
+        self.breaker.record(True)
+        return result
+
+    def stats(self):
+        with self._lock:
+            calls, failures = self.calls, self.failures
+        return {
+            "calls": calls,
+            "failures": failures,
+            "circuit": self.breaker.state,
+            "trips": self.breaker.trips,
+            "rate_limited_waits": self.bucket.waited,
+            "rate_limited_rejections": self.bucket.rejected,
+        }
+
+
+# Requests per second and burst per provider; Nominatim's usage policy allows 1 req/s.
+# Override with UPSTREAM_<NAME>_RATE, UPSTREAM_<NAME>_BURST and UPSTREAM_<NAME>_MAX_WAIT.
+PROVIDER_DEFAULTS = {
+    "nominatim": {"rate": 1, "burst": 1, "max_wait": 2.0},
+    "overpass": {"rate": 2, "burst": 2, "max_wait": 5.0},
+    "tomtom": {"rate": 5, "burst": 5, "max_wait": 2.0},
+    "groq": {"rate": 10, "burst": 10, "max_wait": 5.0},
+}
+
+_providers = {}
+
+
+def provider(name):
+    """Return the process-wide Provider guard for `name`"""
+    with _flights_lock:
+        if name not in _providers:
+            config = dict(PROVIDER_DEFAULTS.get(name, {"rate": 10, "burst": 10, "max_wait": 2.0}))
+            prefix = f"UPSTREAM_{name.upper()}_"
+            for key in config:
+                value = os.getenv(prefix + key.upper())
+                if value:
+                    config[key] = float(value)
+            _providers[name] = Provider(name, **config)
+        return _providers[name]
+
+
+def provider_stats():
+    with _flights_lock:
+        providers = list(_providers.values())
+    return {p.name: p.stats() for p in providers}
+
+
+def get_json(url, params=None, timeout=30):
+    """GET a JSON resource, raising on server errors so they count against the circuit"""
+    import requests  # deferred: not needed until the first upstream call
+    response = requests.get(url, params=params, timeout=timeout)
+    if response.status_code == 429 or response.status_code >= 500:
+        response.raise_for_status()
+    return response.json()